@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+from .config import log
+from .schemas import Priority
+
+
+class Overloaded(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits how many requests run at once, queuing the rest by priority and rejecting them when overloaded.
+
+    When the queue is full, a new request displaces the lowest priority request in the queue if it's more important,
+    and is rejected otherwise. Requests that wait longer than the timeout are rejected as well.
+    """
+
+    def __init__(self, concurrency: int, max_queue_size: int, timeout: float | None = None) -> None:
+        """
+        Args:
+            concurrency: Maximum number of admitted requests at a time.
+            max_queue_size: Maximum number of requests waiting to be admitted.
+            timeout: Rejects requests that waited this many seconds to be admitted. Disabled if None. Defaults to None.
+        """
+
+        self.concurrency = concurrency
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout
+        self.active = 0
+        self.queue: list[tuple[Priority, int, asyncio.Future[None]]] = []
+        self.rejected = {"queue_full": 0, "timeout": 0}
+        # smoothed time requests wait to be admitted, used to suggest when rejected requests should retry
+        self.wait_time = 0.0
+        self._counter = itertools.count()
+
+    async def acquire(self, priority: Priority) -> None:
+        """Waits until the request is admitted. Raises `Overloaded` if it's rejected."""
+
+        if self.active < self.concurrency and not self.queue:
+            self.active += 1
+            return
+
+        if len(self.queue) >= self.max_queue_size:
+            self._shed(priority)
+
+        start = time.monotonic()
+        entry = (priority, next(self._counter), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.queue, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(entry[2]), self.timeout)
+        except asyncio.TimeoutError:
+            # the slot may have been handed over right as the request timed out
+            if not _admitted(entry[2]):
+                self._remove(entry)
+                self.rejected["timeout"] += 1
+                raise Overloaded("Request timed out while waiting to be processed", 503, self.retry_after)
+        except asyncio.CancelledError:
+            if _admitted(entry[2]):
+                self.release()
+            else:
+                self._remove(entry)
+            raise
+        self.wait_time = 0.9 * self.wait_time + 0.1 * (time.monotonic() - start)
+
+    def release(self) -> None:
+        """Hands the request's slot to the highest priority request in the queue, or frees it."""
+
+        while self.queue:
+            _, _, future = heapq.heappop(self.queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    @property
+    def retry_after(self) -> int:
+        return max(math.ceil(self.wait_time), 1)
+
+    def queued(self, priority: Priority) -> int:
+        return sum(entry[0] == priority for entry in self.queue)
+
+    def _shed(self, priority: Priority) -> None:
+        self.rejected["queue_full"] += 1
+        error = Overloaded("Too many requests are waiting to be processed", 429, self.retry_after)
+        if not self.queue or max(self.queue)[0] <= priority:
+            raise error
+
+        lowest = max(self.queue)
+
+        log.debug(f"Shedding a queued {lowest[0].name.lower()} priority request for a {priority.name.lower()} one")
+        self._remove(lowest)
+        lowest[2].set_exception(error)
+
+    def _remove(self, entry: tuple[Priority, int, asyncio.Future[None]]) -> None:
+        try:
+            self.queue.remove(entry)
+        except ValueError:
+            return
+        heapq.heapify(self.queue)
+
+
+def _admitted(future: asyncio.Future[None]) -> bool:
+    return future.done() and not future.cancelled() and future.exception() is None
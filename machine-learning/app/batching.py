@@ -0,0 +1,104 @@
+import asyncio
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Any
+
+import orjson
+
+from .config import log
+from .models.base import InferenceModel
+
+
+@dataclass
+class PendingBatch:
+    model: InferenceModel
+    options: dict[str, Any]
+    inputs: list[Any] = field(default_factory=list)
+    futures: list[asyncio.Future[Any]] = field(default_factory=list)
+    timer: asyncio.TimerHandle | None = None
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests for the same model into a single batched inference call. Only requests with the same
+    options are grouped, as the options apply to the whole batch.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait_ms: float, executor: Executor | None = None) -> None:
+        """
+        Args:
+            max_batch_size: Runs a batch as soon as it has this many inputs.
+            max_wait_ms: Runs a batch after its first input has waited this long, even if it isn't full.
+            executor: Executor to run batches in. Batches run in the event loop if None. Defaults to None.
+        """
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.pending: dict[tuple[int, bytes], PendingBatch] = {}
+        self.running: set[asyncio.Task[None]] = set()
+
+    async def submit(self, model: InferenceModel, inputs: Any, options: dict[str, Any] | None = None) -> Any:
+        loop = asyncio.get_running_loop()
+        options = options or {}
+        key = (id(model), orjson.dumps(options, option=orjson.OPT_SORT_KEYS))
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = self.pending[key] = PendingBatch(model, options)
+            batch.timer = loop.call_later(self.max_wait, self._flush, key)
+
+        future = loop.create_future()
+        batch.inputs.append(inputs)
+        batch.futures.append(future)
+        if len(batch.inputs) >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key: tuple[int, bytes]) -> None:
+        batch = self.pending.pop(key, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+
+        task = asyncio.create_task(self._run(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _run(self, batch: PendingBatch) -> None:
+        try:
+            outputs = await self._call(batch.model, partial(batch.model.predict_batch, **batch.options), batch.inputs)
+        except Exception as e:
+            if len(batch.inputs) == 1:
+                _set_exception(batch.futures[0], e)
+                return
+            # isolate the failing input(s) so one bad image doesn't fail every request in the batch
+            log.debug(f"Batch of {len(batch.inputs)} failed for '{batch.model.model_name}'; retrying individually")
+            for inputs, future in zip(batch.inputs, batch.futures):
+                try:
+                    _set_result(
+                        future, await self._call(batch.model, partial(batch.model.predict, **batch.options), inputs)
+                    )
+                except Exception as item_error:
+                    _set_exception(future, item_error)
+            return
+
+        for output, future in zip(outputs, batch.futures):
+            _set_result(future, output)
+
+    async def _call(self, model: InferenceModel, func: Any, inputs: Any) -> Any:
+        async with model.reserve():
+            if self.executor is None:
+                return func(inputs)
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, inputs)
+
+
+def _set_result(future: asyncio.Future[Any], result: Any) -> None:
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future[Any], exception: BaseException) -> None:
+    if not future.done():
+        future.set_exception(exception)
@@ -0,0 +1,215 @@
+import threading
+from pathlib import Path
+from typing import Any, Literal
+
+import numpy as np
+import orjson
+
+from .config import log
+from .index import NDArray, VectorIndex
+
+# faces are compared with this many of their nearest neighbors, as the nearest ones may not have a cluster
+_NEIGHBORS = 16
+# similarities are computed for this many pairs of faces at a time during re-clustering
+_PAIRS_PER_CHUNK = 2**24
+
+
+class FaceClusters:
+    """
+    Groups face embeddings into clusters of the same person.
+
+    New faces join the cluster of their most similar face within `max_distance`, or start a new cluster, using an
+    index of every face's embedding. This is fast, but can split a person into several clusters depending on the
+    order faces are added in. `recluster` groups every face from scratch with DBSCAN instead.
+
+    The folder contains the index of embeddings in `embeddings` and a log of each face's cluster in `clusters.jsonl`.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        dtype: Literal["float16", "float32"] = "float16",
+        partitions: int = 0,
+        probes: int = 8,
+    ) -> None:
+        self.folder = folder
+        self.index = VectorIndex(folder / "embeddings", dtype=dtype, partitions=partitions, probes=probes)
+        self.clusters: dict[str, int] = {}
+        self._next_cluster = 0
+        self._lock = threading.Lock()
+        clusters_path = folder / "clusters.jsonl"
+        if clusters_path.is_file():
+            with clusters_path.open("rb") as f:
+                for line in f:
+                    self._apply(orjson.loads(line))
+
+    def __len__(self) -> int:
+        return len(self.clusters)
+
+    def assign(self, ids: list[str], embeddings: NDArray, max_distance: float = 0.5) -> list[int]:
+        """
+        Adds faces to the index and returns their clusters. Faces already in the index are assigned again with
+        their new embedding.
+        """
+
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True).clip(min=1e-12)
+        clusters: list[int] = []
+        entries: list[dict[str, Any]] = []
+        with self._lock:
+            try:
+                self._assign(ids, embeddings, 1 - max_distance, clusters, entries)
+            finally:
+                # logs the faces that were added even if a later one fails
+                self._log(entries)
+        return clusters
+
+    def _assign(
+        self,
+        ids: list[str],
+        embeddings: NDArray,
+        min_similarity: float,
+        clusters: list[int],
+        entries: list[dict[str, Any]],
+    ) -> None:
+        for id, embedding in zip(ids, embeddings):
+            cluster = None
+            for other, similarity in self.index.search(embedding, _NEIGHBORS):
+                if similarity < min_similarity:
+                    break
+                if other != id and other in self.clusters:
+                    cluster = self.clusters[other]
+                    break
+            if cluster is None:
+                cluster = self._next_cluster
+            # added one at a time so faces can join the clusters of earlier faces in the same batch
+            self.index.add([id], embedding)
+            entry = {"id": id, "cluster": cluster}
+            self._apply(entry)
+            entries.append(entry)
+            clusters.append(cluster)
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            self.index.remove(ids)
+            entries = [{"id": id, "cluster": None} for id in ids if id in self.clusters]
+            for entry in entries:
+                self._apply(entry)
+            self._log(entries)
+
+    def recluster(self, max_distance: float = 0.5, min_faces: int = 3) -> dict[str, int | None]:
+        """
+        Groups every face from scratch with DBSCAN and returns their clusters, replacing the previous ones.
+        Faces that aren't within `max_distance` of a face with at least `min_faces` such neighbors (including
+        itself) aren't in a cluster.
+        """
+
+        with self._lock:
+            ids, embeddings = self.index.items()
+            log.info(f"Re-clustering {len(ids)} faces in '{self.folder}'")
+            labels = dbscan(embeddings, max_distance, min_faces)
+            entries: list[dict[str, Any]] = [
+                {"id": id, "cluster": int(label) if label >= 0 else None} for id, label in zip(ids, labels)
+            ]
+            self.clusters = {}
+            self._next_cluster = 0
+            for entry in entries:
+                self._apply(entry)
+
+            self.folder.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.folder / "clusters.jsonl.tmp"
+            tmp_path.write_bytes(
+                b"".join(
+                    orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE)
+                    for entry in entries
+                    if entry["cluster"] is not None
+                )
+            )
+            tmp_path.replace(self.folder / "clusters.jsonl")
+        return {entry["id"]: entry["cluster"] for entry in entries}
+
+    def flush(self) -> None:
+        self.index.flush()
+
+    def _apply(self, entry: dict[str, Any]) -> None:
+        if entry["cluster"] is None:
+            self.clusters.pop(entry["id"], None)
+        else:
+            self.clusters[entry["id"]] = entry["cluster"]
+            self._next_cluster = max(self._next_cluster, entry["cluster"] + 1)
+
+    def _log(self, entries: list[dict[str, Any]]) -> None:
+        if not entries:
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with (self.folder / "clusters.jsonl").open("ab") as f:
+            f.write(b"".join(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in entries))
+
+
+def dbscan(embeddings: NDArray, max_distance: float, min_samples: int) -> NDArray:
+    """
+    Clusters normalized embeddings by cosine distance with DBSCAN, returning the cluster of each one or -1 if it's
+    noise. Clusters are numbered in order of their first embedding.
+
+    Neighbors are found by comparing every pair of embeddings a chunk of rows at a time, so memory use doesn't grow
+    with the square of the number of embeddings.
+    """
+
+    count = len(embeddings)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    min_similarity = 1 - max_distance
+    chunk_size = max(1, _PAIRS_PER_CHUNK // count)
+    chunks = [(i, min(i + chunk_size, count)) for i in range(0, count, chunk_size)]
+
+    neighbor_counts = np.concatenate(
+        [(embeddings[i:j] @ embeddings.T >= min_similarity).sum(axis=1) for i, j in chunks]
+    )
+    core = neighbor_counts >= min_samples
+    if not core.any():
+        return np.full(count, -1)
+    core_rows = np.flatnonzero(core)
+    core_embeddings = embeddings[core]
+
+    # core embeddings that are neighbors are in the same cluster, which is found with a union-find
+    parents = np.arange(count)
+    nearest_core = np.full(count, -1)
+    for i, j in chunks:
+        similarities = embeddings[i:j] @ core_embeddings.T
+        is_neighbor = similarities >= min_similarity
+        rows, cols = np.nonzero(is_neighbor[core[i:j]])
+        union(parents, np.flatnonzero(core[i:j])[rows] + i, core_rows[cols])
+        # embeddings that aren't core join the cluster of their most similar core neighbor
+        has_core = is_neighbor.any(axis=1)
+        nearest = core_rows[np.argmax(np.where(is_neighbor, similarities, -np.inf), axis=1)]
+        nearest_core[i:j] = np.where(has_core & ~core[i:j], nearest, -1)
+
+    roots = find_roots(parents, np.arange(count))
+    roots = np.where(core, roots, np.where(nearest_core >= 0, roots[np.maximum(nearest_core, 0)], -1))
+    labels = np.full(count, -1)
+    clustered = roots >= 0
+    _, first, inverse = np.unique(roots[clustered], return_index=True, return_inverse=True)
+    # renumbers clusters by their first embedding instead of their root
+    labels[clustered] = np.argsort(np.argsort(first))[inverse]
+    return labels
+
+
+def find_roots(parents: NDArray, nodes: NDArray) -> NDArray:
+    roots = parents[nodes]
+    while True:
+        next_roots = parents[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+
+def union(parents: NDArray, a: NDArray, b: NDArray) -> None:
+    """Merges the sets of each pair of nodes, with the smallest node of each set as its root."""
+
+    while len(a):
+        root_a, root_b = find_roots(parents, a), find_roots(parents, b)
+        unmerged = root_a != root_b
+        a, b, root_a, root_b = a[unmerged], b[unmerged], root_a[unmerged], root_b[unmerged]
+        np.minimum.at(parents, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        # compresses paths so later searches for roots are shorter
+        parents[:] = find_roots(parents, np.arange(len(parents)))
@@ -1,6 +1,7 @@
 import logging
 import os
 from pathlib import Path
+from typing import Literal
 
 import gunicorn
 import starlette
@@ -8,19 +9,40 @@ from pydantic import BaseSettings
 from rich.console import Console
 from rich.logging import RichHandler
 
-from .schemas import ModelType
+from .schemas import ModelType, PreloadModel
 
 
 class Settings(BaseSettings):
     cache_folder: str = "/cache"
     model_ttl: int = 0
+    model_memory_budget: int = 0
     host: str = "0.0.0.0"
     port: int = 3003
     workers: int = 1
     test_full: bool = False
     request_threads: int = os.cpu_count() or 4
+    inference_processes: int = 0
     model_inter_op_threads: int = 1
     model_intra_op_threads: int = 2
+    model_replicas: int = 1
+    quantize: list[ModelType] = []
+    max_batch_size: int = 1
+    max_batch_wait_ms: float = 5
+    face_batch_size: int = 32
+    text_cache_size: int = 1024
+    text_cache_ttl: int = 0
+    result_cache_size: int = 0
+    result_cache_persist: bool = False
+    decode_safety_factor: float = 2.0
+    max_concurrent_requests: int = 0
+    max_queued_requests: int = 1000
+    queue_timeout: float = 0
+    preload: list[PreloadModel] = []
+    index_embeddings: bool = False
+    index_dtype: Literal["float16", "float32"] = "float16"
+    index_partitions: int = 0
+    index_probes: int = 8
+    face_clustering: bool = False
 
     class Config:
         env_prefix = "MACHINE_LEARNING_"
@@ -42,6 +64,14 @@ def get_cache_dir(model_name: str, model_type: ModelType) -> Path:
     return Path(settings.cache_folder) / model_type.value / model_name.translate(_clean_name)
 
 
+def get_index_dir(model_name: str) -> Path:
+    return Path(settings.cache_folder) / "index" / model_name.translate(_clean_name)
+
+
+def get_clusters_dir(model_name: str) -> Path:
+    return Path(settings.cache_folder) / "clusters" / model_name.translate(_clean_name)
+
+
 LOG_LEVELS: dict[str, int] = {
     "critical": logging.ERROR,
     "error": logging.ERROR,
@@ -0,0 +1,276 @@
+import itertools
+import math
+import threading
+from pathlib import Path
+from typing import Any, Iterator
+
+import cv2
+import numpy as np
+import orjson
+
+from .clustering import find_roots, union
+from .index import NDArray, VectorIndex
+from .models.decode import DecodedImage, decode_cv2
+
+HASH_BITS = 64
+# images are shrunk to this size before the DCT, and the lowest 8x8 frequencies are kept
+_DCT_SIZE = 32
+_HASH_SIZE = 8
+# similarities are computed for this many candidate pairs at a time
+_PAIRS_PER_CHUNK = 2**16
+# substrings up to this long are looked up in a table with an entry for every key instead of by binary search
+_MAX_TABLE_BITS = 22
+# a candidate costs about this many lookups to generate and verify
+_CANDIDATE_COST = 4
+
+
+def perceptual_hash(image: bytes | DecodedImage) -> int:
+    """
+    Computes a 64-bit perceptual hash (pHash) of an image: whether each of the lowest frequencies of the image's
+    DCT is above their median. Resized, re-encoded and slightly edited copies of an image have hashes that differ
+    in only a few bits, which makes them cheap to compare by Hamming distance.
+    """
+
+    # the image only needs to be large enough to shrink it to the DCT size, so JPEGs are downscaled while decoding
+    bgr, _ = decode_cv2(image, max_size=_DCT_SIZE)
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (_DCT_SIZE, _DCT_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    frequencies = cv2.dct(small)[:_HASH_SIZE, :_HASH_SIZE].ravel()
+    # the first frequency is the image's average brightness, which would skew the median
+    bits = frequencies > np.median(frequencies[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(hashes: NDArray, other: NDArray | int) -> NDArray:
+    """Counts the bits that differ between 64-bit hashes."""
+
+    x = np.bitwise_xor(hashes, np.uint64(other))
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((x * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+
+class HashIndex:
+    """
+    Stores the perceptual hashes of images by ID, and finds pairs of similar hashes. The folder contains a log
+    of each ID's hash in `hashes.jsonl`.
+    """
+
+    def __init__(self, folder: Path) -> None:
+        self.folder = folder
+        self.ids: list[str | None] = []
+        self.rows: dict[str, int] = {}
+        self.hashes = np.zeros(0, dtype=np.uint64)
+        self._lock = threading.Lock()
+        hashes_path = folder / "hashes.jsonl"
+        if hashes_path.is_file():
+            with hashes_path.open("rb") as f:
+                for line in f:
+                    entry = orjson.loads(line)
+                    self._apply(entry["id"], entry["hash"])
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def add(self, ids: list[str], hashes: list[int]) -> None:
+        with self._lock:
+            for id, hash in zip(ids, hashes):
+                self._apply(id, hash)
+            self._log([{"id": id, "hash": hash} for id, hash in zip(ids, hashes)])
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            removed = [id for id in ids if id in self.rows]
+            for id in removed:
+                self._apply(id, None)
+            self._log([{"id": id, "hash": None} for id in removed])
+
+    def get(self, id: str) -> int | None:
+        row = self.rows.get(id)
+        return None if row is None else int(self.hashes[row])
+
+    def near(self, hash: int, max_distance: int) -> list[tuple[str, int]]:
+        """Returns the IDs and Hamming distances of the hashes within `max_distance` bits of a hash."""
+
+        with self._lock:
+            ids, hashes = list(self.ids), self.hashes[: len(self.ids)]
+        distances = hamming_distance(hashes, hash)
+        return [(ids[row], int(distances[row])) for row in np.flatnonzero(distances <= max_distance) if ids[row]]
+
+    def pairs(self, max_distance: int) -> tuple[list[str | None], NDArray, NDArray]:
+        """
+        Finds every pair of hashes within `max_distance` bits of each other without comparing every pair,
+        using multi-index hashing (see `_candidate_pairs`).
+
+        Returns:
+            The ID of each row, and the rows of each pair with the first row of a pair being the smaller.
+        """
+
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"Hamming distance must be between 0 and {HASH_BITS - 1}, got {max_distance}")
+        with self._lock:
+            ids, hashes = list(self.ids), self.hashes[: len(self.ids)]
+        rows = np.array([row for row, id in enumerate(ids) if id is not None], dtype=np.int64)
+
+        pairs = []
+        for a, b in _candidate_pairs(hashes[rows], max_distance):
+            close = hamming_distance(hashes[rows[a]], hashes[rows[b]]) <= max_distance
+            pairs.append(np.stack([rows[a[close]], rows[b[close]]], axis=1))
+
+        if not pairs:
+            return ids, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        # pairs that are close in several substrings are found once for each of them
+        unique_pairs = np.unique(np.concatenate(pairs), axis=0)
+        return ids, unique_pairs[:, 0], unique_pairs[:, 1]
+
+    def _apply(self, id: str, hash: int | None) -> None:
+        row = self.rows.get(id)
+        if hash is None:
+            if row is not None:
+                del self.rows[id]
+                self.ids[row] = None
+            return
+        if row is None:
+            row = self.rows[id] = len(self.ids)
+            self.ids.append(id)
+        if row >= len(self.hashes):
+            # grows geometrically so adding one hash at a time doesn't copy the array every time
+            hashes = np.zeros(max(1024, 2 * len(self.hashes)), dtype=np.uint64)
+            hashes[: len(self.hashes)] = self.hashes
+            self.hashes = hashes
+        self.hashes[row] = hash
+
+    def _log(self, entries: list[dict[str, Any]]) -> None:
+        if not entries:
+            return
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with (self.folder / "hashes.jsonl").open("ab") as f:
+            f.write(b"".join(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in entries))
+
+
+def _candidate_pairs(hashes: NDArray, max_distance: int) -> Iterator[tuple[NDArray, NDArray]]:
+    """
+    Yields the pairs of positions in `hashes` that may be within `max_distance` bits of each other, a chunk at a
+    time, with the first position of a pair being the smaller. Every pair that is within the distance is yielded at
+    least once.
+
+    The hashes are split into substrings, and each hash is looked up in a sorted table of each substring with every
+    key within `max_distance // substrings` bits of its own. Hashes that differ in at most `max_distance` bits must
+    be that close in at least one substring, so only hashes found by a lookup are candidates. Substrings of about
+    log2(len(hashes)) bits leave about one hash per key, so each lookup finds few candidates by chance.
+    """
+
+    substrings = _substring_count(len(hashes), max_distance)
+    radius = max_distance // substrings
+    shift = 0
+    for substring in range(substrings):
+        width = HASH_BITS // substrings + (substring < HASH_BITS % substrings)
+        keys = (hashes >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+        shift += width
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        if width <= _MAX_TABLE_BITS:
+            key_counts = np.bincount(keys.astype(np.int64), minlength=1 << width).astype(np.int32)
+            key_starts = np.cumsum(key_counts, dtype=np.int32) - key_counts
+        for distance in range(radius + 1):
+            for bits in itertools.combinations(range(width), distance):
+                probes = keys ^ np.uint64(sum(1 << bit for bit in bits))
+                if width <= _MAX_TABLE_BITS:
+                    probes = probes.astype(np.int64)
+                    found = np.flatnonzero(key_counts[probes])
+                    starts, counts = key_starts[probes[found]], key_counts[probes[found]]
+                else:
+                    starts = np.searchsorted(sorted_keys, probes, side="left")
+                    counts = np.searchsorted(sorted_keys, probes, side="right") - starts
+                    found = np.flatnonzero(counts)
+                    starts, counts = starts[found], counts[found]
+                # most lookups find nothing, so only the hashes that found something are paired with what they found
+                queries = np.repeat(found, counts)
+                offsets = np.arange(len(queries)) - np.repeat(np.cumsum(counts) - counts, counts)
+                matches = order[np.repeat(starts, counts) + offsets]
+                # both hashes of a pair find each other, so only the lookup of the first one is kept
+                keep = queries < matches
+                yield queries[keep], matches[keep]
+
+
+def _substring_count(count: int, max_distance: int) -> int:
+    """
+    Returns the number of substrings to split `count` hashes into for `_candidate_pairs` with the least expected
+    work per hash. Fewer, longer substrings have fewer hashes per key by chance, but need more lookups to cover the
+    keys within the distance.
+    """
+
+    def cost(substrings: int) -> float:
+        width = HASH_BITS // substrings
+        lookups = sum(math.comb(width, distance) for distance in range(max_distance // substrings + 1))
+        lookup_cost = 1 if width <= _MAX_TABLE_BITS else math.log2(max(count, 2))
+        return substrings * lookups * (lookup_cost + _CANDIDATE_COST * count / 2**width)
+
+    return min(range(1, HASH_BITS + 1), key=cost)
+
+
+def find_duplicates(
+    hashes: HashIndex, index: VectorIndex, id: str, max_distance: int, min_similarity: float
+) -> list[dict[str, Any]]:
+    """
+    Finds near-duplicates of an image: images whose hashes are within `max_distance` bits of its hash, and whose
+    embeddings have a cosine similarity of at least `min_similarity` with its embedding. Raises a `KeyError` if the
+    image isn't in both indexes.
+    """
+
+    hash = hashes.get(id)
+    if hash is None or id not in index.rows:
+        raise KeyError(id)
+    candidates = [(other, distance) for other, distance in hashes.near(hash, max_distance) if other in index.rows]
+    candidates = [(other, distance) for other, distance in candidates if other != id]
+    if not candidates:
+        return []
+    embeddings = index.get([id] + [other for other, _ in candidates])
+    similarities = embeddings[1:] @ embeddings[0]
+    duplicates = [
+        {"id": other, "distance": distance, "similarity": float(similarity)}
+        for (other, distance), similarity in zip(candidates, similarities)
+        if similarity >= min_similarity
+    ]
+    return sorted(duplicates, key=lambda duplicate: -duplicate["similarity"])
+
+
+def find_all_duplicates(
+    hashes: HashIndex, index: VectorIndex, max_distance: int, min_similarity: float
+) -> list[list[str]]:
+    """
+    Groups every image with its near-duplicates (see `find_duplicates`). Images are in the same group if they're
+    linked by a chain of near-duplicates, such as the shots of a burst. Only groups of at least two images are
+    returned.
+    """
+
+    ids, a, b = hashes.pairs(max_distance)
+    indexed = np.array([id is not None and id in index.rows for id in ids], dtype=bool)
+    keep = indexed[a] & indexed[b]
+    a, b = a[keep], b[keep]
+    if len(a) == 0:
+        return []
+
+    rows = np.unique(np.concatenate([a, b]))
+    embeddings = index.get([ids[row] for row in rows])  # type: ignore[misc]
+    a_positions, b_positions = np.searchsorted(rows, a), np.searchsorted(rows, b)
+    similar = np.concatenate(
+        [
+            np.einsum(
+                "ij,ij->i",
+                embeddings[a_positions[i : i + _PAIRS_PER_CHUNK]],
+                embeddings[b_positions[i : i + _PAIRS_PER_CHUNK]],
+            )
+            >= min_similarity
+            for i in range(0, len(a), _PAIRS_PER_CHUNK)
+        ]
+    )
+
+    parents = np.arange(len(rows))
+    union(parents, a_positions[similar], b_positions[similar])
+    roots = find_roots(parents, np.arange(len(rows)))
+    groups: dict[int, list[str]] = {}
+    for row, root in zip(rows.tolist(), roots.tolist()):
+        groups.setdefault(root, []).append(ids[row])  # type: ignore[arg-type]
+    return [group for group in groups.values() if len(group) > 1]
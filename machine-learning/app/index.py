@@ -0,0 +1,358 @@
+import json
+import threading
+from pathlib import Path
+from typing import Any, Literal
+
+import numpy as np
+import orjson
+
+from .config import log
+
+NDArray = np.ndarray[int, np.dtype[Any]]
+
+_CHUNK_SIZE = 2**12
+# partitions are only trained once there are enough vectors to give each of them this many on average
+_MIN_PARTITION_SIZE = 32
+_KMEANS_ITERATIONS = 10
+_KMEANS_SAMPLES_PER_PARTITION = 64
+
+
+class VectorIndex:
+    """
+    Stores normalized embeddings in an append-only matrix that's memory-mapped from disk, and finds the most similar
+    ones to a query by cosine similarity.
+
+    Searches compare the query with every vector unless partitions are enabled. Partitions group similar vectors
+    with k-means (an IVF index), so a search only compares the query with the vectors in its nearest partitions.
+    This is much faster for millions of vectors, but can miss some of the most similar ones. Partitions are trained
+    in a background thread once there are enough vectors, and searches compare the query with every vector until
+    the first training finishes.
+
+    The folder contains `meta.json` with the dimensions and dtype of the vectors, `vectors.bin` with the matrix,
+    `ids.jsonl` with a log of which ID each row belongs to, and `partitions.npz` with the partitions if trained.
+    """
+
+    def __init__(
+        self,
+        folder: Path,
+        dtype: Literal["float16", "float32"] = "float16",
+        partitions: int = 0,
+        probes: int = 8,
+    ) -> None:
+        """
+        Args:
+            folder: Folder to store the index in. It's created when the first vector is added.
+            dtype: Data type to store vectors as, unless the index already exists. Defaults to "float16".
+            partitions: Number of partitions to group vectors into. Searches compare the query with every vector
+                if 0. Defaults to 0.
+            probes: Number of partitions nearest to the query to search. Defaults to 8.
+        """
+
+        self.folder = folder
+        self.dtype = np.dtype(dtype)
+        self.partitions = partitions
+        self.probes = probes
+        self.dim = 0
+        self.ids: list[str | None] = []
+        self.rows: dict[str, int] = {}
+        self._matrix: np.memmap[Any, np.dtype[Any]] | None = None
+        self._valid = np.zeros(0, dtype=bool)
+        self._centroids: NDArray | None = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        # rows of each partition, with rows added since the last training kept separately so they can be appended
+        self._partition_rows: list[NDArray] = []
+        self._pending_rows: list[list[int]] = []
+        self._trained_count = 0
+        self._lock = threading.Lock()
+        # held while training, so only one training runs at a time
+        self._train_lock = threading.Lock()
+        self._training: threading.Thread | None = None
+        if (folder / "meta.json").is_file():
+            self._open()
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @property
+    def count(self) -> int:
+        """Number of rows in the matrix, including those of removed vectors."""
+        return len(self.ids)
+
+    def add(self, ids: list[str], vectors: NDArray) -> None:
+        """Adds vectors with the given IDs, replacing the vectors of IDs that are already in the index."""
+
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+        with self._lock:
+            if not self.dim:
+                self._create(vectors.shape[1])
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected vectors with {self.dim} dimensions, got {vectors.shape[1]}")
+
+            rows, new_entries = [], []
+            for id in ids:
+                row = self.rows.get(id)
+                if row is None:
+                    row = self.rows[id] = self.count
+                    self.ids.append(id)
+                    new_entries.append({"id": id, "row": row})
+                rows.append(row)
+            self._reserve(self.count)
+            assert self._matrix is not None
+            self._matrix[rows] = vectors
+            self._valid[rows] = True
+            if self._centroids is not None:
+                self._assign(np.array(rows), vectors)
+            self._log(new_entries)
+
+    def remove(self, ids: list[str]) -> None:
+        with self._lock:
+            entries = []
+            for id in ids:
+                row = self.rows.pop(id, None)
+                if row is not None:
+                    self.ids[row] = None
+                    self._valid[row] = False
+                    entries.append({"id": id, "row": None})
+            self._log(entries)
+
+    def search(self, query: NDArray, k: int) -> list[tuple[str, float]]:
+        """Returns the IDs and cosine similarities of up to `k` vectors most similar to the query."""
+
+        query = np.asarray(query, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if self._matrix is None or k <= 0:
+            return []
+        if query.shape[0] != self.dim:
+            raise ValueError(f"Expected a query with {self.dim} dimensions, got {query.shape[0]}")
+
+        if self.partitions > 0 and self._needs_training():
+            self._train_in_background()
+        with self._lock:
+            # the matrix is only replaced when it grows, so searching the current one outside the lock is safe
+            matrix, count, valid, ids = self._matrix, self.count, self._valid, self.ids
+            candidates = self._candidates(query) if self._centroids is not None else None
+
+        if candidates is None:
+            scores = _nearest(matrix[:count], query[np.newaxis], reduce=False)[:, 0]
+            scores[~valid[:count]] = -np.inf
+            rows = np.arange(count)
+        else:
+            rows = candidates[valid[candidates]]
+            scores = matrix[rows].astype(np.float32, copy=False) @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        results = []
+        for i in top[np.argsort(-scores[top], kind="stable")]:
+            id = ids[rows[i]]
+            # removed vectors score -inf, or have no ID if they were removed during the search
+            if id is not None and np.isfinite(scores[i]):
+                results.append((id, float(scores[i])))
+        return results
+
+    def train(self) -> None:
+        """Groups the vectors into partitions with k-means, replacing any previous partitions."""
+
+        with self._train_lock:
+            self._train()
+
+    def _train_in_background(self) -> None:
+        """
+        Starts training in a background thread unless it's already training, so searches don't wait for it.
+        Searches keep using the current partitions, if any, until it finishes.
+        """
+
+        if not self._train_lock.acquire(blocking=False):
+            return
+        # another search may have started and finished training since this one checked
+        if not self._needs_training():
+            self._train_lock.release()
+            return
+
+        def train() -> None:
+            try:
+                self._train()
+            except Exception:
+                log.exception(f"Failed to train partitions in '{self.folder}'")
+            finally:
+                self._train_lock.release()
+
+        self._training = threading.Thread(target=train, name=f"train-{self.folder.name}", daemon=True)
+        self._training.start()
+
+    def _train(self) -> None:
+        with self._lock:
+            matrix, count, valid = self._matrix, self.count, self._valid
+        if matrix is None or self.partitions <= 0:
+            return
+
+        log.info(f"Training {self.partitions} partitions for {count} vectors in '{self.folder}'")
+        rows = np.flatnonzero(valid[:count])
+        if len(rows) == 0:
+            return
+        rng = np.random.default_rng(0)
+        sample_size = min(len(rows), self.partitions * _KMEANS_SAMPLES_PER_PARTITION)
+        sample = matrix[np.sort(rng.choice(rows, sample_size, replace=False))].astype(np.float32, copy=False)
+        centroids = sample[rng.choice(len(sample), min(self.partitions, len(sample)), replace=False)]
+        # spherical k-means, as vectors are compared by cosine similarity
+        for _ in range(_KMEANS_ITERATIONS):
+            labels = _nearest(sample, centroids)
+            order = np.argsort(labels, kind="stable")
+            present, starts = np.unique(labels[order], return_index=True)
+            # partitions that lost all of their vectors keep their centroid
+            centroids[present] = np.add.reduceat(sample[order], starts, axis=0)
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True).clip(min=1e-12)
+
+        assignments = _nearest(matrix[:count], centroids)
+        with self._lock:
+            self._set_partitions(centroids, assignments, count)
+            # rows added while training are assigned to the new partitions
+            if self.count > count:
+                new_rows = np.arange(count, self.count)
+                self._assign(new_rows, np.asarray(self._matrix[new_rows], dtype=np.float32))  # type: ignore[index]
+        np.savez(self.folder / "partitions.tmp.npz", centroids=centroids, assignments=assignments)
+        (self.folder / "partitions.tmp.npz").replace(self.folder / "partitions.npz")
+
+    def items(self) -> tuple[list[str], NDArray]:
+        """Returns the IDs in the index and their vectors as float32."""
+
+        with self._lock:
+            if self._matrix is None:
+                return [], np.zeros((0, self.dim), dtype=np.float32)
+            rows = np.flatnonzero(self._valid[: self.count])
+            return [self.ids[row] for row in rows], np.asarray(self._matrix[rows], dtype=np.float32)  # type: ignore
+
+    def get(self, ids: list[str]) -> NDArray:
+        """Returns the vectors of the given IDs as float32, raising a `KeyError` if an ID isn't in the index."""
+
+        with self._lock:
+            rows = [self.rows[id] for id in ids]
+            if self._matrix is None:
+                return np.zeros((0, self.dim), dtype=np.float32)
+            return np.asarray(self._matrix[rows], dtype=np.float32)
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._matrix is not None:
+                self._matrix.flush()
+
+    def _needs_training(self) -> bool:
+        # retrained whenever the index has doubled in size, as the partitions may no longer fit the vectors
+        count = len(self)
+        return count >= self.partitions * _MIN_PARTITION_SIZE and count >= 2 * self._trained_count
+
+    def _candidates(self, query: NDArray) -> NDArray:
+        assert self._centroids is not None
+        probes = np.argsort(-(self._centroids @ query))[: self.probes]
+        rows = [self._partition_rows[p] for p in probes]
+        rows += [np.array(self._pending_rows[p], dtype=np.int64) for p in probes]
+        # replaced vectors that moved to another partition are in both
+        return np.unique(np.concatenate(rows))
+
+    def _assign(self, rows: NDArray, vectors: NDArray) -> None:
+        assert self._centroids is not None
+        labels = _nearest(vectors, self._centroids)
+        if len(self._assignments) < self.count:
+            # rows that aren't in a partition yet are assigned -1
+            assignments = np.full(max(self.count, 2 * len(self._assignments)), -1, dtype=np.int32)
+            assignments[: len(self._assignments)] = self._assignments
+            self._assignments = assignments
+        for row, label in zip(rows.tolist(), labels.tolist()):
+            # replaced vectors stay in their old partition as well, which only costs a redundant comparison
+            if self._assignments[row] != label:
+                self._pending_rows[label].append(row)
+                self._assignments[row] = label
+
+    def _set_partitions(self, centroids: NDArray, assignments: NDArray, count: int) -> None:
+        self._centroids = centroids
+        self._assignments = assignments.copy()
+        self._trained_count = count
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.cumsum(np.bincount(assignments, minlength=len(centroids)))
+        self._partition_rows = np.split(order, bounds[:-1])
+        self._pending_rows = [[] for _ in range(len(centroids))]
+
+    def _create(self, dim: int) -> None:
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.dim = dim
+        (self.folder / "meta.json").write_text(json.dumps({"dim": dim, "dtype": self.dtype.name}))
+        (self.folder / "vectors.bin").touch()
+        self._map(0)
+
+    def _open(self) -> None:
+        meta = json.loads((self.folder / "meta.json").read_text())
+        self.dim = meta["dim"]
+        if meta["dtype"] != self.dtype.name:
+            log.warning(f"Index in '{self.folder}' stores vectors as {meta['dtype']} instead of {self.dtype.name}")
+            self.dtype = np.dtype(meta["dtype"])
+
+        ids_path = self.folder / "ids.jsonl"
+        if ids_path.is_file():
+            with ids_path.open("rb") as f:
+                for line in f:
+                    entry = orjson.loads(line)
+                    if entry["row"] is None:
+                        row = self.rows.pop(entry["id"], None)
+                        if row is not None:
+                            self.ids[row] = None
+                        continue
+                    self.ids.extend([None] * (entry["row"] + 1 - len(self.ids)))
+                    self.ids[entry["row"]] = entry["id"]
+                    self.rows[entry["id"]] = entry["row"]
+
+        self._map((self.folder / "vectors.bin").stat().st_size // (self.dim * self.dtype.itemsize))
+        self._reserve(self.count)
+        self._valid[: self.count] = [id is not None for id in self.ids]
+
+        partitions_path = self.folder / "partitions.npz"
+        if self.partitions > 0 and partitions_path.is_file():
+            with np.load(partitions_path) as partitions:
+                centroids, assignments = partitions["centroids"], partitions["assignments"]
+            count = min(len(assignments), self.count)
+            if len(centroids) == self.partitions and centroids.shape[1] == self.dim:
+                self._set_partitions(centroids, assignments[:count], count)
+                if self.count > count:
+                    new_rows = np.arange(count, self.count)
+                    self._assign(new_rows, np.asarray(self._matrix[new_rows], dtype=np.float32))  # type: ignore[index]
+        log.info(f"Opened index in '{self.folder}' with {len(self)} vectors")
+
+    def _reserve(self, count: int) -> None:
+        capacity = 0 if self._matrix is None else self._matrix.shape[0]
+        if count > capacity:
+            # grows geometrically so appending one vector at a time doesn't remap the file every time
+            self._map(max(count, 2 * capacity, 1024))
+
+    def _map(self, capacity: int) -> None:
+        path = self.folder / "vectors.bin"
+        size = capacity * self.dim * self.dtype.itemsize
+        if path.stat().st_size < size:
+            with path.open("r+b") as f:
+                f.truncate(size)
+        self._matrix = np.memmap(path, dtype=self.dtype, mode="r+", shape=(capacity, self.dim)) if capacity else None
+        if capacity == 0:
+            return
+        valid = np.zeros(capacity, dtype=bool)
+        valid[: len(self._valid)] = self._valid[:capacity]
+        self._valid = valid
+
+    def _log(self, entries: list[dict[str, Any]]) -> None:
+        if not entries:
+            return
+        with (self.folder / "ids.jsonl").open("ab") as f:
+            f.write(b"".join(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE) for entry in entries))
+
+
+def _nearest(vectors: NDArray, centroids: NDArray, reduce: bool = True) -> NDArray:
+    """
+    Returns the index of the most similar centroid to each vector, or the similarities to every centroid if not
+    `reduce`. Vectors are compared a chunk at a time, so float16 vectors are only converted to float32 in chunks.
+    """
+
+    chunks = []
+    for i in range(0, len(vectors), _CHUNK_SIZE):
+        similarities = vectors[i : i + _CHUNK_SIZE].astype(np.float32, copy=False) @ centroids.T
+        chunks.append(np.argmax(similarities, axis=1).astype(np.int32) if reduce else similarities)
+    if not chunks:
+        return np.zeros(0 if reduce else (0, len(centroids)), dtype=np.int32 if reduce else np.float32)
+    return np.concatenate(chunks)
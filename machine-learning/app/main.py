@@ -1,22 +1,44 @@
 import asyncio
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Any
+from contextlib import ExitStack
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Sequence
 from zipfile import BadZipFile
 
+import numpy as np
 import orjson
-from fastapi import FastAPI, Form, HTTPException, UploadFile
-from fastapi.responses import ORJSONResponse
+import pydantic
+from fastapi import FastAPI, File, Form, Header, HTTPException, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
 from onnxruntime.capi.onnxruntime_pybind11_state import InvalidProtobuf, NoSuchFile  # type: ignore
 from starlette.formparsers import MultiPartParser
 
 from app.models.base import InferenceModel
 
-from .config import log, settings
-from .models.cache import ModelCache
+from . import metrics
+from .admission import AdmissionController, Overloaded
+from .batching import MicroBatcher
+from .clustering import FaceClusters
+from .config import get_clusters_dir, get_index_dir, log, settings
+from .duplicates import HashIndex, find_all_duplicates, find_duplicates, perceptual_hash
+from .index import VectorIndex
+from .models.cache import LRUCache, ModelCache, ResultCache, model_key
+from .models.decode import DecodedImage, decode_shared
+from .process_pool import ProcessPool
+from .responses import JSONResponse, dumps_json, negotiate
 from .schemas import (
+    DuplicatesRequest,
+    FaceClusterRequest,
+    FaceReclusterRequest,
+    IndexRemoveRequest,
+    IndexRequest,
+    InferenceTask,
     MessageResponse,
     ModelType,
+    PreloadModel,
+    Priority,
     TextResponse,
 )
 
@@ -25,22 +47,156 @@ app = FastAPI()
 
 
 def init_state() -> None:
-    app.state.model_cache = ModelCache(ttl=settings.model_ttl, revalidate=settings.model_ttl > 0)
+    max_size = settings.model_memory_budget * 2**20 if settings.model_memory_budget > 0 else None
+    app.state.model_cache = ModelCache(ttl=settings.model_ttl, revalidate=settings.model_ttl > 0, max_size=max_size)
     log.info(
         (
             "Created in-memory cache with unloading "
-            f"{f'after {settings.model_ttl}s of inactivity' if settings.model_ttl > 0 else 'disabled'}."
+            f"{f'after {settings.model_ttl}s of inactivity' if settings.model_ttl > 0 else 'disabled'}"
+            f"{f' and a memory budget of {settings.model_memory_budget} MiB' if max_size is not None else ''}."
         )
     )
+    if settings.text_cache_size > 0:
+        ttl = settings.text_cache_ttl if settings.text_cache_ttl > 0 else None
+        app.state.text_cache = LRUCache(settings.text_cache_size, ttl=ttl)
+        log.info(f"Caching up to {settings.text_cache_size} text embeddings.")
+    else:
+        app.state.text_cache = None
+    if settings.result_cache_size > 0:
+        folder = Path(settings.cache_folder) / "results" if settings.result_cache_persist else None
+        app.state.result_cache = ResultCache(settings.result_cache_size * 2**20, folder=folder)
+        log.info(
+            f"Caching up to {settings.result_cache_size} MiB of results in memory"
+            f"{f' and persisting them to {folder}' if folder is not None else ''}."
+        )
+    else:
+        app.state.result_cache = None
     # asyncio is a huge bottleneck for performance, so we use a thread pool to run blocking code
     app.state.thread_pool = ThreadPoolExecutor(settings.request_threads) if settings.request_threads > 0 else None
     app.state.locks = {model_type: threading.Lock() for model_type in ModelType}
     log.info(f"Initialized request thread pool with {settings.request_threads} threads.")
+    if settings.inference_processes > 0:
+        app.state.process_pool = ProcessPool(settings.inference_processes, preload=settings.preload)
+        log.info(f"Running inference in {settings.inference_processes} worker processes.")
+    else:
+        app.state.process_pool = None
+    if settings.max_batch_size > 1:
+        app.state.batcher = MicroBatcher(settings.max_batch_size, settings.max_batch_wait_ms, app.state.thread_pool)
+        log.info(
+            f"Batching up to {settings.max_batch_size} requests per model with a {settings.max_batch_wait_ms}ms window."
+        )
+    else:
+        app.state.batcher = None
+    if settings.max_concurrent_requests > 0:
+        timeout = settings.queue_timeout if settings.queue_timeout > 0 else None
+        app.state.admission = AdmissionController(
+            settings.max_concurrent_requests, settings.max_queued_requests, timeout=timeout
+        )
+        log.info(
+            f"Running up to {settings.max_concurrent_requests} requests at a time "
+            f"with up to {settings.max_queued_requests} queued."
+        )
+    else:
+        app.state.admission = None
+    app.state.index_lock = threading.Lock()
+    if settings.index_embeddings:
+        app.state.indexes = {}
+        app.state.hash_indexes = {}
+        log.info(
+            f"Indexing CLIP embeddings as {settings.index_dtype}"
+            f"{f' in {settings.index_partitions} partitions' if settings.index_partitions > 0 else ''}."
+        )
+    else:
+        app.state.indexes = None
+        app.state.hash_indexes = None
+    if settings.face_clustering:
+        app.state.face_clusters = {}
+        log.info("Clustering faces.")
+    else:
+        app.state.face_clusters = None
+    app.state.ready = not settings.preload
+    metrics.queued_requests.set_function(collect_queued_requests)
+    metrics.rejected_requests_total.set_function(collect_rejected_requests)
+    metrics.thread_pool_queue_depth.set_function(collect_queue_depth)
+    metrics.loaded_models.set_function(collect_loaded_models)
+    metrics.cache_hits_total.set_function(lambda: collect_cache_stats("hits"))
+    metrics.cache_misses_total.set_function(lambda: collect_cache_stats("misses"))
+
+
+def collect_queue_depth() -> dict[tuple[str, ...], float]:
+    thread_pool: ThreadPoolExecutor | None = app.state.thread_pool
+    return {(): thread_pool._work_queue.qsize() if thread_pool is not None else 0}
+
+
+def collect_queued_requests() -> dict[tuple[str, ...], float]:
+    admission: AdmissionController | None = app.state.admission
+    if admission is None:
+        return {}
+    return {(priority.name.lower(),): admission.queued(priority) for priority in Priority}
+
+
+def collect_rejected_requests() -> dict[tuple[str, ...], float]:
+    admission: AdmissionController | None = app.state.admission
+    if admission is None:
+        return {}
+    return {(reason,): count for reason, count in admission.rejected.items()}
+
+
+def collect_loaded_models() -> dict[tuple[str, ...], float]:
+    return {(): sum(model.loaded for model in app.state.model_cache.cache._cache.values())}
+
+
+def collect_cache_stats(stat: str) -> dict[tuple[str, ...], float]:
+    caches = {"model": app.state.model_cache, "text": app.state.text_cache, "result": app.state.result_cache}
+    return {(name,): getattr(cache, stat) for name, cache in caches.items() if cache is not None}
 
 
 @app.on_event("startup")
 async def startup_event() -> None:
     init_state()
+    # preloading can take longer than the worker timeout, so it runs in the background while /ready fails
+    if settings.preload and app.state.process_pool is None:
+        app.state.preload_task = asyncio.create_task(preload_models(settings.preload))
+    elif settings.preload:
+        # worker processes preload models themselves when they start
+        app.state.preload_task = asyncio.create_task(start_workers(app.state.process_pool))
+    else:
+        app.state.ready = True
+
+
+@app.on_event("shutdown")
+async def shutdown_event() -> None:
+    if app.state.process_pool is not None:
+        app.state.process_pool.shutdown()
+    if app.state.indexes is not None:
+        for index in app.state.indexes.values():
+            index.flush()
+    if app.state.face_clusters is not None:
+        for clusters in app.state.face_clusters.values():
+            clusters.flush()
+
+
+async def preload_models(models: list[PreloadModel]) -> None:
+    for entry in models:
+        try:
+            model = await app.state.model_cache.get(entry.model_name, entry.model_type, **entry.options)
+            with model.in_use():
+                await run_blocking((await load(model)).warmup)
+            log.info(f"Preloaded {entry.model_type.replace('-', ' ')} model '{entry.model_name}'")
+        except Exception:
+            log.exception(f"Failed to preload {entry.model_type.replace('-', ' ')} model '{entry.model_name}'")
+    app.state.ready = True
+    log.info("Finished preloading models.")
+
+
+async def start_workers(process_pool: ProcessPool) -> None:
+    try:
+        await process_pool.warmup()
+    except Exception:
+        log.exception("Failed to start worker processes")
+        return
+    app.state.ready = True
+    log.info("Finished preloading models.")
 
 
 @app.get("/", response_model=MessageResponse)
@@ -53,6 +209,19 @@ def ping() -> str:
     return "pong"
 
 
+@app.get("/ready", response_model=TextResponse)
+def ready() -> str:
+    if not app.state.ready:
+        raise HTTPException(503, "Models are still being preloaded")
+    return "ready"
+
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    # the content type already has a charset, which would be added again if it was given as the media type
+    return Response(metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
 @app.post("/predict")
 async def predict(
     model_name: str = Form(alias="modelName"),
@@ -60,29 +229,498 @@ async def predict(
     options: str = Form(default="{}"),
     text: str | None = Form(default=None),
     image: UploadFile | None = None,
+    accept: str | None = Header(default=None),
+    priority: str | None = Header(default=None, alias="x-priority"),
+) -> Any:
+    with metrics.track_request(model_name, model_type.value):
+        if image is not None:
+            with metrics.time_stage(model_name, model_type.value, "read"):
+                inputs: str | bytes = await image.read()
+        elif text is not None:
+            inputs = text
+        else:
+            raise HTTPException(400, "Either image or text must be provided")
+        return await _predict(
+            model_name, model_type, parse_options(options), inputs, accept, parse_priority(priority, inputs)
+        )
+
+
+@app.post("/predict/raw")
+async def predict_raw(request: Request) -> Any:
+    """
+    Same as `/predict`, but takes the image as the raw request body instead of a multipart form,
+    which skips parsing the form and spooling large uploads to disk. The body is read as text if its
+    content type is `text/plain`. The other fields are passed as the `modelName`, `modelType` and `options`
+    query parameters, or as the `X-Model-Name`, `X-Model-Type` and `X-Options` headers.
+    """
+
+    model_name = get_raw_param(request, "modelName", "x-model-name")
+    try:
+        model_type = ModelType(get_raw_param(request, "modelType", "x-model-type"))
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+    options = get_raw_param(request, "options", "x-options", "{}")
+
+    with metrics.track_request(model_name, model_type.value):
+        with metrics.time_stage(model_name, model_type.value, "read"):
+            # a body received in a single chunk is returned as is, so this is the only copy of the image
+            body = await request.body()
+        if not body:
+            raise HTTPException(400, "Either image or text must be provided")
+        inputs: str | bytes = body
+        if request.headers.get("content-type", "").startswith("text/plain"):
+            try:
+                inputs = body.decode()
+            except UnicodeDecodeError:
+                raise HTTPException(400, "Text must be UTF-8 encoded")
+        return await _predict(
+            model_name,
+            model_type,
+            parse_options(options),
+            inputs,
+            request.headers.get("accept"),
+            parse_priority(request.headers.get("x-priority"), inputs),
+        )
+
+
+def get_raw_param(request: Request, query_name: str, header_name: str, default: str | None = None) -> str:
+    value = request.query_params.get(query_name, request.headers.get(header_name, default))
+    if value is None:
+        raise HTTPException(422, f"Either the '{query_name}' query parameter or '{header_name}' header is required")
+    return value
+
+
+async def _predict(
+    model_name: str,
+    model_type: ModelType,
+    kwargs: dict[str, Any],
+    inputs: str | bytes,
+    accept: str | None = None,
+    priority: Priority = Priority.NORMAL,
 ) -> Any:
-    if image is not None:
-        inputs: str | bytes = await image.read()
-    elif text is not None:
-        inputs = text
+    serialize = negotiate(accept)
+    index_id = pop_index_id(model_type, kwargs, inputs)
+    result_key = None
+    # only JSON responses are cached, as they're the only ones served from the cache
+    # results are recomputed when they're indexed, as the embedding isn't kept in a usable form
+    cacheable = index_id is None and serialize is JSONResponse
+    if isinstance(inputs, bytes) and app.state.result_cache is not None and cacheable:
+        result_key = await run_blocking(ResultCache.key, inputs, model_name, model_type, kwargs)
+        cached = await run_blocking(app.state.result_cache.get, result_key)
+        if cached is not None:
+            return Response(cached, media_type="application/json")
+
+    model = await app.state.model_cache.get(model_name, model_type, **kwargs)
+    with model.in_use():
+        model = await prepare(model, kwargs)
+        # the image is decoded once for both the model and its perceptual hash, unless a worker process decodes it
+        model_inputs: Any = inputs
+        if index_id is not None and app.state.process_pool is None:
+            model_inputs = await run_blocking(decode_shared, inputs, [model.decode_size(**kwargs)])
+        outputs = await run(model, model_inputs, priority, kwargs)
+    if index_id is not None:
+        await index_image(model_name, index_id, model_inputs, outputs)
+    with metrics.time_stage(model_name, model_type.value, "serialize"):
+        response = serialize(outputs)
+    if result_key is not None:
+        await run_blocking(app.state.result_cache.set, result_key, response.body)
+    return response
+
+
+@app.post("/predict/multi")
+async def predict_multi(
+    tasks: str = Form(),
+    image: UploadFile = File(),
+    accept: str | None = Header(default=None),
+    priority: str | None = Header(default=None, alias="x-priority"),
+) -> Any:
+    """
+    Runs several models on one image, e.g. CLIP, image classification and facial recognition for a new asset.
+    The image is uploaded and decoded once for all of them. `tasks` is a JSON list of objects with the
+    `modelName`, `modelType` and `options` of each model. The response is a list with the `modelName`, `modelType`
+    and either the `result` or `error` of each task, in the same order.
+    """
+
+    task_list = parse_tasks(tasks)
+    data = await image.read()
+    index_ids = [pop_index_id(task.model_type, task.options, data) for task in task_list]
+    parsed_priority = parse_priority(priority, data)
+
+    with ExitStack() as stack:
+
+        async def _load(task: InferenceTask) -> InferenceModel:
+            model = await app.state.model_cache.get(task.model_name, task.model_type, **task.options)
+            stack.enter_context(model.in_use())
+            return await prepare(model, task.options)
+
+        # a task whose model can't be found or loaded fails on its own, like one whose model fails to run
+        models = await asyncio.gather(*(_load(task) for task in task_list), return_exceptions=True)
+        sizes = [
+            model.decode_size(**task.options)
+            for model, task in zip(models, task_list)
+            if not isinstance(model, BaseException)
+        ]
+        # worker processes decode images themselves
+        inputs: Any = data
+        if app.state.process_pool is None and sizes:
+            inputs = await run_blocking(decode_shared, data, sizes)
+
+        async def _run(
+            task: InferenceTask, model: InferenceModel | BaseException, index_id: str | None
+        ) -> dict[str, Any]:
+            output: dict[str, Any] = {"modelName": task.model_name, "modelType": task.model_type}
+            try:
+                if isinstance(model, BaseException):
+                    raise model
+                with metrics.track_request(task.model_name, task.model_type.value):
+                    output["result"] = await run(model, inputs, parsed_priority, task.options)
+                if index_id is not None:
+                    await index_image(task.model_name, index_id, inputs, output["result"])
+            except Exception as e:
+                log.debug(f"Failed to run {task.model_type.replace('-', ' ')} model '{task.model_name}': {e}")
+                output["error"] = str(e) or e.__class__.__name__
+            return output
+
+        outputs = await asyncio.gather(*(_run(*args) for args in zip(task_list, models, index_ids)))
+    return negotiate(accept)(outputs)
+
+
+@app.post("/search")
+async def search(
+    model_name: str = Form(alias="modelName"),
+    text: str = Form(),
+    k: int = Form(default=100),
+    options: str = Form(default="{}"),
+) -> Any:
+    """
+    Finds the IDs of the indexed images most similar to a text query, as a list of objects with the `id` and
+    cosine similarity `score` of each image, most similar first. Images are indexed with the `indexId` option
+    of CLIP predictions or with `/index`.
+    """
+
+    index = get_index(model_name)
+    kwargs = parse_options(options)
+    with metrics.track_request(model_name, ModelType.CLIP.value):
+        model = await app.state.model_cache.get(model_name, ModelType.CLIP, **kwargs)
+        with model.in_use():
+            model = await prepare(model, kwargs)
+            embedding = await run(model, text, Priority.HIGH, kwargs)
+        with metrics.time_stage(model_name, ModelType.CLIP.value, "search"):
+            try:
+                results = await run_blocking(index.search, np.asarray(embedding), k)
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+    return JSONResponse([{"id": id, "score": score} for id, score in results])
+
+
+@app.post("/index", response_model=MessageResponse)
+async def add_to_index(request: IndexRequest) -> dict[str, str]:
+    """Adds embeddings computed elsewhere to the index of a CLIP model, replacing those of existing IDs."""
+
+    if len(request.ids) != len(request.embeddings):
+        raise HTTPException(400, "There must be one embedding per ID")
+    index = get_index(request.model_name)
+    try:
+        await run_blocking(index.add, request.ids, np.array(request.embeddings, dtype=np.float32))
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return {"message": f"Indexed {len(request.ids)} embeddings"}
+
+
+@app.post("/index/remove", response_model=MessageResponse)
+async def remove_from_index(request: IndexRemoveRequest) -> dict[str, str]:
+    await run_blocking(get_index(request.model_name).remove, request.ids)
+    await run_blocking(get_hash_index(request.model_name).remove, request.ids)
+    return {"message": f"Removed {len(request.ids)} embeddings"}
+
+
+@app.post("/duplicates")
+async def duplicates(request: DuplicatesRequest) -> Any:
+    """
+    Finds near-duplicates of an indexed image, such as re-saved copies and burst shots, as a list of objects
+    with the `id`, Hamming `distance` between perceptual hashes and cosine `similarity` between CLIP embeddings of
+    each one, most similar first. Candidates are images whose hashes are within `maxDistance` bits, which are
+    confirmed by having a `minSimilarity` with the image.
+    """
+
+    if request.id is None:
+        raise HTTPException(400, "An ID must be provided, or use /duplicates/all")
+    index, hashes = get_index(request.model_name), get_hash_index(request.model_name)
+    try:
+        return JSONResponse(
+            await run_blocking(find_duplicates, hashes, index, request.id, request.max_distance, request.min_similarity)
+        )
+    except KeyError:
+        raise HTTPException(404, f"Image '{request.id}' isn't indexed")
+
+
+@app.post("/duplicates/all")
+async def all_duplicates(request: DuplicatesRequest) -> Any:
+    """
+    Groups every indexed image with its near-duplicates (see `/duplicates`), returning a list of groups of IDs.
+    Images linked by a chain of near-duplicates are in the same group.
+    """
+
+    index, hashes = get_index(request.model_name), get_hash_index(request.model_name)
+    try:
+        groups = await run_blocking(find_all_duplicates, hashes, index, request.max_distance, request.min_similarity)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return JSONResponse(groups)
+
+
+@app.post("/faces/cluster")
+async def cluster_faces(request: FaceClusterRequest) -> Any:
+    """
+    Adds faces to the clustering index and returns the `id` and `clusterId` of each one. A face joins the cluster of
+    its most similar face within `maxDistance` (cosine distance), or starts a new cluster. Faces are added in order,
+    so they can also join the clusters of earlier faces in the same request.
+    """
+
+    clusters = get_face_clusters(request.model_name)
+    ids = [face.id for face in request.faces]
+    embeddings = np.array([face.embedding for face in request.faces], dtype=np.float32)
+    try:
+        cluster_ids = await run_blocking(clusters.assign, ids, embeddings, request.max_distance)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    return JSONResponse([{"id": id, "clusterId": cluster_id} for id, cluster_id in zip(ids, cluster_ids)])
+
+
+@app.post("/faces/recluster")
+async def recluster_faces(request: FaceReclusterRequest) -> Any:
+    """
+    Clusters every face in the index from scratch with DBSCAN, replacing the previous clusters, and returns the `id`
+    and `clusterId` of each face. A cluster is made of faces with at least `minFaces` faces within `maxDistance`
+    (including themselves) and the faces near them. Faces that aren't in a cluster have a `clusterId` of null.
+    """
+
+    clusters = get_face_clusters(request.model_name)
+    cluster_ids = await run_blocking(clusters.recluster, request.max_distance, request.min_faces)
+    return JSONResponse([{"id": id, "clusterId": cluster_id} for id, cluster_id in cluster_ids.items()])
+
+
+@app.post("/faces/remove", response_model=MessageResponse)
+async def remove_faces(request: IndexRemoveRequest) -> dict[str, str]:
+    await run_blocking(get_face_clusters(request.model_name).remove, request.ids)
+    return {"message": f"Removed {len(request.ids)} faces"}
+
+
+@app.post("/predict/batch")
+async def predict_batch(
+    model_name: str = Form(alias="modelName"),
+    model_type: ModelType = Form(alias="modelType"),
+    options: str = Form(default="{}"),
+    texts: list[str] | None = Form(default=None, alias="text"),
+    images: list[UploadFile] | None = File(default=None, alias="image"),
+    priority: str | None = Header(default=None, alias="x-priority"),
+) -> StreamingResponse:
+    if images:
+        with metrics.time_stage(model_name, model_type.value, "read"):
+            inputs: Sequence[str | bytes] = [await image.read() for image in images]
+    elif texts:
+        inputs = texts
     else:
-        raise HTTPException(400, "Either image or text must be provided")
+        raise HTTPException(400, "Either images or texts must be provided")
+
+    kwargs = parse_options(options)
+    model = await app.state.model_cache.get(model_name, model_type, **kwargs)
+    with ExitStack() as stack:
+        stack.enter_context(model.in_use())
+        model = await prepare(model, kwargs)
+        # the stream releases the model once it finishes, so it can't be unloaded before the stream starts
+        in_use = stack.pop_all()
+    return StreamingResponse(
+        stream_results(model, inputs, parse_priority(priority, inputs[0]), kwargs, in_use),
+        media_type="application/x-ndjson",
+    )
+
+
+async def stream_results(
+    model: InferenceModel,
+    inputs: Sequence[str | bytes],
+    priority: Priority = Priority.NORMAL,
+    options: dict[str, Any] | None = None,
+    in_use: ExitStack | None = None,
+) -> AsyncIterator[bytes]:
+    """
+    Yields one JSON line per input in order of completion, tagged with the input's index. The model is marked as in
+    use until the stream finishes, using `in_use` if the caller already marked it.
+    """
+
+    async def _run(index: int, item: str | bytes) -> dict[str, Any]:
+        try:
+            with metrics.track_request(model.model_name, model.model_type.value):
+                return {"index": index, "result": await run(model, item, priority, options)}
+        except Exception as e:
+            log.debug(f"Failed to process batch item {index} for '{model.model_name}': {e}")
+            return {"index": index, "error": str(e) or e.__class__.__name__}
+
+    if in_use is None:
+        in_use = ExitStack()
+        in_use.enter_context(model.in_use())
+    with in_use:
+        tasks = [asyncio.ensure_future(_run(i, item)) for i, item in enumerate(inputs)]
+        try:
+            for task in asyncio.as_completed(tasks):
+                result = await task
+                with model.stage("serialize"):
+                    line = dumps_json(result, option=orjson.OPT_APPEND_NEWLINE)
+                yield line
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def parse_options(options: str) -> dict[str, Any]:
     try:
-        kwargs = orjson.loads(options)
+        kwargs: dict[str, Any] = orjson.loads(options)
     except orjson.JSONDecodeError:
         raise HTTPException(400, f"Invalid options JSON: {options}")
+    return kwargs
+
+
+def parse_tasks(tasks: str) -> list[InferenceTask]:
+    try:
+        task_list = pydantic.parse_raw_as(list[InferenceTask], tasks)
+    # invalid JSON raises a `ValueError`, which `ValidationError` is a subclass of
+    except ValueError as e:
+        raise HTTPException(400, f"Invalid tasks: {e}")
+    if not task_list:
+        raise HTTPException(400, "At least one task must be provided")
+    return task_list
 
-    model = await load(await app.state.model_cache.get(model_name, model_type, **kwargs))
-    model.configure(**kwargs)
-    outputs = await run(model, inputs)
-    return ORJSONResponse(outputs)
 
+def pop_index_id(model_type: ModelType, options: dict[str, Any], inputs: Any) -> str | None:
+    index_id = options.pop("indexId", None)
+    if index_id is None:
+        return None
+    if model_type != ModelType.CLIP or not isinstance(inputs, bytes):
+        raise HTTPException(400, "Only CLIP image embeddings can be indexed")
+    if app.state.indexes is None:
+        raise HTTPException(400, "Indexing is disabled")
+    return str(index_id)
 
-async def run(model: InferenceModel, inputs: Any) -> Any:
+
+def get_index(model_name: str) -> VectorIndex:
+    if app.state.indexes is None:
+        raise HTTPException(400, "Indexing is disabled")
+    with app.state.index_lock:
+        index: VectorIndex | None = app.state.indexes.get(model_name)
+        if index is None:
+            index = VectorIndex(
+                get_index_dir(model_name),
+                dtype=settings.index_dtype,
+                partitions=settings.index_partitions,
+                probes=settings.index_probes,
+            )
+            app.state.indexes[model_name] = index
+    return index
+
+
+def get_hash_index(model_name: str) -> HashIndex:
+    if app.state.hash_indexes is None:
+        raise HTTPException(400, "Indexing is disabled")
+    with app.state.index_lock:
+        hashes: HashIndex | None = app.state.hash_indexes.get(model_name)
+        if hashes is None:
+            # stored next to the embeddings
+            hashes = app.state.hash_indexes[model_name] = HashIndex(get_index_dir(model_name))
+    return hashes
+
+
+async def index_image(model_name: str, index_id: str, image: bytes | DecodedImage, embedding: Any) -> None:
+    await run_blocking(get_index(model_name).add, [index_id], np.asarray([embedding]))
+    hash = await run_blocking(perceptual_hash, image)
+    await run_blocking(get_hash_index(model_name).add, [index_id], [hash])
+
+
+def get_face_clusters(model_name: str) -> FaceClusters:
+    if app.state.face_clusters is None:
+        raise HTTPException(400, "Face clustering is disabled")
+    with app.state.index_lock:
+        clusters: FaceClusters | None = app.state.face_clusters.get(model_name)
+        if clusters is None:
+            clusters = FaceClusters(
+                get_clusters_dir(model_name),
+                dtype=settings.index_dtype,
+                partitions=settings.index_partitions,
+                probes=settings.index_probes,
+            )
+            app.state.face_clusters[model_name] = clusters
+    return clusters
+
+
+def parse_priority(priority: str | None, inputs: Any) -> Priority:
+    if priority is None:
+        # text is encoded for searches, which someone is waiting on, while images are usually processed by jobs
+        return Priority.HIGH if isinstance(inputs, str) else Priority.NORMAL
+    try:
+        return Priority[priority.upper()]
+    except KeyError:
+        raise HTTPException(400, f"Invalid priority '{priority}', must be one of: high, normal, low")
+
+
+async def prepare(model: InferenceModel, options: dict[str, Any]) -> InferenceModel:
+    # worker processes load their own copies of the model
+    if app.state.process_pool is not None:
+        return model
+
+    return await load(model)
+
+
+async def run(
+    model: InferenceModel, inputs: Any, priority: Priority = Priority.NORMAL, options: dict[str, Any] | None = None
+) -> Any:
+    if isinstance(inputs, str) and app.state.text_cache is not None:
+        key = (model_key(model.model_name, model.model_type, options or {}), normalize_text(inputs))
+        outputs = app.state.text_cache.get(key)
+        if outputs is None:
+            outputs = await _run(model, inputs, priority, options)
+            app.state.text_cache.set(key, outputs)
+        return outputs
+
+    return await _run(model, inputs, priority, options)
+
+
+async def _run(
+    model: InferenceModel, inputs: Any, priority: Priority = Priority.NORMAL, options: dict[str, Any] | None = None
+) -> Any:
+    admission: AdmissionController | None = app.state.admission
+    if admission is None:
+        return await _infer(model, inputs, options)
+
+    try:
+        with model.stage("queue"):
+            await admission.acquire(priority)
+    except Overloaded as e:
+        raise HTTPException(e.status_code, str(e), headers={"Retry-After": str(e.retry_after)})
+    try:
+        return await _infer(model, inputs, options)
+    finally:
+        admission.release()
+
+
+async def _infer(model: InferenceModel, inputs: Any, options: dict[str, Any] | None = None) -> Any:
+    if app.state.process_pool is not None:
+        return await app.state.process_pool.predict(model.model_name, model.model_type, inputs, options)
+
+    if app.state.batcher is not None and model.batchable(inputs):
+        return await app.state.batcher.submit(model, inputs, options)
+
+    async with model.reserve():
+        return await run_blocking(partial(model.predict, **(options or {})), inputs)
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any) -> Any:
     if app.state.thread_pool is None:
-        return model.predict(inputs)
+        return func(*args)
 
-    return await asyncio.get_running_loop().run_in_executor(app.state.thread_pool, model.predict, inputs)
+    return await asyncio.get_running_loop().run_in_executor(app.state.thread_pool, func, *args)
 
 
 async def load(model: InferenceModel) -> InferenceModel:
@@ -99,7 +737,6 @@ async def load(model: InferenceModel) -> InferenceModel:
             model.load()
         else:
             await loop.run_in_executor(app.state.thread_pool, _load)
-        return model
     except (OSError, InvalidProtobuf, BadZipFile, NoSuchFile):
         log.warn(
             (
@@ -112,4 +749,5 @@ async def load(model: InferenceModel) -> InferenceModel:
             model.load()
         else:
             await loop.run_in_executor(app.state.thread_pool, _load)
-        return model
+    await app.state.model_cache.evict()
+    return model
@@ -0,0 +1,123 @@
+from contextlib import contextmanager
+from typing import Any, Callable, ContextManager, Iterable, Iterator
+
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+
+CONTENT_TYPE = CONTENT_TYPE_LATEST
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = tuple[str, ...]
+
+
+class CollectedMetric:
+    """
+    A gauge or counter whose values are already tracked elsewhere, e.g. by the app's state, and are read when the
+    metrics are rendered. Values are read with the function given to `set_function`, and the metric is empty until
+    one is given.
+    """
+
+    def __init__(
+        self,
+        family: type[GaugeMetricFamily] | type[CounterMetricFamily],
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        registry: CollectorRegistry | None = None,
+    ) -> None:
+        self.family = family
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._function: Callable[[], dict[LabelValues, float]] | None = None
+        if registry is not None:
+            registry.register(self)
+
+    def set_function(self, function: Callable[[], dict[LabelValues, float]]) -> None:
+        """Sets the function that returns the current value for each combination of label values."""
+        self._function = function
+
+    def describe(self) -> Iterable[Metric]:
+        return [self.family(self.name, self.documentation, labels=self.labelnames)]
+
+    def collect(self) -> Iterable[Metric]:
+        metric = self.family(self.name, self.documentation, labels=self.labelnames)
+        if self._function is not None:
+            for label_values, value in self._function().items():
+                metric.add_metric(list(label_values), value)
+        return [metric]
+
+
+registry = CollectorRegistry()
+
+requests_total = Counter(
+    "immich_ml_requests_total",
+    "Number of inference requests. Each input of a batch request is counted separately.",
+    ("model_name", "model_type"),
+    registry=registry,
+)
+errors_total = Counter(
+    "immich_ml_errors_total",
+    "Number of inference requests that failed. Each input of a batch request is counted separately.",
+    ("model_name", "model_type"),
+    registry=registry,
+)
+stage_duration_seconds = Histogram(
+    "immich_ml_stage_duration_seconds",
+    (
+        "Time spent in each stage of handling a request: read, queue (to be admitted), "
+        "wait (for a free model replica), decode, detect (face detection), preprocess, run, postprocess and serialize."
+    ),
+    ("model_name", "model_type", "stage"),
+    buckets=DEFAULT_BUCKETS,
+    registry=registry,
+)
+# the values below are tracked by the app's state and collected when rendered
+thread_pool_queue_depth = CollectedMetric(
+    GaugeMetricFamily,
+    "immich_ml_thread_pool_queue_depth",
+    "Number of tasks waiting for a thread in the request thread pool.",
+    registry=registry,
+)
+loaded_models = CollectedMetric(
+    GaugeMetricFamily, "immich_ml_loaded_models", "Number of models loaded in memory.", registry=registry
+)
+queued_requests = CollectedMetric(
+    GaugeMetricFamily,
+    "immich_ml_queued_requests",
+    "Number of requests waiting to be admitted for inference.",
+    ("priority",),
+    registry=registry,
+)
+rejected_requests_total = CollectedMetric(
+    CounterMetricFamily,
+    "immich_ml_rejected_requests_total",
+    "Number of requests rejected because too many requests were queued or they waited too long.",
+    ("reason",),
+    registry=registry,
+)
+cache_hits_total = CollectedMetric(
+    CounterMetricFamily, "immich_ml_cache_hits_total", "Number of cache hits.", ("cache",), registry=registry
+)
+cache_misses_total = CollectedMetric(
+    CounterMetricFamily, "immich_ml_cache_misses_total", "Number of cache misses.", ("cache",), registry=registry
+)
+
+
+def render() -> bytes:
+    return generate_latest(registry)
+
+
+def time_stage(model_name: str, model_type: str, stage: str) -> ContextManager[Any]:
+    return stage_duration_seconds.labels(model_name=model_name, model_type=model_type, stage=stage).time()
+
+
+@contextmanager
+def track_request(model_name: str, model_type: str) -> Iterator[None]:
+    """Counts a request, and counts it as an error if the block raises."""
+    requests_total.labels(model_name=model_name, model_type=model_type).inc()
+    try:
+        yield
+    except Exception:
+        errors_total.labels(model_name=model_name, model_type=model_type).inc()
+        raise
@@ -1,3 +1,49 @@
-from .clip import CLIPEncoder
-from .facial_recognition import FaceRecognizer
-from .image_classification import ImageClassifier
+import importlib
+import sys
+import time
+from collections import Counter
+from typing import Any
+
+from ..config import log
+from ..schemas import ModelType
+from .base import InferenceModel
+
+# model modules pull in heavy dependencies, so they're only imported once their model type is requested
+_MODEL_CLASSES: dict[ModelType, tuple[str, str]] = {
+    ModelType.CLIP: (".clip", "CLIPEncoder"),
+    ModelType.FACIAL_RECOGNITION: (".facial_recognition", "FaceRecognizer"),
+    ModelType.IMAGE_CLASSIFICATION: (".image_classification", "ImageClassifier"),
+}
+
+
+def get_model_class(model_type: ModelType) -> type[InferenceModel]:
+    if model_type not in _MODEL_CLASSES:
+        raise ValueError(f"Unsupported model type: {model_type}")
+
+    module_name, class_name = _MODEL_CLASSES[model_type]
+    if f"{__name__}{module_name}" in sys.modules:
+        module = sys.modules[f"{__name__}{module_name}"]
+    else:
+        module = _timed_import(module_name)
+    model_class: type[InferenceModel] = getattr(module, class_name)
+    return model_class
+
+
+def _timed_import(module_name: str) -> Any:
+    modules_before = set(sys.modules)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name, __name__)
+    elapsed = time.perf_counter() - start
+
+    new_modules = set(sys.modules) - modules_before
+    packages = Counter(name.split(".")[0] for name in new_modules)
+    summary = ", ".join(f"{package} ({count})" for package, count in packages.most_common(10))
+    log.debug(f"Imported '{module.__name__}' in {elapsed:.2f}s with {len(new_modules)} new modules: {summary}")
+    return module
+
+
+def __getattr__(name: str) -> type[InferenceModel]:
+    for model_type, (_, class_name) in _MODEL_CLASSES.items():
+        if class_name == name:
+            return get_model_class(model_type)
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
@@ -1,19 +1,29 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import os
 import pickle
+import queue
 from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 from shutil import rmtree
-from typing import Any
+from typing import Any, AsyncIterator, ContextManager, Iterator
 
 import onnxruntime as ort
 
 from ..config import get_cache_dir, log, settings
+from ..metrics import time_stage
 from ..schemas import ModelType
 
+QUANTIZED_SUFFIX = ".int8.onnx"
+
 
 class InferenceModel(ABC):
     _model_type: ModelType
+    # whether quantizing the model's weights with `quantize_model` makes a difference
+    quantizable = False
 
     def __init__(
         self,
@@ -21,10 +31,26 @@ class InferenceModel(ABC):
         cache_dir: Path | str | None = None,
         inter_op_num_threads: int = settings.model_inter_op_threads,
         intra_op_num_threads: int = settings.model_intra_op_threads,
+        replicas: int = settings.model_replicas,
+        quantize: bool | None = None,
         **model_kwargs: Any,
     ) -> None:
         self.model_name = model_name
+        quantize = quantize if quantize is not None else self.model_type in settings.quantize
+        if quantize and not self.quantizable:
+            log.warning(
+                f"Quantization isn't supported for {self.model_type.replace('-', ' ')} models, "
+                f"so '{model_name}' will be loaded without it."
+            )
+            quantize = False
+        self.quantize = quantize
         self.loaded = False
+        self.size = 0
+        self.active_requests = 0
+        self.replicas = max(replicas, 1)
+        self._replicas: list[InferenceModel] = [self]
+        self._idle_replicas: queue.SimpleQueue[InferenceModel] | None = None
+        self._replica_slots: asyncio.Semaphore | None = None
         self._cache_dir = Path(cache_dir) if cache_dir is not None else get_cache_dir(model_name, self.model_type)
         self.providers = model_kwargs.pop("providers", ["CPUExecutionProvider"])
         #  don't pre-allocate more memory than needed
@@ -38,17 +64,22 @@ class InferenceModel(ABC):
             ),
         )
         log.debug(f"Setting execution provider options to {self.provider_options}")
-        self.sess_options = PicklableSessionOptions()
-        # avoid thread contention between models
-        if inter_op_num_threads > 1:
-            self.sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
-
+        self.inter_op_num_threads = inter_op_num_threads
+        self.intra_op_num_threads = intra_op_num_threads
+        self.sess_options = self._create_sess_options()
         log.debug(f"Setting execution_mode to {self.sess_options.execution_mode.name}")
         log.debug(f"Setting inter_op_num_threads to {inter_op_num_threads}")
         log.debug(f"Setting intra_op_num_threads to {intra_op_num_threads}")
-        self.sess_options.inter_op_num_threads = inter_op_num_threads
-        self.sess_options.intra_op_num_threads = intra_op_num_threads
-        self.sess_options.enable_cpu_mem_arena = False
+
+    def _create_sess_options(self) -> PicklableSessionOptions:
+        sess_options = PicklableSessionOptions()
+        # avoid thread contention between models
+        if self.inter_op_num_threads > 1:
+            sess_options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+        sess_options.inter_op_num_threads = self.inter_op_num_threads
+        sess_options.intra_op_num_threads = self.intra_op_num_threads
+        sess_options.enable_cpu_mem_arena = False
+        return sess_options
 
     def download(self) -> None:
         if not self.cached:
@@ -62,21 +93,125 @@ class InferenceModel(ABC):
             return
         self.download()
         log.info(f"Loading {self.model_type.replace('-', ' ')} model '{self.model_name}'")
+        rss_before = get_rss()
         self._load()
+        self._load_replicas()
+        # RSS is skewed by other models loading at the same time, so the model files act as a lower bound
+        file_size = sum(file.stat().st_size for file in self._model_files()) * self.replicas
+        self.size = max(get_rss() - rss_before, file_size)
+        log.debug(f"Loaded '{self.model_name}' with an estimated size of {self.size / 2**20:.1f} MiB")
         self.loaded = True
 
-    def predict(self, inputs: Any, **model_kwargs: Any) -> Any:
+    def _load_replicas(self) -> None:
+        if self.replicas <= 1:
+            return
+
+        # each replica is a copy of this model with its own sessions, which only serves one request at a time
+        log.debug(f"Loading {self.replicas - 1} additional replicas of '{self.model_name}'")
+        replicas = [self]
+        for _ in range(self.replicas - 1):
+            replica = copy.copy(self)
+            # sessions keep a reference to their options, so each replica needs its own to be configured separately
+            replica.sess_options = self._create_sess_options()
+            replica._load()
+            replicas.append(replica)
+        self._idle_replicas = queue.SimpleQueue()
+        for replica in replicas:
+            replica._replicas = replicas
+            self._idle_replicas.put(replica)
+        self._replica_slots = asyncio.Semaphore(len(replicas))
+
+    @asynccontextmanager
+    async def reserve(self) -> AsyncIterator[None]:
+        """
+        Waits in the event loop until a replica is free, if the model has more than one. Requests should reserve a
+        replica before running in the request thread pool, so requests waiting for a busy model don't hold threads
+        that requests for other models could use.
+        """
+        if self._replica_slots is None:
+            yield
+            return
+
+        with self.stage("wait"):
+            await self._replica_slots.acquire()
+        try:
+            yield
+        finally:
+            self._replica_slots.release()
+
+    @contextmanager
+    def _acquire(self) -> Iterator[InferenceModel]:
+        """
+        Takes a free replica if the model has more than one, otherwise uses the model itself. This only blocks if
+        the replica wasn't reserved first.
+        """
+        if self._idle_replicas is None:
+            yield self
+            return
+
+        replica = self._idle_replicas.get()
+        try:
+            yield replica
+        finally:
+            self._idle_replicas.put(replica)
+
+    @contextmanager
+    def in_use(self) -> Iterator[None]:
+        """Marks the model as having a request in flight, which keeps it from being unloaded."""
+        self.active_requests += 1
+        try:
+            yield
+        finally:
+            self.active_requests -= 1
+
+    def stage(self, name: str) -> ContextManager[Any]:
+        """Records the time taken by a stage of inference, e.g. `decode` or `run`, in the model's metrics."""
+        return time_stage(self.model_name, self.model_type.value, name)
+
+    def warmup(self) -> None:
+        """Runs a dummy inference so the first real request doesn't pay for the runtime's lazy initialization."""
+        self.load()
+        log.debug(f"Warming up {self.model_type.replace('-', ' ')} model '{self.model_name}'")
+        for replica in self._replicas:
+            replica._warmup()
+
+    def predict(self, inputs: Any, **options: Any) -> Any:
+        """
+        Runs inference on `inputs`. The options of a request, e.g. `minScore`, only apply to this call, so concurrent
+        requests with different options don't affect each other. Options the model doesn't use are ignored.
+        """
+
+        self.load()
+        with self._acquire() as replica:
+            return replica._predict(inputs, **options)
+
+    def predict_batch(self, inputs: list[Any], **options: Any) -> list[Any]:
+        """Runs inference on each of `inputs` with the same options, as in `predict`."""
         self.load()
-        if model_kwargs:
-            self.configure(**model_kwargs)
-        return self._predict(inputs)
+        with self._acquire() as replica:
+            return replica._predict_batch(inputs, **options)
+
+    @abstractmethod
+    def _predict(self, inputs: Any, /, **options: Any) -> Any:
+        ...
 
     @abstractmethod
-    def _predict(self, inputs: Any) -> Any:
+    def _warmup(self) -> None:
         ...
 
-    def configure(self, **model_kwargs: Any) -> None:
-        pass
+    def _predict_batch(self, inputs: list[Any], /, **options: Any) -> list[Any]:
+        return [self._predict(item, **options) for item in inputs]
+
+    def decode_size(self, **options: Any) -> tuple[int, int] | None:
+        """
+        Returns the minimum shortest and longest side an image needs for this model, so it can be downscaled while
+        decoding, or None if the image is needed at full size.
+        """
+        return None
+
+    def batchable(self, inputs: Any) -> bool:
+        """Whether `inputs` can be grouped with other requests into a single `predict_batch` call."""
+        return False
 
     @abstractmethod
     def _download(self) -> None:
@@ -86,6 +221,63 @@ class InferenceModel(ABC):
     def _load(self) -> None:
         ...
 
+    def _model_files(self) -> list[Path]:
+        return [
+            file
+            for file in self.cache_dir.rglob("*.onnx")
+            if file.is_file() and file.name.endswith(QUANTIZED_SUFFIX) == self.quantize
+        ]
+
+    def _model_path(self, path: Path) -> Path:
+        """
+        Returns the path of the model file to load, which is an INT8 variant of `path` if quantization is enabled.
+        The variant is saved next to the original the first time it's needed.
+        """
+
+        if not self.quantize:
+            return path
+
+        quantized_path = path.with_suffix(QUANTIZED_SUFFIX)
+        if not quantized_path.is_file():
+            log.info(f"Quantizing '{path.name}' of '{self.model_name}' to INT8. This may take a while.")
+            quantize_model(path, quantized_path)
+        return quantized_path
+
+    def _create_session(self, path: Path) -> ort.InferenceSession:
+        """
+        Creates a session for the model at `path`, using its INT8 variant if quantization is enabled.
+
+        Optimizing the graph makes up most of the time it takes to create a session, so the optimized graph is saved
+        next to the model in ORT format the first time it's loaded and reused afterwards.
+        """
+
+        path = self._model_path(path)
+        optimized_path = path.with_name(f"{path.stem}.optimized-{ort.__version__}-{_provider_key(self.providers)}.ort")
+        if not optimized_path.is_file() and path.is_file():
+            log.debug(f"Saving optimized graph of '{path.name}' for '{self.model_name}'")
+            try:
+                optimize_model(path, optimized_path, self.providers, self.provider_options)
+            except Exception:
+                log.warning(f"Failed to save optimized graph of '{path.name}' for '{self.model_name}'", exc_info=True)
+
+        if optimized_path.is_file():
+            try:
+                return self._session(optimized_path)
+            except Exception:
+                log.warning(
+                    f"Failed to load optimized graph of '{path.name}', loading the original instead", exc_info=True
+                )
+                optimized_path.unlink(missing_ok=True)
+        return self._session(path)
+
+    def _session(self, path: Path) -> ort.InferenceSession:
+        return ort.InferenceSession(
+            path.as_posix(),
+            sess_options=self.sess_options,
+            providers=self.providers,
+            provider_options=self.provider_options,
+        )
+
     @property
     def model_type(self) -> ModelType:
         return self._model_type
@@ -104,11 +296,9 @@ class InferenceModel(ABC):
 
     @classmethod
     def from_model_type(cls, model_type: ModelType, model_name: str, **model_kwargs: Any) -> InferenceModel:
-        subclasses = {subclass._model_type: subclass for subclass in cls.__subclasses__()}
-        if model_type not in subclasses:
-            raise ValueError(f"Unsupported model type: {model_type}")
+        from . import get_model_class
 
-        return subclasses[model_type](model_name, **model_kwargs)
+        return get_model_class(model_type)(model_name, **model_kwargs)
 
     def clear_cache(self) -> None:
         if not self.cache_dir.exists():
@@ -133,6 +323,62 @@ class InferenceModel(ABC):
         self.cache_dir.mkdir(parents=True, exist_ok=True)
 
 
+def quantize_model(path: Path, quantized_path: Path) -> None:
+    """Dynamically quantizes the weights of MatMul and Gemm nodes to INT8 and saves the model to `quantized_path`."""
+
+    # the quantization tools pull in onnx, which isn't needed otherwise
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    # convolutions are left in FP32, as dynamically quantized convolutions are usually slower on CPU
+    tmp_path = quantized_path.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        quantize_dynamic(path, tmp_path, op_types_to_quantize=["MatMul", "Gemm"], weight_type=QuantType.QInt8)
+        os.replace(tmp_path, quantized_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def optimize_model(
+    path: Path, optimized_path: Path, providers: list[str], provider_options: list[dict[str, Any]]
+) -> None:
+    """
+    Applies the graph optimizations that don't depend on the hardware to the model and saves it to `optimized_path`
+    in ORT format. Older optimized graphs of the model are removed.
+    """
+
+    sess_options = ort.SessionOptions()
+    # layout optimizations are specific to the CPU and still applied when the saved graph is loaded
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_options.add_session_config_entry("session.save_model_format", "ORT")
+    tmp_path = optimized_path.with_suffix(f".{os.getpid()}.tmp")
+    sess_options.optimized_model_filepath = tmp_path.as_posix()
+    try:
+        ort.InferenceSession(
+            path.as_posix(), sess_options=sess_options, providers=providers, provider_options=provider_options
+        )
+        os.replace(tmp_path, optimized_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    # graphs optimized for other onnxruntime versions or providers
+    for stale_path in path.parent.glob(f"{path.stem}.optimized-*.ort"):
+        if stale_path != optimized_path:
+            stale_path.unlink(missing_ok=True)
+
+
+def _provider_key(providers: list[str]) -> str:
+    return "-".join(provider.removesuffix("ExecutionProvider").lower() for provider in providers)
+
+
+def get_rss() -> int:
+    """Returns the resident set size of this process in bytes, or 0 if it can't be measured."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
 # HF deep copies configs, so we need to make session options picklable
 class PicklableSessionOptions(ort.SessionOptions):
     def __getstate__(self) -> bytes:
@@ -1,12 +1,42 @@
-from typing import Any
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Hashable
 
+import orjson
 from aiocache.backends.memory import SimpleMemoryCache
 from aiocache.lock import OptimisticLock
 from aiocache.plugins import BasePlugin, TimingPlugin
 
+from ..config import log
 from ..schemas import ModelType
 from .base import InferenceModel
 
+# options that change how a model is loaded, as opposed to those that only apply to each request
+LOAD_OPTIONS = ("mode", "quantize", "replicas")
+
+
+def load_options(model_kwargs: dict[str, Any]) -> dict[str, Any]:
+    """
+    Returns the options a model should be created with. Request options are passed to each call instead, so they
+    can't become the defaults of a cached model for every request after the one that loaded it.
+    """
+
+    return {option: model_kwargs[option] for option in LOAD_OPTIONS if option in model_kwargs}
+
+
+def model_key(model_name: str, model_type: ModelType, model_kwargs: dict[str, Any]) -> str:
+    """
+    Returns the key of a model in a cache. A loaded model can't change its load options, so models requested with
+    different ones are cached separately instead of reusing whichever was loaded first.
+    """
+
+    options = "".join(f"{option}={value}" for option, value in load_options(model_kwargs).items())
+    return f"{model_name}{model_type.value}{options}"
+
 
 class ModelCache:
     """Fetches a model from an in-memory cache, instantiating it if it's missing."""
@@ -17,6 +47,7 @@ class ModelCache:
         revalidate: bool = False,
         timeout: int | None = None,
         profiling: bool = False,
+        max_size: int | None = None,
     ) -> None:
         """
         Args:
@@ -24,9 +55,15 @@ class ModelCache:
             revalidate: Resets TTL on cache hit. Useful to keep models in memory while active. Defaults to False.
             timeout: Maximum allowed time for model to load. Disabled if None. Defaults to None.
             profiling: Collects metrics for cache operations, adding slight overhead. Defaults to False.
+            max_size: Unloads least recently used models when loaded models take more than this many bytes.
+                Disabled if None. Defaults to None.
         """
 
         self.ttl = ttl
+        self.max_size = max_size
+        self.last_used: dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
         plugins = []
 
         if revalidate:
@@ -46,14 +83,40 @@ class ModelCache:
             model: The requested model.
         """
 
-        key = f"{model_name}{model_type.value}{model_kwargs.get('mode', '')}"
+        key = model_key(model_name, model_type, model_kwargs)
         async with OptimisticLock(self.cache, key) as lock:
             model = await self.cache.get(key)
             if model is None:
-                model = InferenceModel.from_model_type(model_type, model_name, **model_kwargs)
+                self.misses += 1
+                model = InferenceModel.from_model_type(model_type, model_name, **load_options(model_kwargs))
                 await lock.cas(model, ttl=self.ttl)
+            else:
+                self.hits += 1
+        self.last_used[key] = time.monotonic()
         return model
 
+    async def evict(self) -> None:
+        """Unloads least recently used models until loaded models fit within `max_size`, skipping models in use."""
+
+        if self.max_size is None:
+            return
+
+        models: dict[str, InferenceModel] = {key: model for key, model in self.cache._cache.items() if model.loaded}
+        total_size = sum(model.size for model in models.values())
+        for key in sorted(models, key=lambda key: self.last_used.get(key, 0.0)):
+            if total_size <= self.max_size:
+                break
+            model = models[key]
+            if model.active_requests > 0:
+                continue
+            await self.cache.delete(key)
+            self.last_used.pop(key, None)
+            total_size -= model.size
+            log.info(
+                f"Unloaded {model.model_type.replace('-', ' ')} model '{model.model_name}' "
+                f"to stay within the memory budget of {self.max_size / 2**20:.0f} MiB"
+            )
+
     async def get_profiling(self) -> dict[str, float] | None:
         if not hasattr(self.cache, "profiling"):
             return None
@@ -95,3 +158,127 @@ class RevalidationPlugin(BasePlugin):
                 key = client.build_key(key, namespace)
             if val is not None and key in client._handlers:
                 await client.expire(key, client.ttl)
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a bounded size and optional expiry."""
+
+    def __init__(self, capacity: int, ttl: float | None = None, sizeof: Callable[[Any], int] | None = None) -> None:
+        """
+        Args:
+            capacity: Maximum total size of entries. The least recently used entries are evicted when full.
+            ttl: Entries expire this many seconds after being set. Disabled if None. Defaults to None.
+            sizeof: Returns the size of a value. Every entry has a size of 1 if None. Defaults to None.
+        """
+
+        self.capacity = capacity
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl is not None and entry[0] < time.monotonic()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        size = self.sizeof(value) if self.sizeof is not None else 1
+        if size > self.capacity:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, value)
+            self.size += size
+            while self.size > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ResultCache:
+    """
+    Caches serialized inference results by the content of their inputs.
+    Results are kept in memory up to a size limit and optionally persisted to disk.
+    """
+
+    def __init__(self, max_size: int, folder: Path | str | None = None) -> None:
+        """
+        Args:
+            max_size: Maximum total size in bytes of results kept in memory.
+            folder: Directory where results are persisted. Results are only kept in memory if None. Defaults to None.
+        """
+
+        self.memory = LRUCache(max_size, sizeof=len)
+        self.folder = Path(folder) if folder is not None else None
+        self.disk_hits = 0
+
+    @staticmethod
+    def key(data: bytes, model_name: str, model_type: ModelType, options: dict[str, Any]) -> str:
+        hasher = hashlib.blake2b(data, digest_size=20)
+        hasher.update(model_name.encode())
+        hasher.update(model_type.value.encode())
+        hasher.update(orjson.dumps(options, option=orjson.OPT_SORT_KEYS))
+        return hasher.hexdigest()
+
+    @property
+    def hits(self) -> int:
+        return self.memory.hits + self.disk_hits
+
+    @property
+    def misses(self) -> int:
+        return self.memory.misses - self.disk_hits
+
+    def get(self, key: str) -> bytes | None:
+        result: bytes | None = self.memory.get(key)
+        if result is not None or self.folder is None:
+            return result
+
+        try:
+            result = self._path(key).read_bytes()
+        except OSError:
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, result)
+        return result
+
+    def set(self, key: str, result: bytes) -> None:
+        self.memory.set(key, result)
+        if self.folder is None:
+            return
+
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.write_bytes(result)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            log.warn(f"Failed to persist result to '{path}': {e}")
+            tmp_path.unlink(missing_ok=True)
+
+    def _path(self, key: str) -> Path:
+        assert self.folder is not None
+        return self.folder / key[:2] / f"{key}.json"
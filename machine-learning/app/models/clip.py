@@ -1,20 +1,21 @@
 import os
 import zipfile
-from io import BytesIO
+from pathlib import Path
 from typing import Any, Literal
 
-import onnxruntime as ort
-import torch
-from clip_server.model.clip import BICUBIC, _convert_image_to_rgb
+import numpy as np
 from clip_server.model.clip_onnx import _MODELS, _S3_BUCKET_V2, CLIPOnnxModel, download_model
-from clip_server.model.pretrained_models import _VISUAL_MODEL_IMAGE_SIZE
-from clip_server.model.tokenization import Tokenizer
+from clip_server.model.pretrained_models import _MULTILINGUALCLIP_MODELS, _VISUAL_MODEL_IMAGE_SIZE
 from PIL import Image
-from torchvision.transforms import CenterCrop, Compose, Normalize, Resize, ToTensor
 
 from ..config import log
 from ..schemas import ModelType
 from .base import InferenceModel
+from .decode import DecodedImage, decode_pil
+
+_CONTEXT_LENGTH = 77
+_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
 
 _ST_TO_JINA_MODEL_NAME = {
     "clip-ViT-B-16": "ViT-B-16::openai",
@@ -26,11 +27,13 @@ _ST_TO_JINA_MODEL_NAME = {
 
 class CLIPEncoder(InferenceModel):
     _model_type = ModelType.CLIP
+    # the transformers are mostly MatMul nodes
+    quantizable = True
 
     def __init__(
         self,
         model_name: str,
-        cache_dir: str | None = None,
+        cache_dir: Path | str | None = None,
         mode: Literal["text", "vision"] | None = None,
         **model_kwargs: Any,
     ) -> None:
@@ -41,6 +44,7 @@ class CLIPEncoder(InferenceModel):
         self.mode = mode
         jina_model_name = self._get_jina_model_name(model_name)
         super().__init__(jina_model_name, cache_dir, **model_kwargs)
+        self.image_size = _VISUAL_MODEL_IMAGE_SIZE[CLIPOnnxModel.get_model_name(self.model_name)]
 
     def _download(self) -> None:
         models: tuple[tuple[str, str], tuple[str, str]] = _MODELS[self.model_name]
@@ -56,53 +60,104 @@ class CLIPEncoder(InferenceModel):
     def _load(self) -> None:
         if self.mode == "text" or self.mode is None:
             log.debug(f"Loading clip text model '{self.model_name}'")
-            self.text_model = ort.InferenceSession(
-                self.cache_dir / "textual.onnx",
-                sess_options=self.sess_options,
-                providers=self.providers,
-                provider_options=self.provider_options,
-            )
+            self.text_model = self._create_session(self.cache_dir / "textual.onnx")
             self.text_outputs = [output.name for output in self.text_model.get_outputs()]
-            self.tokenizer = Tokenizer(self.model_name)
+            self.tokenizer = _load_tokenizer(self.model_name)
 
         if self.mode == "vision" or self.mode is None:
             log.debug(f"Loading clip vision model '{self.model_name}'")
-            self.vision_model = ort.InferenceSession(
-                self.cache_dir / "visual.onnx",
-                sess_options=self.sess_options,
-                providers=self.providers,
-                provider_options=self.provider_options,
-            )
+            self.vision_model = self._create_session(self.cache_dir / "visual.onnx")
             self.vision_outputs = [output.name for output in self.vision_model.get_outputs()]
 
-            image_size = _VISUAL_MODEL_IMAGE_SIZE[CLIPOnnxModel.get_model_name(self.model_name)]
-            self.transform = _transform_pil_image(image_size)
+    def _warmup(self) -> None:
+        if self.mode == "text" or self.mode is None:
+            self._predict("warmup")
+        if self.mode == "vision" or self.mode is None:
+            self._predict(Image.new("RGB", (self.image_size, self.image_size)))
 
-    def _predict(self, image_or_text: Image.Image | str) -> list[float]:
-        if isinstance(image_or_text, bytes):
-            image_or_text = Image.open(BytesIO(image_or_text))
+    def _predict(
+        self, image_or_text: Image.Image | bytes | DecodedImage | str, /, **options: Any
+    ) -> np.ndarray[int, np.dtype[np.float32]]:
+        if isinstance(image_or_text, (bytes, DecodedImage)):
+            with self.stage("decode"):
+                image_or_text = decode_pil(image_or_text, self.image_size)
 
         match image_or_text:
             case Image.Image():
                 if self.mode == "text":
                     raise TypeError("Cannot encode image as text-only model")
-                pixel_values = self.transform(image_or_text)
-                assert isinstance(pixel_values, torch.Tensor)
-                pixel_values = torch.unsqueeze(pixel_values, 0).numpy()
-                outputs = self.vision_model.run(self.vision_outputs, {"pixel_values": pixel_values})
+                outputs = self._encode_images([image_or_text])
             case str():
                 if self.mode == "vision":
                     raise TypeError("Cannot encode text as vision-only model")
-                text_inputs: dict[str, torch.Tensor] = self.tokenizer(image_or_text)
-                inputs = {
-                    "input_ids": text_inputs["input_ids"].int().numpy(),
-                    "attention_mask": text_inputs["attention_mask"].int().numpy(),
-                }
-                outputs = self.text_model.run(self.text_outputs, inputs)
+                with self.stage("preprocess"):
+                    text_inputs = self._tokenize([image_or_text])
+                with self.stage("run"):
+                    outputs = self.text_model.run(self.text_outputs, text_inputs)
             case _:
                 raise TypeError(f"Expected Image or str, but got: {type(image_or_text)}")
 
-        return outputs[0][0].tolist()
+        # embeddings are returned as arrays so they can be serialized without converting them to lists
+        return outputs[0][0]
+
+    def _predict_batch(
+        self, images: list[Image.Image | bytes | DecodedImage], /, **options: Any
+    ) -> list[np.ndarray[int, np.dtype[np.float32]]]:
+        if not all(self.batchable(image) for image in images):
+            return super()._predict_batch(images, **options)
+        if self.mode == "text":
+            raise TypeError("Cannot encode image as text-only model")
+
+        with self.stage("decode"):
+            decoded = [
+                decode_pil(image, self.image_size) if isinstance(image, (bytes, DecodedImage)) else image
+                for image in images
+            ]
+        outputs = self._encode_images(decoded)
+        return list(outputs[0])
+
+    def _encode_images(self, images: list[Image.Image]) -> list[np.ndarray[int, np.dtype[np.float32]]]:
+        with self.stage("preprocess"):
+            pixel_values = _transform_pil_images(images, self.image_size)
+        with self.stage("run"):
+            outputs: list[np.ndarray[int, np.dtype[np.float32]]] = self.vision_model.run(
+                self.vision_outputs, {"pixel_values": pixel_values}
+            )
+        return outputs
+
+    def _tokenize(self, texts: list[str]) -> dict[str, np.ndarray[int, np.dtype[np.int32]]]:
+        if self.model_name in _MULTILINGUALCLIP_MODELS:
+            text_inputs = self.tokenizer(
+                texts,
+                max_length=_CONTEXT_LENGTH,
+                return_attention_mask=True,
+                return_tensors="np",
+                padding=True,
+                truncation=True,
+            )
+            return {
+                "input_ids": text_inputs["input_ids"].astype(np.int32),
+                "attention_mask": text_inputs["attention_mask"].astype(np.int32),
+            }
+
+        # same as clip-server's `Tokenizer`, but without creating torch tensors
+        sot_token = self.tokenizer.encoder["<|startoftext|>"]
+        eot_token = self.tokenizer.encoder["<|endoftext|>"]
+        input_ids = np.zeros((len(texts), _CONTEXT_LENGTH), dtype=np.int32)
+        attention_mask = np.zeros((len(texts), _CONTEXT_LENGTH), dtype=np.int32)
+        for i, text in enumerate(texts):
+            tokens = [sot_token] + self.tokenizer.encode(text)[: _CONTEXT_LENGTH - 2] + [eot_token]
+            input_ids[i, : len(tokens)] = tokens
+            attention_mask[i, : len(tokens)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def batchable(self, inputs: Any) -> bool:
+        # text is cheap to encode and latency-sensitive, so only images are batched
+        return isinstance(inputs, (bytes, DecodedImage, Image.Image))
+
+    def decode_size(self, **options: Any) -> tuple[int, int] | None:
+        # the shortest side is resized to the model's input size
+        return self.image_size, 0
 
     def _get_jina_model_name(self, model_name: str) -> str:
         if model_name in _MODELS:
@@ -133,22 +188,47 @@ class CLIPEncoder(InferenceModel):
             os.remove(file)
         return True
 
+    def _model_files(self) -> list[Path]:
+        files = []
+        if self.mode == "text" or self.mode is None:
+            files.append(self._model_path(self.cache_dir / "textual.onnx"))
+        if self.mode == "vision" or self.mode is None:
+            files.append(self._model_path(self.cache_dir / "visual.onnx"))
+        return [file for file in files if file.is_file()]
+
     @property
     def cached(self) -> bool:
         return (self.cache_dir / "textual.onnx").is_file() and (self.cache_dir / "visual.onnx").is_file()
 
 
-# same as `_transform_blob` without `_blob2image`
-def _transform_pil_image(n_px: int) -> Compose:
-    return Compose(
-        [
-            Resize(n_px, interpolation=BICUBIC),
-            CenterCrop(n_px),
-            _convert_image_to_rgb,
-            ToTensor(),
-            Normalize(
-                (0.48145466, 0.4578275, 0.40821073),
-                (0.26862954, 0.26130258, 0.27577711),
-            ),
-        ]
-    )
+def _load_tokenizer(model_name: str) -> Any:
+    # importing clip-server's tokenizers pulls in torch, so they're only imported when a text model is loaded
+    if model_name in _MULTILINGUALCLIP_MODELS:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(model_name)
+
+    from clip_server.model.simple_tokenizer import SimpleTokenizer
+
+    return SimpleTokenizer()
+
+
+# same as `_transform_blob` without `_blob2image`, but using NumPy instead of torchvision
+def _transform_pil_images(images: list[Image.Image], n_px: int) -> np.ndarray[int, np.dtype[np.float32]]:
+    pixels = np.stack([np.asarray(_resize_and_crop(image, n_px).convert("RGB")) for image in images])
+    pixel_values = (pixels.astype(np.float32) / 255 - _MEAN) / _STD
+    return np.ascontiguousarray(pixel_values.transpose(0, 3, 1, 2))
+
+
+def _resize_and_crop(image: Image.Image, n_px: int) -> Image.Image:
+    width, height = image.size
+    short, long = (width, height) if width <= height else (height, width)
+    if short != n_px:
+        new_long = int(n_px * long / short)
+        new_width, new_height = (n_px, new_long) if width <= height else (new_long, n_px)
+        image = image.resize((new_width, new_height), resample=Image.BICUBIC)
+        width, height = new_width, new_height
+
+    left = int(round((width - n_px) / 2.0))
+    top = int(round((height - n_px) / 2.0))
+    return image.crop((left, top, left + n_px, top + n_px))
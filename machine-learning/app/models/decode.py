@@ -0,0 +1,159 @@
+import math
+from dataclasses import dataclass
+from functools import cached_property
+from io import BytesIO
+from typing import Any
+
+import cv2
+import numpy as np
+from PIL import ExifTags, Image, ImageOps
+
+from ..config import settings
+
+_CV2_REDUCED_FLAGS = {
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+}
+# EXIF orientations that rotate the image by 90 degrees, which swaps its width and height
+_TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+@dataclass
+class DecodedImage:
+    """An image decoded once for several models, as BGR for OpenCV-based models and RGB for PIL-based ones."""
+
+    bgr: np.ndarray[int, np.dtype[np.uint8]]
+    # width and height of the original image, which coordinates are mapped back to if it was downscaled while decoding
+    size: tuple[int, int]
+
+    @cached_property
+    def pil(self) -> Image.Image:
+        return Image.fromarray(cv2.cvtColor(self.bgr, cv2.COLOR_BGR2RGB))
+
+
+def decode_pil(
+    data: bytes | DecodedImage, min_size: int = 0, safety_factor: float = settings.decode_safety_factor
+) -> Image.Image:
+    """
+    Decodes an image with PIL. JPEGs are downscaled while decoding if their shortest side can stay at or above
+    `min_size * safety_factor`, which skips the work of decoding pixels that would be resized away anyway.
+    Images are rotated by their EXIF orientation, as OpenCV does, so this gives the same image as `decode_cv2`.
+    Images that are already decoded are converted to RGB.
+
+    Args:
+        data: Encoded image.
+        min_size: Shortest side the model resizes the image to. The image is decoded at full size if 0. Defaults to 0.
+        safety_factor: Multiplier of `min_size` to keep as margin for the model's own resizing.
+            The image is decoded at full size if <= 0. Defaults to `settings.decode_safety_factor`.
+    """
+
+    if isinstance(data, DecodedImage):
+        return data.pil
+
+    image = Image.open(BytesIO(data))
+    if min_size > 0 and safety_factor > 0 and image.format == "JPEG":
+        target = math.ceil(min_size * safety_factor)
+        image.draft(image.mode, (target, target))
+    # PIL decodes lazily, so this makes sure decoding isn't deferred to whatever first accesses the pixels
+    image.load()
+    # transposing copies the image even if it isn't rotated, so it's skipped for the usual orientation
+    if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        image = ImageOps.exif_transpose(image)
+    return image
+
+
+def decode_cv2(
+    data: bytes | DecodedImage, max_size: int = 0, safety_factor: float = settings.decode_safety_factor
+) -> tuple[np.ndarray[int, np.dtype[np.uint8]], tuple[int, int]]:
+    """
+    Decodes an image with OpenCV in BGR order. JPEGs are downscaled by a factor of 2, 4 or 8 while decoding
+    if their longest side can stay at or above `max_size * safety_factor`. Images that are already decoded are
+    returned as is.
+
+    Args:
+        data: Encoded image.
+        max_size: Longest side the model resizes the image to. The image is decoded at full size if 0. Defaults to 0.
+        safety_factor: Multiplier of `max_size` to keep as margin for the model's own resizing.
+            The image is decoded at full size if <= 0. Defaults to `settings.decode_safety_factor`.
+
+    Returns:
+        The decoded image and the width and height of the original image, to map coordinates back to it.
+    """
+
+    if isinstance(data, DecodedImage):
+        return data.bgr, data.size
+
+    size = _jpeg_size(data)
+    reduction = 1
+    if size is not None and max_size > 0 and safety_factor > 0:
+        reduction = _reduction(size, math.ceil(max_size * safety_factor))
+
+    image = _imdecode(data, reduction)
+    if reduction == 1 or size is None:
+        size = image.shape[1], image.shape[0]
+    return image, size
+
+
+def decode_shared(
+    data: bytes, sizes: list[tuple[int, int] | None], safety_factor: float = settings.decode_safety_factor
+) -> DecodedImage:
+    """
+    Decodes an image once for several models. JPEGs are downscaled by a factor of 2, 4 or 8 while decoding
+    if their sides stay large enough for every model.
+
+    Args:
+        data: Encoded image.
+        sizes: Minimum shortest and longest side of the image for each model (see `InferenceModel.decode_size`),
+            or None for models that need the image at full size.
+        safety_factor: Multiplier of the sizes to keep as margin for the models' own resizing.
+            The image is decoded at full size if <= 0. Defaults to `settings.decode_safety_factor`.
+    """
+
+    image_size = _jpeg_size(data)
+    reduction = 1
+    if image_size is not None and safety_factor > 0 and all(size is not None for size in sizes):
+        shortest = max((size[0] for size in sizes if size is not None), default=0)
+        longest = max((size[1] for size in sizes if size is not None), default=0)
+        reduction = _reduction(
+            image_size, math.ceil(longest * safety_factor), shortest_target=math.ceil(shortest * safety_factor)
+        )
+
+    image = _imdecode(data, reduction)
+    if reduction == 1 or image_size is None:
+        image_size = image.shape[1], image.shape[0]
+    return DecodedImage(image, image_size)
+
+
+def _imdecode(data: bytes, reduction: int) -> np.ndarray[int, np.dtype[np.uint8]]:
+    image: Any = cv2.imdecode(np.frombuffer(data, np.uint8), _CV2_REDUCED_FLAGS.get(reduction, cv2.IMREAD_COLOR))
+    if image is None:
+        raise ValueError("Failed to decode image")
+    return image
+
+
+def _jpeg_size(data: bytes) -> tuple[int, int] | None:
+    """
+    Reads the width and height of a JPEG from its header, after applying its EXIF orientation like OpenCV does.
+    Returns None if the image isn't a JPEG.
+    """
+
+    try:
+        header = Image.open(BytesIO(data))
+    except OSError:
+        return None
+    if header.format != "JPEG":
+        return None
+
+    width, height = header.size
+    if header.getexif().get(ExifTags.Base.Orientation) in _TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def _reduction(size: tuple[int, int], target: int, shortest_target: int = 0) -> int:
+    longest, shortest = max(size), min(size)
+    for reduction in _CV2_REDUCED_FLAGS:
+        if longest / reduction >= target and shortest / reduction >= shortest_target:
+            return reduction
+    return 1
@@ -1,16 +1,43 @@
+import functools
+import itertools
+import math
 import zipfile
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator, Literal, TypeAlias
 
 import cv2
 import numpy as np
-import onnxruntime as ort
 from insightface.model_zoo import ArcFaceONNX, RetinaFace
+from insightface.model_zoo.retinaface import distance2bbox, distance2kps
 from insightface.utils.face_align import norm_crop
 from insightface.utils.storage import BASE_REPO_URL, download_file
 
+from ..config import settings
 from ..schemas import ModelType
-from .base import InferenceModel
+from .base import QUANTIZED_SUFFIX, InferenceModel
+from .decode import DecodedImage, decode_cv2
+
+NDArray: TypeAlias = np.ndarray[int, np.dtype[Any]]
+
+# longest side of the detector's input in auto mode, which follows the image's size between these bounds
+AUTO_DETECTION_SIZES = (320, 1280)
+# the detector downsamples its input by up to 32x, so its dimensions must be multiples of this
+_SIZE_MULTIPLE = 32
+# tiles overlap by this fraction of their size, so every face smaller than the overlap is fully inside a tile
+_TILE_OVERLAP = 0.25
+# detections this close to an edge between tiles, as a fraction of the tile size, may be cut off and are discarded
+_TILE_EDGE_MARGIN = 0.02
+
+
+@dataclass(frozen=True)
+class DetectionOptions:
+    """The options of a request, which are given to each call instead of being set on the shared model."""
+
+    min_score: float
+    batch_size: int
+    detection_size: int | Literal["auto"]
+    tiled: bool
 
 
 class FaceRecognizer(InferenceModel):
@@ -21,9 +48,29 @@ class FaceRecognizer(InferenceModel):
         model_name: str,
         min_score: float = 0.7,
         cache_dir: Path | str | None = None,
+        batch_size: int = settings.face_batch_size,
+        detection_size: int | Literal["auto"] = 640,
+        tiled: bool = False,
         **model_kwargs: Any,
     ) -> None:
+        """
+        The arguments are defaults for requests that don't set the `minScore`, `batchSize`, `detectionSize` or `tiled`
+        options.
+
+        Args:
+            detection_size: Longest side the image is resized to for face detection. Larger sizes find smaller
+                faces, but are slower. If "auto", it's the longest side of the image, between `AUTO_DETECTION_SIZES`.
+                Defaults to 640.
+            tiled: Whether to also detect faces in overlapping tiles of images more than twice the detection size,
+                which finds faces too small to detect in the whole image. Defaults to False.
+        """
+
         self.min_score = model_kwargs.pop("minScore", min_score)
+        self.batch_size = max(model_kwargs.pop("batchSize", batch_size), 1)
+        self.detection_size = _validate_detection_size(model_kwargs.pop("detectionSize", detection_size))
+        self.tiled = bool(model_kwargs.pop("tiled", tiled))
+        # set if the detection model only supports one input size
+        self.fixed_detection_size: tuple[int, int] | None = None
         super().__init__(model_name, cache_dir, **model_kwargs)
 
     def _download(self) -> None:
@@ -38,29 +85,20 @@ class FaceRecognizer(InferenceModel):
 
     def _load(self) -> None:
         try:
-            det_file = next(self.cache_dir.glob("det_*.onnx"))
-            rec_file = next(self.cache_dir.glob("w600k_*.onnx"))
+            det_file = next(file for file in self.cache_dir.glob("det_*.onnx") if not _is_quantized(file))
+            rec_file = next(file for file in self.cache_dir.glob("w600k_*.onnx") if not _is_quantized(file))
         except StopIteration:
             raise FileNotFoundError("Facial recognition models not found in cache directory")
 
         self.det_model = RetinaFace(
-            session=ort.InferenceSession(
-                det_file.as_posix(),
-                sess_options=self.sess_options,
-                providers=self.providers,
-                provider_options=self.provider_options,
-            ),
+            session=self._create_session(det_file),
         )
         self.rec_model = ArcFaceONNX(
             rec_file.as_posix(),
-            session=ort.InferenceSession(
-                rec_file.as_posix(),
-                sess_options=self.sess_options,
-                providers=self.providers,
-                provider_options=self.provider_options,
-            ),
+            session=self._create_session(rec_file),
         )
 
+        self.fixed_detection_size = self.det_model.input_size
         self.det_model.prepare(
             ctx_id=0,
             det_thresh=self.min_score,
@@ -68,22 +106,62 @@ class FaceRecognizer(InferenceModel):
         )
         self.rec_model.prepare(ctx_id=0)
 
-    def _predict(self, image: np.ndarray[int, np.dtype[Any]] | bytes) -> list[dict[str, Any]]:
-        if isinstance(image, bytes):
-            image = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
-        bboxes, kpss = self.det_model.detect(image)
-        if bboxes.size == 0:
-            return []
-        assert isinstance(image, np.ndarray) and isinstance(kpss, np.ndarray)
+    def _warmup(self) -> None:
+        # a blank image has no faces, so the recognition model is warmed up separately
+        self._predict(np.zeros((*self.det_model.input_size[::-1], 3), dtype=np.uint8))
+        self.rec_model.get_feat(np.zeros((*self.rec_model.input_size[::-1], 3), dtype=np.uint8))
 
-        scores = bboxes[:, 4].tolist()
-        bboxes = bboxes[:, :4].round().tolist()
+    def _predict(self, image: NDArray | bytes | DecodedImage, /, **options: Any) -> list[dict[str, Any]]:
+        return self._predict_batch([image], **options)[0]
+
+    def _predict_batch(
+        self, images: list[NDArray | bytes | DecodedImage], /, **options: Any
+    ) -> list[list[dict[str, Any]]]:
+        detection_options = self.detection_options(**options)
+        with self.stage("decode"):
+            # tiles are detected at a higher resolution than the whole image
+            max_size = 0 if detection_options.tiled else self.max_detection_size(detection_options.detection_size)
+            decoded = [
+                decode_cv2(image, max_size)
+                if isinstance(image, (bytes, DecodedImage))
+                else (image, (image.shape[1], image.shape[0]))
+                for image in images
+            ]
+        # the detector resizes its input and decodes its outputs internally, so it's timed as a whole
+        with self.stage("detect"):
+            if detection_options.tiled:
+                detections = [self._detect(image, detection_options) for image, _ in decoded]
+            else:
+                detections = self._detect_batch([image for image, _ in decoded], detection_options)
+
+        with self.stage("preprocess"):
+            cropped_imgs = [norm_crop(image, kps) for (image, _), (_, kpss) in zip(decoded, detections) for kps in kpss]
+        # embed the aligned faces of all images with as few recognition calls as possible
+        with self.stage("run"):
+            batch_size = detection_options.batch_size
+            embeddings = [
+                self.rec_model.get_feat(cropped_imgs[i : i + batch_size])
+                for i in range(0, len(cropped_imgs), batch_size)
+            ]
 
+        with self.stage("postprocess"):
+            all_embeddings = iter(embedding for batch in embeddings for embedding in batch)
+            return [
+                self._postprocess(image, size, bboxes, all_embeddings)
+                for (image, size), (bboxes, _) in zip(decoded, detections)
+            ]
+
+    def _postprocess(
+        self, image: NDArray, size: tuple[int, int], bboxes: NDArray, embeddings: Iterator[NDArray]
+    ) -> list[dict[str, Any]]:
+        # boxes and dimensions are reported relative to the original image if it was downscaled while decoding,
+        # which may not be by exactly the same factor on each axis as the decoder rounds the dimensions up
+        width, height = size
+        scores = bboxes[:, 4].tolist()
+        scale = np.array([width / image.shape[1], height / image.shape[0]] * 2)
+        boxes = (bboxes[:, :4] * scale).round().tolist()
         results = []
-        height, width, _ = image.shape
-        for (x1, y1, x2, y2), score, kps in zip(bboxes, scores, kpss):
-            cropped_img = norm_crop(image, kps)
-            embedding = self.rec_model.get_feat(cropped_img)[0].tolist()
+        for (x1, y1, x2, y2), score in zip(boxes, scores):
             results.append(
                 {
                     "imageWidth": width,
@@ -95,14 +173,179 @@ class FaceRecognizer(InferenceModel):
                         "y2": y2,
                     },
                     "score": score,
-                    "embedding": embedding,
+                    "embedding": next(embeddings),
                 }
             )
         return results
 
+    def batchable(self, inputs: Any) -> bool:
+        return isinstance(inputs, (bytes, DecodedImage, np.ndarray))
+
+    def decode_size(self, **options: Any) -> tuple[int, int] | None:
+        detection_options = self.detection_options(**options)
+        # tiles are detected at a higher resolution than the whole image
+        return None if detection_options.tiled else (0, self.max_detection_size(detection_options.detection_size))
+
+    def detection_options(self, **options: Any) -> DetectionOptions:
+        """Returns the options of a request, using the ones the model was created with for those it doesn't set."""
+        return DetectionOptions(
+            min_score=options.get("minScore", self.min_score),
+            batch_size=max(options.get("batchSize", self.batch_size), 1),
+            detection_size=_validate_detection_size(options.get("detectionSize", self.detection_size)),
+            tiled=bool(options.get("tiled", self.tiled)),
+        )
+
+    def _detect(self, image: NDArray, options: DetectionOptions) -> tuple[NDArray, NDArray]:
+        height, width = image.shape[:2]
+        input_size = self.detection_input_size(height, width, options.detection_size)
+        [(bboxes, kpss)] = self._detect_batch([image], options)
+        # tiles are twice the detection size, so faces in them are detected at twice the resolution of the whole image
+        tile_size = 2 * max(input_size)
+        if not options.tiled or max(height, width) <= tile_size:
+            return bboxes, kpss
+
+        all_bboxes, all_kpss = [bboxes], [kpss]
+        margin = tile_size * _TILE_EDGE_MARGIN
+        for y, x in itertools.product(_tile_offsets(height, tile_size), _tile_offsets(width, tile_size)):
+            tile = image[y : y + tile_size, x : x + tile_size]
+            tile_height, tile_width = tile.shape[:2]
+            [(tile_bboxes, tile_kpss)] = self._detect_batch([tile], options)
+            # faces cut off by a tile's edge are fully inside a neighbouring tile or found in the whole image
+            inside = np.ones(len(tile_bboxes), dtype=bool)
+            if x > 0:
+                inside &= tile_bboxes[:, 0] > margin
+            if y > 0:
+                inside &= tile_bboxes[:, 1] > margin
+            if x + tile_width < width:
+                inside &= tile_bboxes[:, 2] < tile_width - margin
+            if y + tile_height < height:
+                inside &= tile_bboxes[:, 3] < tile_height - margin
+            offset = np.array([x, y], dtype=np.float32)
+            all_bboxes.append(tile_bboxes[inside] + np.array([*offset, *offset, 0], dtype=np.float32))
+            all_kpss.append(tile_kpss[inside] + offset)
+
+        merged_bboxes, merged_kpss = np.concatenate(all_bboxes), np.concatenate(all_kpss)
+        keep = self.det_model.nms(merged_bboxes)
+        return merged_bboxes[keep], merged_kpss[keep]
+
+    def _detect_batch(
+        self, images: list[NDArray], options: DetectionOptions | None = None
+    ) -> list[tuple[NDArray, NDArray]]:
+        """
+        Detects faces in several images with one call to the detector, giving the same results as `RetinaFace.detect`
+        for each image. Images are letterboxed to a common input size that fits each of their detection sizes.
+        The score threshold is taken from `options` rather than the detector, which is shared by every request.
+        """
+
+        options = options or self.detection_options()
+        det_model = self.det_model
+        input_sizes = [
+            self.detection_input_size(image.shape[0], image.shape[1], options.detection_size) for image in images
+        ]
+        width, height = max(size[0] for size in input_sizes), max(size[1] for size in input_sizes)
+        det_imgs, det_scales = [], []
+        for image, (input_width, input_height) in zip(images, input_sizes):
+            # same resize as `RetinaFace.detect`, padded to the common size
+            im_ratio = image.shape[0] / image.shape[1]
+            if im_ratio > input_height / input_width:
+                new_height, new_width = input_height, int(input_height / im_ratio)
+            else:
+                new_height, new_width = int(input_width * im_ratio), input_width
+            det_img = np.zeros((height, width, 3), dtype=np.uint8)
+            det_img[:new_height, :new_width] = cv2.resize(image, (new_width, new_height))
+            det_imgs.append(det_img)
+            det_scales.append(new_height / image.shape[0])
+
+        mean = (det_model.input_mean,) * 3
+        blob = cv2.dnn.blobFromImages(det_imgs, 1.0 / det_model.input_std, (width, height), mean, swapRB=True)
+        net_outs = det_model.session.run(det_model.output_names, {det_model.input_name: blob})
+        # outputs are either flattened across the batch or have a batch dimension, which reshaping handles alike
+        net_outs = [out.reshape(len(images), -1, out.shape[-1]) for out in net_outs]
+
+        detections = []
+        for i, det_scale in enumerate(det_scales):
+            scores_list, bboxes_list, kpss_list = [], [], []
+            for idx, stride in enumerate(det_model._feat_stride_fpn):
+                anchor_centers = _anchor_centers(height // stride, width // stride, stride, det_model._num_anchors)
+                scores = net_outs[idx][i]
+                pos_inds = np.where(scores >= options.min_score)[0]
+                scores_list.append(scores[pos_inds])
+                bboxes_list.append(distance2bbox(anchor_centers, net_outs[idx + det_model.fmc][i] * stride)[pos_inds])
+                kpss = distance2kps(anchor_centers, net_outs[idx + det_model.fmc * 2][i] * stride)
+                kpss_list.append(kpss.reshape((kpss.shape[0], -1, 2))[pos_inds])
+
+            # same postprocessing as `RetinaFace.detect`
+            order = np.vstack(scores_list).ravel().argsort()[::-1]
+            pre_det = np.hstack((np.vstack(bboxes_list) / det_scale, np.vstack(scores_list)))
+            pre_det = pre_det.astype(np.float32, copy=False)[order]
+            keep = det_model.nms(pre_det)
+            detections.append((pre_det[keep], (np.vstack(kpss_list) / det_scale)[order][keep]))
+        return detections
+
+    def detection_input_size(
+        self, height: int, width: int, detection_size: int | Literal["auto"] | None = None
+    ) -> tuple[int, int]:
+        """
+        Returns the (width, height) of the detector's input for an image. The image's aspect ratio is kept,
+        so the detector doesn't spend time on padding. Uses the model's detection size if `detection_size` is None.
+        """
+
+        if self.fixed_detection_size is not None:
+            return self.fixed_detection_size
+
+        if detection_size is None:
+            detection_size = self.detection_size
+        longest = max(height, width)
+        if detection_size == "auto":
+            size = min(max(longest, AUTO_DETECTION_SIZES[0]), AUTO_DETECTION_SIZES[1])
+        else:
+            size = detection_size
+        scale = size / longest
+        return _round_up(width * scale), _round_up(height * scale)
+
+    def max_detection_size(self, detection_size: int | Literal["auto"] | None = None) -> int:
+        """Longest side of the detector's input for any image."""
+        if self.fixed_detection_size is not None:
+            return max(self.fixed_detection_size)
+        if detection_size is None:
+            detection_size = self.detection_size
+        return AUTO_DETECTION_SIZES[1] if detection_size == "auto" else detection_size
+
     @property
     def cached(self) -> bool:
         return self.cache_dir.is_dir() and any(self.cache_dir.glob("*.onnx"))
 
-    def configure(self, **model_kwargs: Any) -> None:
-        self.det_model.det_thresh = model_kwargs.pop("minScore", self.det_model.det_thresh)
+
+def _is_quantized(file: Path) -> bool:
+    return file.name.endswith(QUANTIZED_SUFFIX)
+
+
+def _validate_detection_size(size: Any) -> int | Literal["auto"]:
+    if size == "auto":
+        return "auto"
+    if not isinstance(size, int) or isinstance(size, bool) or size < _SIZE_MULTIPLE:
+        raise ValueError(f"Detection size must be 'auto' or an integer of at least {_SIZE_MULTIPLE}; got {size!r}")
+    return _round_up(size)
+
+
+def _round_up(size: float) -> int:
+    return max(math.ceil(size / _SIZE_MULTIPLE), 1) * _SIZE_MULTIPLE
+
+
+def _tile_offsets(length: int, tile_size: int) -> list[int]:
+    stride = int(tile_size * (1 - _TILE_OVERLAP))
+    offsets = list(range(0, max(length - tile_size, 0) + 1, stride))
+    # the last tile is aligned with the end of the image, so the tiles cover it entirely
+    if offsets[-1] + tile_size < length:
+        offsets.append(length - tile_size)
+    return offsets
+
+
+@functools.lru_cache(maxsize=64)
+def _anchor_centers(height: int, width: int, stride: int, num_anchors: int) -> NDArray:
+    # same as the anchor centers of `RetinaFace.forward`
+    anchor_centers = np.stack(list(np.mgrid[:height, :width][::-1]), axis=-1).astype(np.float32)
+    anchor_centers = (anchor_centers * stride).reshape((-1, 2))
+    if num_anchors > 1:
+        anchor_centers = np.stack([anchor_centers] * num_anchors, axis=1).reshape((-1, 2))
+    return anchor_centers
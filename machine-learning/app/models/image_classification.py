@@ -1,4 +1,3 @@
-from io import BytesIO
 from pathlib import Path
 from typing import Any
 
@@ -11,6 +10,7 @@ from transformers import AutoImageProcessor
 from ..config import log
 from ..schemas import ModelType
 from .base import InferenceModel
+from .decode import DecodedImage, decode_pil
 
 
 class ImageClassifier(InferenceModel):
@@ -37,6 +37,8 @@ class ImageClassifier(InferenceModel):
 
     def _load(self) -> None:
         processor = AutoImageProcessor.from_pretrained(self.cache_dir, cache_dir=self.cache_dir)
+        size = getattr(processor, "size", None) or {}
+        self.image_size = size.get("shortest_edge") or min(size.get("height", 0), size.get("width", 0))
         model_path = self.cache_dir / "model.onnx"
         model_kwargs = {
             "cache_dir": self.cache_dir,
@@ -46,7 +48,9 @@ class ImageClassifier(InferenceModel):
         }
 
         if model_path.exists():
-            model = ORTModelForImageClassification.from_pretrained(self.cache_dir, **model_kwargs)
+            model = ORTModelForImageClassification.from_pretrained(
+                self.cache_dir, file_name=model_path.name, **model_kwargs
+            )
             self.model = pipeline(self.model_type.value, model, feature_extractor=processor)
         else:
             log.info(
@@ -63,13 +67,22 @@ class ImageClassifier(InferenceModel):
                 feature_extractor=processor,
             )
 
-    def _predict(self, image: Image.Image | bytes) -> list[str]:
-        if isinstance(image, bytes):
-            image = Image.open(BytesIO(image))
-        predictions: list[dict[str, Any]] = self.model(image)  # type: ignore
-        tags = [tag for pred in predictions for tag in pred["label"].split(", ") if pred["score"] >= self.min_score]
+    def _warmup(self) -> None:
+        self._predict(Image.new("RGB", (self.image_size or 224, self.image_size or 224)))
+
+    def _predict(self, image: Image.Image | bytes | DecodedImage, /, **options: Any) -> list[str]:
+        if isinstance(image, (bytes, DecodedImage)):
+            with self.stage("decode"):
+                image = decode_pil(image, self.image_size)
+        # the pipeline preprocesses and postprocesses internally, so it's timed as a whole
+        with self.stage("run"):
+            predictions: list[dict[str, Any]] = self.model(image)  # type: ignore
+        with self.stage("postprocess"):
+            min_score = options.get("minScore", self.min_score)
+            tags = [tag for pred in predictions for tag in pred["label"].split(", ") if pred["score"] >= min_score]
 
         return tags
 
-    def configure(self, **model_kwargs: Any) -> None:
-        self.min_score = model_kwargs.pop("minScore", self.min_score)
+    def decode_size(self, **options: Any) -> tuple[int, int] | None:
+        # the size is read from the processor's config when the model is loaded
+        return (self.image_size, 0) if self.image_size else None
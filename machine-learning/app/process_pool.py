@@ -0,0 +1,120 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from multiprocessing.shared_memory import SharedMemory
+from multiprocessing.synchronize import Barrier
+from typing import Any
+
+from .config import log
+from .models.base import InferenceModel
+from .models.cache import load_options, model_key
+from .schemas import ModelType, PreloadModel
+
+# models loaded by this process if it's a worker, keyed the same way as `ModelCache`
+_models: dict[str, InferenceModel] = {}
+# shared by the workers to wait for each other when warming up
+_started: Barrier | None = None
+
+
+@dataclass(frozen=True)
+class SharedBytes:
+    """Refers to bytes in shared memory, so they don't need to be pickled when sent to a worker."""
+
+    name: str
+    size: int
+
+
+class ProcessPool:
+    """
+    Runs inference in worker processes, each with its own copy of the models.
+    This keeps decoding, preprocessing and postprocessing from contending for the GIL of a single process.
+    """
+
+    def __init__(self, processes: int, preload: list[PreloadModel] | None = None) -> None:
+        """
+        Args:
+            processes: Number of worker processes.
+            preload: Models each worker loads and warms up when it starts. Defaults to None.
+        """
+
+        self.processes = processes
+        # forking would copy the parent's threads and locks, so workers are started fresh
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(
+            processes,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(preload or [], context.Barrier(processes)),
+        )
+
+    async def warmup(self) -> list[int]:
+        """
+        Starts every worker and waits until each has preloaded its models. Workers are otherwise only started as
+        requests are submitted, so the first requests would wait for them to load.
+
+        Returns:
+            The process ID of each worker.
+        """
+
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(*[loop.run_in_executor(self.executor, _warmup) for _ in range(self.processes)])
+
+    async def predict(
+        self, model_name: str, model_type: ModelType, inputs: str | bytes, options: dict[str, Any] | None = None
+    ) -> Any:
+        loop = asyncio.get_running_loop()
+        if not isinstance(inputs, bytes):
+            return await loop.run_in_executor(self.executor, _predict, model_name, model_type, inputs, options or {})
+
+        shm = SharedMemory(create=True, size=max(len(inputs), 1))
+        try:
+            shm.buf[: len(inputs)] = inputs
+            shared = SharedBytes(shm.name, len(inputs))
+            return await loop.run_in_executor(self.executor, _predict, model_name, model_type, shared, options or {})
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _init_worker(preload: list[PreloadModel], started: Barrier) -> None:
+    global _started
+    _started = started
+    for entry in preload:
+        try:
+            _get_model(entry.model_name, entry.model_type, entry.options).warmup()
+        except Exception:
+            log.exception(f"Failed to preload {entry.model_type.replace('-', ' ')} model '{entry.model_name}'")
+
+
+def _warmup() -> int:
+    # each worker blocks until all of them have started, so every worker takes exactly one of these tasks
+    if _started is not None:
+        _started.wait()
+    return os.getpid()
+
+
+def _predict(model_name: str, model_type: ModelType, inputs: str | SharedBytes, options: dict[str, Any]) -> Any:
+    if isinstance(inputs, SharedBytes):
+        shm = SharedMemory(inputs.name)
+        try:
+            data: str | bytes = bytes(shm.buf[: inputs.size])
+        finally:
+            shm.close()
+    else:
+        data = inputs
+
+    return _get_model(model_name, model_type, options).predict(data, **options)
+
+
+def _get_model(model_name: str, model_type: ModelType, options: dict[str, Any]) -> InferenceModel:
+    key = model_key(model_name, model_type, options)
+    model = _models.get(key)
+    if model is None:
+        model = _models[key] = InferenceModel.from_model_type(model_type, model_name, **load_options(options))
+    model.load()
+    return model
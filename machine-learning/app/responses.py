@@ -0,0 +1,121 @@
+from functools import partial
+from typing import Any, Callable
+
+import msgpack
+import numpy as np
+import orjson
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse, Response
+
+# raw formats only contain the embeddings, so they're only supported for outputs that are embeddings or faces
+RAW_DTYPES = {"application/x-float32": np.dtype("<f4"), "application/x-float16": np.dtype("<f2")}
+MSGPACK_MEDIA_TYPES = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+
+
+class JSONResponse(ORJSONResponse):
+    """Serializes the output as JSON, with arrays like embeddings as lists of numbers."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps_json(content)
+
+
+class MsgpackResponse(Response):
+    """Serializes the output with msgpack, storing arrays like embeddings as little-endian binary."""
+
+    media_type = "application/msgpack"
+
+    def __init__(self, content: Any, dtype: np.dtype[Any] = np.dtype("<f4"), **kwargs: Any) -> None:
+        self.dtype = dtype
+        super().__init__(content, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        return msgpack.packb(content, default=partial(_serialize_msgpack, dtype=self.dtype))
+
+
+class EmbeddingResponse(Response):
+    """
+    Serializes the embeddings of the output as a little-endian C-order array with no envelope.
+    The shape of the array is given by the `X-Embedding-Shape` header, e.g. `3,512` for three faces.
+    """
+
+    def __init__(self, content: Any, dtype: np.dtype[Any], media_type: str) -> None:
+        self.embeddings = np.ascontiguousarray(_get_embeddings(content), dtype=dtype)
+        shape = ",".join(str(dim) for dim in self.embeddings.shape)
+        super().__init__(content, media_type=media_type, headers={"X-Embedding-Shape": shape})
+
+    def render(self, content: Any) -> bytes:
+        return self.embeddings.tobytes()
+
+
+def negotiate(accept: str | None) -> Callable[[Any], Response]:
+    """
+    Returns a function that serializes outputs in the first supported format of the `Accept` header,
+    defaulting to JSON.
+
+    The supported formats are:
+        `application/json`: JSON with embeddings as lists of numbers.
+        `application/x-float32` and `application/x-float16`: only the embeddings as raw little-endian floats.
+        `application/msgpack`: the same structure as JSON, with embeddings as little-endian binary.
+            Embeddings are float32 unless the `dtype=float16` parameter is given.
+    """
+
+    for media_type, params in _parse_accept(accept):
+        if media_type in RAW_DTYPES:
+            return partial(EmbeddingResponse, dtype=RAW_DTYPES[media_type], media_type=media_type)
+        if media_type in MSGPACK_MEDIA_TYPES:
+            dtype = np.dtype("<f2") if params.get("dtype") == "float16" else np.dtype("<f4")
+            return partial(MsgpackResponse, dtype=dtype)
+        if media_type in ("application/json", "application/*", "*/*"):
+            break
+    return JSONResponse
+
+
+def dumps_json(content: Any, option: int = 0) -> bytes:
+    return orjson.dumps(content, default=_serialize_array, option=option | orjson.OPT_NON_STR_KEYS)
+
+
+def _serialize_array(obj: Any) -> orjson.Fragment:
+    if not isinstance(obj, np.ndarray):
+        raise TypeError(f"Cannot serialize object of type {type(obj)} with JSON")
+    # float32 numbers are printed with float64 precision, the same as if the array had been converted to a list
+    if obj.dtype.kind == "f":
+        obj = obj.astype(np.float64)
+    return orjson.Fragment(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY))
+
+
+def _parse_accept(accept: str | None) -> list[tuple[str, dict[str, str]]]:
+    if not accept:
+        return []
+
+    media_types = []
+    for entry in accept.split(","):
+        media_type, *param_strs = (part.strip() for part in entry.split(";"))
+        params = dict(param.partition("=")[::2] for param in param_strs)
+        try:
+            quality = float(params.pop("q", 1))
+        except ValueError:
+            quality = 1
+        if quality > 0:
+            media_types.append((quality, media_type.lower(), params))
+    # sorting is stable, so media types with the same quality keep their order
+    media_types.sort(key=lambda entry: entry[0], reverse=True)
+    return [(media_type, params) for _, media_type, params in media_types]
+
+
+def _get_embeddings(outputs: Any) -> np.ndarray[int, np.dtype[Any]]:
+    if isinstance(outputs, np.ndarray):
+        return outputs
+    if isinstance(outputs, list) and all(isinstance(item, dict) and "embedding" in item for item in outputs):
+        if not outputs:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([item["embedding"] for item in outputs])
+    raise HTTPException(406, "Raw embedding formats are only supported for CLIP and facial recognition models")
+
+
+def _serialize_msgpack(obj: Any, dtype: np.dtype[Any]) -> Any:
+    if isinstance(obj, np.ndarray):
+        return np.ascontiguousarray(obj, dtype=dtype).tobytes()
+    # NumPy scalars like scores aren't subclasses of Python's numbers, except for float64
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f"Cannot serialize object of type {type(obj)} with msgpack")
@@ -1,4 +1,5 @@
-from enum import StrEnum
+from enum import IntEnum, StrEnum
+from typing import Any
 
 from pydantic import BaseModel
 
@@ -31,3 +32,89 @@ class ModelType(StrEnum):
     IMAGE_CLASSIFICATION = "image-classification"
     CLIP = "clip"
     FACIAL_RECOGNITION = "facial-recognition"
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class PreloadModel(BaseModel):
+    model_name: str
+    model_type: ModelType
+    options: dict[str, Any] = {}
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class InferenceTask(BaseModel):
+    model_name: str
+    model_type: ModelType
+    options: dict[str, Any] = {}
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class IndexRequest(BaseModel):
+    model_name: str
+    ids: list[str]
+    embeddings: list[list[float]]
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class IndexRemoveRequest(BaseModel):
+    model_name: str
+    ids: list[str]
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class SearchResult(BaseModel):
+    id: str
+    score: float
+
+
+class Face(BaseModel):
+    id: str
+    embedding: list[float]
+
+
+class FaceClusterRequest(BaseModel):
+    model_name: str
+    faces: list[Face]
+    max_distance: float = 0.5
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class FaceReclusterRequest(BaseModel):
+    model_name: str
+    max_distance: float = 0.5
+    min_faces: int = 3
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
+
+
+class DuplicatesRequest(BaseModel):
+    model_name: str
+    id: str | None = None
+    max_distance: int = 6
+    min_similarity: float = 0.9
+
+    class Config:
+        alias_generator = to_lower_camel
+        allow_population_by_field_name = True
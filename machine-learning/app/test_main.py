@@ -1,27 +1,104 @@
+import asyncio
 import json
 import pickle
 from io import BytesIO
+from pathlib import Path
 from typing import Any, TypeAlias
 from unittest import mock
 
 import cv2
+import msgpack
 import numpy as np
+import onnxruntime as ort
+import orjson
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
-from PIL import Image
+from insightface.model_zoo import RetinaFace
+from PIL import ExifTags, Image
 from pytest_mock import MockerFixture
 
+from . import metrics
+from .admission import AdmissionController, Overloaded
+from .batching import MicroBatcher
+from .clustering import FaceClusters, dbscan
 from .config import settings
-from .models.base import PicklableSessionOptions
-from .models.cache import ModelCache
-from .models.clip import CLIPEncoder
+from .duplicates import (
+    HashIndex,
+    _candidate_pairs,
+    find_all_duplicates,
+    find_duplicates,
+    hamming_distance,
+    perceptual_hash,
+)
+from .index import VectorIndex
+from .main import _infer, app, predict_batch, preload_models, start_workers
+from .models import get_model_class
+from .models.base import InferenceModel, PicklableSessionOptions, optimize_model, quantize_model
+from .models.cache import LRUCache, ModelCache, ResultCache
+from .models.clip import CLIPEncoder, _transform_pil_images
+from .models.decode import DecodedImage, decode_cv2, decode_pil, decode_shared
 from .models.facial_recognition import FaceRecognizer
 from .models.image_classification import ImageClassifier
-from .schemas import ModelType
+from .process_pool import ProcessPool, _get_model
+from .responses import negotiate
+from .schemas import ModelType, PreloadModel, Priority
 
 ndarray: TypeAlias = np.ndarray[int, np.dtype[np.float32]]
 
 
+def save_matmul_model(path: Path) -> None:
+    """Saves a model with a single MatMul node that maps an input of shape (1, 64) to (1, 32)."""
+    from onnx import TensorProto, helper, numpy_helper
+
+    weights = np.random.rand(64, 32).astype(np.float32)
+    graph = helper.make_graph(
+        [helper.make_node("MatMul", ["input", "weights"], ["output"])],
+        "test",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, [1, 64])],
+        [helper.make_tensor_value_info("output", TensorProto.FLOAT, [1, 32])],
+        [numpy_helper.from_array(weights, "weights")],
+    )
+    # onnxruntime doesn't support the IR version of newer onnx releases
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    path.write_bytes(model.SerializeToString())
+
+
+def save_retinaface_model(path: Path) -> None:
+    """
+    Saves a model with the same inputs and outputs as insightface's RetinaFace detectors with keypoints:
+    scores, box distances and keypoint distances for 2 anchors at strides of 8, 16 and 32.
+    Scores and distances are derived from the image's brightness around each anchor.
+    """
+    from onnx import TensorProto, helper
+
+    nodes: list[Any] = []
+    outputs: dict[str, list[Any]] = {"score": [], "bbox": [], "kps": []}
+    for stride in (8, 16, 32):
+        nodes += [
+            helper.make_node(
+                "AveragePool", ["input"], [f"pool{stride}"], kernel_shape=[stride] * 2, strides=[stride] * 2
+            ),
+            helper.make_node("ReduceMean", [f"pool{stride}"], [f"mean{stride}"], axes=[1]),
+            helper.make_node("Transpose", [f"mean{stride}"], [f"feat{stride}"], perm=[0, 2, 3, 1]),
+        ]
+        for name, channels, last_dim in (("score", 2, 1), ("bbox", 8, 4), ("kps", 20, 10)):
+            nodes.append(helper.make_node("Concat", [f"feat{stride}"] * channels, [f"{name}{stride}_nhwc"], axis=3))
+            activation = "Sigmoid" if name == "score" else "Abs"
+            nodes.append(helper.make_node(activation, [f"{name}{stride}_nhwc"], [f"{name}{stride}_act"]))
+            nodes.append(helper.make_node("Reshape", [f"{name}{stride}_act", f"shape{last_dim}"], [f"{name}{stride}"]))
+            outputs[name].append(helper.make_tensor_value_info(f"{name}{stride}", TensorProto.FLOAT, None))
+    graph = helper.make_graph(
+        nodes,
+        "retinaface",
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 3, "H", "W"])],
+        outputs["score"] + outputs["bbox"] + outputs["kps"],
+        [helper.make_tensor(f"shape{dim}", TensorProto.INT64, [2], [-1, dim]) for dim in (1, 4, 10)],
+    )
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    path.write_bytes(model.SerializeToString())
+
+
 class TestImageClassifier:
     classifier_preds = [
         {"label": "that's an image alright", "score": 0.8},
@@ -59,30 +136,75 @@ class TestCLIP:
 
     def test_basic_image(self, pil_image: Image.Image, mocker: MockerFixture) -> None:
         mocker.patch.object(CLIPEncoder, "download")
-        mocked = mocker.patch("app.models.clip.ort.InferenceSession", autospec=True)
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
         mocked.return_value.run.return_value = [[self.embedding]]
         clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="vision")
         assert clip_encoder.mode == "vision"
         embedding = clip_encoder.predict(pil_image)
 
-        assert isinstance(embedding, list)
-        assert len(embedding) == 512
-        assert all([isinstance(num, float) for num in embedding])
+        assert isinstance(embedding, np.ndarray)
+        assert embedding.shape == (512,)
+        assert embedding.dtype == np.float32
         clip_encoder.vision_model.run.assert_called_once()
 
     def test_basic_text(self, mocker: MockerFixture) -> None:
         mocker.patch.object(CLIPEncoder, "download")
-        mocked = mocker.patch("app.models.clip.ort.InferenceSession", autospec=True)
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
         mocked.return_value.run.return_value = [[self.embedding]]
         clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="text")
         assert clip_encoder.mode == "text"
         embedding = clip_encoder.predict("test search query")
 
-        assert isinstance(embedding, list)
-        assert len(embedding) == 512
-        assert all([isinstance(num, float) for num in embedding])
+        assert isinstance(embedding, np.ndarray)
+        assert embedding.shape == (512,)
+        assert embedding.dtype == np.float32
         clip_encoder.text_model.run.assert_called_once()
 
+    def test_transform_matches_torchvision(self) -> None:
+        from clip_server.model.clip import _transform_blob
+
+        images = [
+            Image.fromarray(np.random.randint(0, 256, size, dtype=np.uint8)) for size in [(600, 800, 3), (97, 31, 3)]
+        ]
+        pixel_values = _transform_pil_images(images, 224)
+
+        assert pixel_values.shape == (2, 3, 224, 224)
+        assert pixel_values.dtype == np.float32
+        for image, values in zip(images, pixel_values):
+            byte_image = BytesIO()
+            image.save(byte_image, format="png")
+            expected = _transform_blob(224)(byte_image.getvalue()).numpy()
+            assert np.allclose(values, expected, atol=1e-5)
+
+    def test_tokenize_matches_clip_server(self, mocker: MockerFixture) -> None:
+        from clip_server.model.tokenization import Tokenizer
+
+        mocker.patch.object(CLIPEncoder, "download")
+        mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="text")
+        clip_encoder.load()
+        texts = ["test search query", "a " * 100]
+
+        inputs = clip_encoder._tokenize(texts)
+        expected = Tokenizer("ViT-B-32::openai")(texts)
+
+        assert inputs["input_ids"].dtype == np.int32
+        assert np.array_equal(inputs["input_ids"], expected["input_ids"].numpy())
+        assert np.array_equal(inputs["attention_mask"], expected["attention_mask"].numpy())
+
+    def test_batch_image(self, pil_image: Image.Image, mocker: MockerFixture) -> None:
+        mocker.patch.object(CLIPEncoder, "download")
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        mocked.return_value.run.return_value = [np.stack([self.embedding] * 3)]
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="vision")
+        embeddings = clip_encoder.predict_batch([pil_image] * 3)
+
+        assert len(embeddings) == 3
+        assert all(len(embedding) == 512 for embedding in embeddings)
+        clip_encoder.vision_model.run.assert_called_once()
+        pixel_values = clip_encoder.vision_model.run.call_args.args[1]["pixel_values"]
+        assert pixel_values.shape == (3, 3, 224, 224)
+
 
 class TestFaceRecognition:
     def test_set_min_score(self, mocker: MockerFixture) -> None:
@@ -95,13 +217,13 @@ class TestFaceRecognition:
         mocker.patch.object(FaceRecognizer, "load")
         face_recognizer = FaceRecognizer("test_model_name", min_score=0.0, cache_dir="test_cache")
 
-        det_model = mock.Mock()
         num_faces = 2
         bbox = np.random.rand(num_faces, 4).astype(np.float32)
         score = np.array([[0.67]] * num_faces).astype(np.float32)
         kpss = np.random.rand(num_faces, 5, 2).astype(np.float32)
-        det_model.detect.return_value = (np.concatenate([bbox, score], axis=-1), kpss)
-        face_recognizer.det_model = det_model
+        detect = mocker.patch.object(
+            face_recognizer, "_detect_batch", return_value=[(np.concatenate([bbox, score], axis=-1), kpss)]
+        )
 
         rec_model = mock.Mock()
         embedding = np.random.rand(num_faces, 512).astype(np.float32)
@@ -114,12 +236,261 @@ class TestFaceRecognition:
         for face in faces:
             assert face["imageHeight"] == 800
             assert face["imageWidth"] == 600
-            assert isinstance(face["embedding"], list)
-            assert len(face["embedding"]) == 512
-            assert all([isinstance(num, float) for num in face["embedding"]])
+            assert isinstance(face["embedding"], np.ndarray)
+            assert face["embedding"].shape == (512,)
+            assert face["embedding"].dtype == np.float32
+
+        detect.assert_called_once()
+        rec_model.get_feat.assert_called_once()
+
+    def test_batch_size(self, cv_image: cv2.Mat, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", min_score=0.0, cache_dir="test_cache", batch_size=2)
+
+        num_faces = 5
+        bbox = np.random.rand(num_faces, 4).astype(np.float32)
+        score = np.array([[0.67]] * num_faces).astype(np.float32)
+        kpss = np.random.rand(num_faces, 5, 2).astype(np.float32)
+        mocker.patch.object(
+            face_recognizer, "_detect_batch", return_value=[(np.concatenate([bbox, score], axis=-1), kpss)]
+        )
+
+        rec_model = mock.Mock()
+        rec_model.get_feat.side_effect = lambda imgs: np.random.rand(len(imgs), 512).astype(np.float32)
+        face_recognizer.rec_model = rec_model
+
+        faces = face_recognizer.predict(cv_image)
+
+        assert len(faces) == num_faces
+        assert [len(call.args[0]) for call in rec_model.get_feat.call_args_list] == [2, 2, 1]
+
+        rec_model.get_feat.reset_mock()
+        face_recognizer.predict(cv_image, batchSize=3)
+
+        assert [len(call.args[0]) for call in rec_model.get_feat.call_args_list] == [3, 2]
+        assert face_recognizer.batch_size == 2
+
+    def test_detection_input_size(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", cache_dir="test_cache")
+        face_recognizer.det_model = mock.Mock()
+
+        assert face_recognizer.detection_input_size(800, 600) == (480, 640)
+        assert face_recognizer.detection_input_size(800, 600, 1000) == (768, 1024)
+        assert face_recognizer.detection_input_size(100, 200, "auto") == (320, 160)
+        assert face_recognizer.detection_input_size(750, 1000, "auto") == (1024, 768)
+        assert face_recognizer.detection_input_size(3000, 4000, "auto") == (1280, 960)
+        assert face_recognizer.max_detection_size("auto") == 1280
+        assert face_recognizer.max_detection_size() == 640
+        face_recognizer.fixed_detection_size = (640, 640)
+        assert face_recognizer.detection_input_size(3000, 4000) == (640, 640)
+
+        with pytest.raises(ValueError):
+            face_recognizer.detection_options(detectionSize="large")
+
+    def test_detection_size_option(self, cv_image: cv2.Mat, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", cache_dir="test_cache")
+        face_recognizer.det_model = mock.Mock()
+        detect = mocker.patch.object(
+            face_recognizer, "_detect_batch", return_value=[(np.empty((0, 5)), np.empty((0, 5, 2)))]
+        )
+        face_recognizer.rec_model = mock.Mock()
+
+        face_recognizer.predict(cv_image, detectionSize=320, minScore=0.5)
+
+        options = detect.call_args.args[1]
+        assert (options.detection_size, options.min_score) == (320, 0.5)
+        assert face_recognizer.detection_input_size(cv_image.shape[0], cv_image.shape[1], options.detection_size) == (
+            256,
+            320,
+        )
+        # options only apply to the request, so the model keeps its own for other requests
+        assert (face_recognizer.detection_size, face_recognizer.min_score) == (640, 0.7)
+        assert face_recognizer.decode_size() == (0, 640)
+        assert face_recognizer.decode_size(detectionSize=320) == (0, 320)
+
+    def test_tiled(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", min_score=0.0, cache_dir="test_cache", tiled=True)
+        image = np.zeros((2000, 3000, 3), dtype=np.uint8)
+
+        def detect(images: list[ndarray], options: Any) -> list[tuple[ndarray, ndarray]]:
+            [image] = images
+            if image.shape[:2] == (2000, 3000):
+                # the same face as in the first tile, which should be merged with it
+                bboxes = np.array([[100, 100, 200, 200, 0.8]], dtype=np.float32)
+            else:
+                # the second face touches the right edge of the tile, so it's only kept in the last column
+                bboxes = np.array([[100, 100, 200, 200, 0.9], [1200, 600, 1279, 700, 0.9]], dtype=np.float32)
+            return [(bboxes, np.repeat(bboxes[:, None, :2], 5, axis=1))]
+
+        det_model = mock.Mock(nms_thresh=0.4)
+        detect_batch = mocker.patch.object(face_recognizer, "_detect_batch", side_effect=detect)
+        det_model.nms.side_effect = lambda dets: RetinaFace.nms(det_model, dets)
+        face_recognizer.det_model = det_model
+        face_recognizer.rec_model = mock.Mock()
+        face_recognizer.rec_model.get_feat.side_effect = lambda imgs: np.random.rand(len(imgs), 512)
+
+        faces = face_recognizer.predict(image)
+
+        # a 3x2 grid of 1280px tiles at x = 0, 960, 1720 and y = 0, 720
+        assert detect_batch.call_count == 7
+        boxes = sorted((face["boundingBox"]["x1"], face["boundingBox"]["y1"]) for face in faces)
+        expected = [(x + 100, y + 100) for x in (0, 960, 1720) for y in (0, 720)] + [(2920, 600), (2920, 1320)]
+        assert boxes == sorted(expected)
+        assert all(face["score"] == pytest.approx(0.9) for face in faces)
+
+    def test_batch_matches_single(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        save_retinaface_model(tmp_path / "det.onnx")
+        det_model = RetinaFace(session=ort.InferenceSession((tmp_path / "det.onnx").as_posix()))
+        det_model.prepare(ctx_id=0, det_thresh=0.6, input_size=(640, 640))
+        face_recognizer = FaceRecognizer("test_model_name", cache_dir="test_cache")
+        face_recognizer.det_model = det_model
+        rng = np.random.default_rng(0)
+        images = [
+            cv2.resize(rng.integers(0, 256, (height // 40, width // 40, 3), dtype=np.uint8), (width, height))
+            for height, width in [(800, 600), (480, 640), (1000, 1000)]
+        ]
+        spy = mocker.spy(det_model.session, "run")
+
+        detections = face_recognizer._detect_batch(images, face_recognizer.detection_options(minScore=0.6))
 
-        det_model.detect.assert_called_once()
-        assert rec_model.get_feat.call_count == num_faces
+        assert spy.call_count == 1
+        for image, (bboxes, kpss) in zip(images, detections):
+            input_size = face_recognizer.detection_input_size(*image.shape[:2])
+            expected_bboxes, expected_kpss = det_model.detect(image, input_size=input_size)
+            assert len(bboxes) > 0
+            assert np.allclose(bboxes, expected_bboxes, atol=1e-3)
+            assert np.allclose(kpss, expected_kpss, atol=1e-3)
+
+        # the threshold is given per request rather than set on the shared detector
+        [(bboxes, _)] = face_recognizer._detect_batch(images[:1], face_recognizer.detection_options(minScore=0.9))
+        assert det_model.det_thresh == 0.6
+        assert len(bboxes) == (detections[0][0][:, 4] >= 0.9).sum()
+
+    def test_predict_batch(self, cv_image: cv2.Mat, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", cache_dir="test_cache", batch_size=4)
+        bboxes = np.array([[10, 10, 50, 50, 0.9], [60, 60, 90, 90, 0.8]], dtype=np.float32)
+        kpss = np.random.rand(2, 5, 2).astype(np.float32) * 40
+        mocker.patch.object(
+            face_recognizer, "_detect_batch", return_value=[(bboxes, kpss), (bboxes[:0], kpss[:0]), (bboxes, kpss)]
+        )
+        face_recognizer.rec_model = mock.Mock()
+        face_recognizer.rec_model.get_feat.side_effect = lambda imgs: np.arange(len(imgs))[:, None] * np.ones(512)
+
+        faces = face_recognizer.predict_batch([cv_image] * 3)
+
+        assert [len(image_faces) for image_faces in faces] == [2, 0, 2]
+        # the faces of every image are embedded together
+        assert [len(call.args[0]) for call in face_recognizer.rec_model.get_feat.call_args_list] == [4]
+        assert [face["embedding"][0] for image_faces in faces for face in image_faces] == [0, 1, 2, 3]
+        assert faces[2][1]["boundingBox"] == {"x1": 60, "y1": 60, "x2": 90, "y2": 90}
+        assert face_recognizer.batchable(b"image") and face_recognizer.batchable(cv_image)
+        assert not face_recognizer.batchable("text")
+
+
+class TestDecode:
+    @pytest.fixture
+    def large_image(self) -> Image.Image:
+        return Image.new("RGB", (4000, 3000), color=(30, 60, 90))
+
+    def test_pil_draft(self, large_image: Image.Image) -> None:
+        byte_image = BytesIO()
+        large_image.save(byte_image, format="jpeg")
+
+        assert decode_pil(byte_image.getvalue(), 224, safety_factor=2).size == (1000, 750)
+        assert decode_pil(byte_image.getvalue(), 224, safety_factor=0).size == (4000, 3000)
+        assert decode_pil(byte_image.getvalue()).size == (4000, 3000)
+
+    def test_pil_only_jpeg(self, large_image: Image.Image) -> None:
+        byte_image = BytesIO()
+        large_image.save(byte_image, format="png")
+
+        assert decode_pil(byte_image.getvalue(), 224, safety_factor=2).size == (4000, 3000)
+
+    def test_cv2_reduced(self, large_image: Image.Image) -> None:
+        byte_image = BytesIO()
+        large_image.save(byte_image, format="jpeg")
+
+        image, size = decode_cv2(byte_image.getvalue(), 640, safety_factor=2)
+        assert size == (4000, 3000)
+        assert image.shape == (1500, 2000, 3)
+        assert np.allclose(image[750, 1000], (90, 60, 30), atol=2)
+
+        image, size = decode_cv2(byte_image.getvalue(), 640, safety_factor=0)
+        assert size == (4000, 3000)
+        assert image.shape == (3000, 4000, 3)
+
+    def test_cv2_original_size(self) -> None:
+        # dimensions are rounded up when downscaling, so they aren't exactly halved
+        byte_image = BytesIO()
+        Image.new("RGB", (4003, 3001)).save(byte_image, format="jpeg")
+        image, size = decode_cv2(byte_image.getvalue(), 640, safety_factor=2)
+        assert image.shape == (1501, 2002, 3)
+        assert size == (4003, 3001)
+
+        # the EXIF orientation is applied, so the width and height of a rotated image are swapped
+        rotated = Image.new("RGB", (4003, 3001))
+        exif = rotated.getexif()
+        exif[ExifTags.Base.Orientation] = 6
+        byte_image = BytesIO()
+        rotated.save(byte_image, format="jpeg", exif=exif)
+        image, size = decode_cv2(byte_image.getvalue(), 640, safety_factor=2)
+        assert image.shape == (2002, 1501, 3)
+        assert size == (3001, 4003)
+        assert decode_shared(byte_image.getvalue(), [(0, 640)], safety_factor=2).size == (3001, 4003)
+
+    def test_face_boxes_scaled(self, large_image: Image.Image, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        face_recognizer = FaceRecognizer("test_model_name", min_score=0.0, cache_dir="test_cache")
+        byte_image = BytesIO()
+        large_image.save(byte_image, format="jpeg")
+
+        kpss = np.random.rand(1, 5, 2).astype(np.float32)
+        detect = mocker.patch.object(
+            face_recognizer, "_detect_batch", return_value=[(np.array([[10, 20, 30, 40, 0.9]], dtype=np.float32), kpss)]
+        )
+        rec_model = mock.Mock()
+        rec_model.get_feat.return_value = np.random.rand(1, 512).astype(np.float32)
+        face_recognizer.rec_model = rec_model
+
+        faces = face_recognizer.predict(byte_image.getvalue())
+
+        assert detect.call_args.args[0][0].shape == (1500, 2000, 3)
+        assert faces[0]["boundingBox"] == {"x1": 20, "y1": 40, "x2": 60, "y2": 80}
+        assert (faces[0]["imageWidth"], faces[0]["imageHeight"]) == (4000, 3000)
+
+        byte_image = BytesIO()
+        Image.new("RGB", (4003, 3001)).save(byte_image, format="jpeg")
+        detect.return_value = [(np.array([[1000, 750, 2002, 1501, 0.9]], dtype=np.float32), kpss)]
+
+        faces = face_recognizer.predict(byte_image.getvalue())
+
+        # boxes are scaled by the original size over the decoded size of 2002x1501 on each axis
+        assert faces[0]["boundingBox"] == {"x1": 2000, "y1": 1500, "x2": 4003, "y2": 3001}
+        assert (faces[0]["imageWidth"], faces[0]["imageHeight"]) == (4003, 3001)
+
+    def test_shared_decode(self, large_image: Image.Image) -> None:
+        byte_image = BytesIO()
+        large_image.save(byte_image, format="jpeg")
+
+        # the longest side needs to stay at 1280 * 2 and the shortest at 224 * 2, so only a 1/2 reduction fits
+        decoded = decode_shared(byte_image.getvalue(), [(224, 0), (0, 1280)], safety_factor=2)
+        assert decoded.bgr.shape == (3000, 4000, 3)
+        decoded = decode_shared(byte_image.getvalue(), [(224, 0), (0, 640)], safety_factor=2)
+        assert decoded.bgr.shape == (1500, 2000, 3)
+        assert decoded.size == (4000, 3000)
+        assert decode_shared(byte_image.getvalue(), [(224, 0), None]).bgr.shape == (3000, 4000, 3)
+
+        image = decode_pil(decoded)
+        assert image.size == (2000, 1500)
+        assert image.getpixel((0, 0)) == pytest.approx((30, 60, 90), abs=2)
+        assert decode_pil(decoded) is image
+        bgr, size = decode_cv2(decoded)
+        assert bgr is decoded.bgr and size == (4000, 3000)
 
 
 @pytest.mark.asyncio
@@ -133,10 +504,8 @@ class TestCache:
 
     async def test_kwargs_used(self, mock_get_model: mock.Mock) -> None:
         model_cache = ModelCache()
-        await model_cache.get("test_model_name", ModelType.IMAGE_CLASSIFICATION, cache_dir="test_cache")
-        mock_get_model.assert_called_once_with(
-            ModelType.IMAGE_CLASSIFICATION, "test_model_name", cache_dir="test_cache"
-        )
+        await model_cache.get("test_model_name", ModelType.IMAGE_CLASSIFICATION, replicas=2, minScore=0.5)
+        mock_get_model.assert_called_once_with(ModelType.IMAGE_CLASSIFICATION, "test_model_name", replicas=2)
 
     async def test_different_clip(self, mock_get_model: mock.Mock) -> None:
         model_cache = ModelCache()
@@ -150,6 +519,30 @@ class TestCache:
         )
         assert len(model_cache.cache._cache) == 2
 
+    async def test_load_options_in_key(self, mock_get_model: mock.Mock) -> None:
+        mock_get_model.side_effect = lambda *args, **kwargs: mock.Mock()
+        model_cache = ModelCache()
+        default = await model_cache.get("buffalo_l", ModelType.FACIAL_RECOGNITION, minScore=0.7)
+        replicated = await model_cache.get("buffalo_l", ModelType.FACIAL_RECOGNITION, minScore=0.7, replicas=2)
+
+        assert default is not replicated
+        # options that only apply to each request use the same model
+        assert await model_cache.get("buffalo_l", ModelType.FACIAL_RECOGNITION, minScore=0.5) is default
+        assert await model_cache.get("buffalo_l", ModelType.FACIAL_RECOGNITION, replicas=2, tiled=True) is replicated
+        assert mock_get_model.call_count == 2
+
+    async def test_request_options_not_defaults(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(FaceRecognizer, "load")
+        model_cache = ModelCache()
+        first = await model_cache.get(
+            "buffalo_l", ModelType.FACIAL_RECOGNITION, detectionSize=1280, tiled=True, minScore=0.1
+        )
+        second = await model_cache.get("buffalo_l", ModelType.FACIAL_RECOGNITION)
+
+        assert second is first
+        assert isinstance(second, FaceRecognizer)
+        assert second.detection_options() == FaceRecognizer("buffalo_l").detection_options()
+
     @mock.patch("app.models.cache.OptimisticLock", autospec=True)
     async def test_model_ttl(self, mock_lock_cls: mock.Mock, mock_get_model: mock.Mock) -> None:
         model_cache = ModelCache(ttl=100)
@@ -163,49 +556,1414 @@ class TestCache:
         await model_cache.get("test_model_name", ModelType.IMAGE_CLASSIFICATION)
         mock_cache_expire.assert_called_once_with(mock.ANY, 100)
 
+    async def test_evicts_least_recently_used(self, mock_get_model: mock.Mock) -> None:
+        mock_get_model.side_effect = lambda *args, **kwargs: mock.Mock(loaded=True, size=60, active_requests=0)
+        model_cache = ModelCache(max_size=100)
+        model1 = await model_cache.get("test_model_name1", ModelType.IMAGE_CLASSIFICATION)
+        model2 = await model_cache.get("test_model_name2", ModelType.IMAGE_CLASSIFICATION)
 
-@pytest.mark.skipif(
-    not settings.test_full,
-    reason="More time-consuming since it deploys the app and loads models.",
-)
-class TestEndpoints:
-    def test_tagging_endpoint(
-        self, pil_image: Image.Image, responses: dict[str, Any], deployed_app: TestClient
-    ) -> None:
-        byte_image = BytesIO()
-        pil_image.save(byte_image, format="jpeg")
-        response = deployed_app.post(
-            "http://localhost:3003/predict",
-            data={
-                "modelName": "microsoft/resnet-50",
-                "modelType": "image-classification",
-                "options": json.dumps({"minScore": 0.0}),
-            },
-            files={"image": byte_image.getvalue()},
+        await model_cache.evict()
+
+        assert list(model_cache.cache._cache.values()) == [model2]
+        assert model1 not in model_cache.cache._cache.values()
+
+    async def test_does_not_evict_models_in_use(self, mock_get_model: mock.Mock) -> None:
+        mock_get_model.side_effect = lambda *args, **kwargs: mock.Mock(loaded=True, size=60, active_requests=0)
+        model_cache = ModelCache(max_size=100)
+        model1 = await model_cache.get("test_model_name1", ModelType.IMAGE_CLASSIFICATION)
+        await model_cache.get("test_model_name2", ModelType.IMAGE_CLASSIFICATION)
+        model1.active_requests = 1
+
+        await model_cache.evict()
+
+        assert list(model_cache.cache._cache.values()) == [model1]
+
+    async def test_no_budget(self, mock_get_model: mock.Mock) -> None:
+        mock_get_model.side_effect = lambda *args, **kwargs: mock.Mock(loaded=True, size=60, active_requests=0)
+        model_cache = ModelCache()
+        await model_cache.get("test_model_name1", ModelType.IMAGE_CLASSIFICATION)
+        await model_cache.get("test_model_name2", ModelType.IMAGE_CLASSIFICATION)
+
+        await model_cache.evict()
+
+        assert len(model_cache.cache._cache) == 2
+
+
+def test_model_size(tmp_path: Path, mocker: MockerFixture) -> None:
+    mocker.patch.object(FaceRecognizer, "_load")
+    mocker.patch("app.models.base.get_rss", side_effect=[1000, 1500])
+    (tmp_path / "det_10g.onnx").write_bytes(b"0" * 200)
+    (tmp_path / "w600k_r50.onnx").write_bytes(b"0" * 400)
+    face_recognizer = FaceRecognizer("buffalo_l", cache_dir=tmp_path)
+
+    face_recognizer.load()
+    assert face_recognizer.size == 600
+
+    with face_recognizer.in_use():
+        assert face_recognizer.active_requests == 1
+    assert face_recognizer.active_requests == 0
+
+
+class TestReplicas:
+    def test_loads_replicas(self, pil_image: Image.Image, mocker: MockerFixture) -> None:
+        mocker.patch.object(CLIPEncoder, "download")
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        mocked.return_value.run.return_value = [[TestCLIP.embedding]]
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="vision", replicas=3)
+
+        clip_encoder.load()
+
+        assert mocked.call_count == 3
+        assert len(clip_encoder._replicas) == 3
+        assert clip_encoder.predict(pil_image).shape == (512,)
+
+    def test_one_request_per_replica(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        classifier = ImageClassifier("test_model_name", cache_dir="test_cache", replicas=2)
+        classifier.load()
+        assert classifier._idle_replicas is not None
+
+        with classifier._acquire() as first, classifier._acquire() as second:
+            assert first is not second
+            assert classifier._idle_replicas.empty()
+        assert classifier._idle_replicas.qsize() == 2
+
+    def test_options_not_stored(self, pil_image: Image.Image, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        classifier = ImageClassifier("test_model_name", cache_dir="test_cache", replicas=2)
+        classifier.load()
+        predictions = [{"label": "a, b", "score": 0.6}, {"label": "c", "score": 0.95}]
+        for replica in classifier._replicas:
+            replica.model = mock.Mock(return_value=predictions)  # type: ignore[attr-defined]
+
+        assert classifier.predict(pil_image, minScore=0.5) == ["a", "b", "c"]
+        assert classifier.predict(pil_image) == ["c"]
+        assert all(
+            isinstance(replica, ImageClassifier) and replica.min_score == 0.9 for replica in classifier._replicas
         )
-        assert response.status_code == 200
-        assert response.json() == responses["image-classification"]
 
-    def test_clip_image_endpoint(
-        self, pil_image: Image.Image, responses: dict[str, Any], deployed_app: TestClient
+    def test_separate_session_options(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        classifier = ImageClassifier("test_model_name", cache_dir="test_cache", replicas=2)
+        classifier.load()
+
+        first, second = classifier._replicas
+        assert first.sess_options is not second.sess_options
+        assert first.sess_options.intra_op_num_threads == second.sess_options.intra_op_num_threads
+
+    def test_busy_model_does_not_block_others(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        thread_pool = ThreadPoolExecutor(3)
+        mocker.patch.object(app.state, "thread_pool", thread_pool)
+        release = threading.Event()
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        mocker.patch.object(ImageClassifier, "_predict", side_effect=lambda image: release.wait(5) and ["tag"])
+        busy = ImageClassifier("busy", cache_dir="test_cache", replicas=2)
+        busy.load()
+        other = mock.MagicMock()
+        other.batchable.return_value = False
+        other.predict.return_value = ["other"]
+
+        async def main() -> list[Any]:
+            busy_requests = [asyncio.ensure_future(_infer(busy, b"image")) for _ in range(3)]
+            await asyncio.sleep(0.1)
+            # a free thread is left for other models while a request waits for one of the busy model's replicas
+            assert await asyncio.wait_for(_infer(other, b"image"), 1) == ["other"]
+            release.set()
+            return await asyncio.gather(*busy_requests)
+
+        assert asyncio.run(main()) == [["tag"]] * 3
+        thread_pool.shutdown()
+
+    def test_single_replica_not_limited(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        classifier = ImageClassifier("test_model_name", cache_dir="test_cache")
+        classifier.load()
+
+        with classifier._acquire() as first, classifier._acquire() as second:
+            assert first is second is classifier
+
+
+class TestQuantization:
+    def test_quantize_model(self, tmp_path: Path) -> None:
+        model_path = tmp_path / "visual.onnx"
+        save_matmul_model(model_path)
+        quantized_path = tmp_path / "visual.int8.onnx"
+
+        quantize_model(model_path, quantized_path)
+
+        assert quantized_path.is_file()
+        assert not list(tmp_path.glob("*.tmp"))
+        inputs = np.random.rand(1, 64).astype(np.float32)
+        expected = ort.InferenceSession(model_path.as_posix()).run(None, {"input": inputs})[0]
+        outputs = ort.InferenceSession(quantized_path.as_posix()).run(None, {"input": inputs})[0]
+        assert np.dot(expected.ravel(), outputs.ravel()) / (np.linalg.norm(expected) * np.linalg.norm(outputs)) > 0.99
+
+    def test_quantized_variant_cached(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        mock_quantize = mocker.patch(
+            "app.models.base.quantize_model", side_effect=lambda path, quantized_path: quantized_path.touch()
+        )
+        mocker.patch("app.models.base.optimize_model")
+        mocker.patch.object(CLIPEncoder, "download")
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        (tmp_path / "visual.onnx").touch()
+
+        for _ in range(2):
+            clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir=tmp_path, mode="vision", quantize=True)
+            clip_encoder.load()
+
+        mock_quantize.assert_called_once_with(tmp_path / "visual.onnx", tmp_path / "visual.int8.onnx")
+        assert mocked.call_args.args[0] == (tmp_path / "visual.int8.onnx").as_posix()
+        assert clip_encoder._model_files() == [tmp_path / "visual.int8.onnx"]
+
+    def test_settings(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(settings, "quantize", [ModelType.CLIP])
+
+        assert CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache").quantize
+        assert not CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", quantize=False).quantize
+        assert not FaceRecognizer("buffalo_l", cache_dir="test_cache").quantize
+
+    def test_only_clip_quantized(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(settings, "quantize", list(ModelType))
+
+        assert CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache").quantize
+        assert not FaceRecognizer("buffalo_l", cache_dir="test_cache").quantize
+        assert not ImageClassifier("microsoft/resnet-50", cache_dir="test_cache", quantize=True).quantize
+
+
+class TestOptimizedModels:
+    def test_optimize_model(self, tmp_path: Path) -> None:
+        model_path = tmp_path / "visual.onnx"
+        save_matmul_model(model_path)
+        stale_path = tmp_path / "visual.optimized-0.0.0-cpu.ort"
+        stale_path.touch()
+        optimized_path = tmp_path / "visual.optimized-1.0.0-cpu.ort"
+
+        optimize_model(model_path, optimized_path, ["CPUExecutionProvider"], [{}])
+
+        assert optimized_path.is_file()
+        assert not stale_path.exists()
+        assert not list(tmp_path.glob("*.tmp"))
+        inputs = np.random.rand(1, 64).astype(np.float32)
+        expected = ort.InferenceSession(model_path.as_posix()).run(None, {"input": inputs})[0]
+        outputs = ort.InferenceSession(optimized_path.as_posix()).run(None, {"input": inputs})[0]
+        assert np.allclose(outputs, expected, atol=1e-5)
+
+    def test_optimized_graph_reused(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        spy = mocker.patch("app.models.base.optimize_model", wraps=optimize_model)
+        mocker.patch.object(CLIPEncoder, "download")
+        save_matmul_model(tmp_path / "visual.onnx")
+        optimized_path = tmp_path / f"visual.optimized-{ort.__version__}-cpu.ort"
+
+        for _ in range(2):
+            clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir=tmp_path, mode="vision")
+            clip_encoder.load()
+
+        spy.assert_called_once()
+        assert spy.call_args.args[1] == optimized_path
+        assert clip_encoder.vision_model._model_path == optimized_path.as_posix()
+
+    def test_falls_back_to_original(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        mocker.patch.object(CLIPEncoder, "download")
+        save_matmul_model(tmp_path / "visual.onnx")
+        optimized_path = tmp_path / f"visual.optimized-{ort.__version__}-cpu.ort"
+        optimized_path.write_bytes(b"corrupted")
+
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir=tmp_path, mode="vision")
+        clip_encoder.load()
+
+        assert clip_encoder.vision_model._model_path == (tmp_path / "visual.onnx").as_posix()
+        assert not optimized_path.exists()
+
+
+class TestLRUCache:
+    def test_evicts_least_recently_used(self) -> None:
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert len(cache) == 2
+        assert (cache.hits, cache.misses) == (3, 1)
+
+    def test_ttl(self, mocker: MockerFixture) -> None:
+        mocked_time = mocker.patch("app.models.cache.time.monotonic", return_value=0.0)
+        cache = LRUCache(2, ttl=10)
+        cache.set("a", 1)
+
+        mocked_time.return_value = 5.0
+        assert cache.get("a") == 1
+        mocked_time.return_value = 11.0
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_text_embeddings_cached(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock(model_name="ViT-B-32::openai", model_type=ModelType.CLIP)
+        model.predict.return_value = [1.0, 2.0]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", LRUCache(10))
+
+        for text in ["a  dog", " a dog ", "a cat"]:
+            response = deployed_app.post(
+                "http://localhost:3003/predict",
+                data={"modelName": "ViT-B-32::openai", "modelType": "clip", "text": text},
+            )
+            assert response.json() == [1.0, 2.0]
+
+        assert model.predict.call_args_list == [mock.call("a  dog"), mock.call("a cat")]
+        assert (app.state.text_cache.hits, app.state.text_cache.misses) == (1, 2)
+
+    def test_text_cache_keyed_by_load_options(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock(model_name="ViT-B-32::openai", model_type=ModelType.CLIP)
+        model.predict.return_value = [1.0, 2.0]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", LRUCache(10))
+
+        for options in [{}, {"quantize": True}, {"quantize": True}]:
+            deployed_app.post(
+                "http://localhost:3003/predict",
+                data={
+                    "modelName": "ViT-B-32::openai",
+                    "modelType": "clip",
+                    "text": "a dog",
+                    "options": json.dumps(options),
+                },
+            )
+
+        assert model.predict.call_count == 2
+        assert (app.state.text_cache.hits, app.state.text_cache.misses) == (1, 2)
+
+
+class TestResultCache:
+    def test_evicts_by_size(self) -> None:
+        cache = ResultCache(10)
+        cache.set("a", b"12345")
+        cache.set("b", b"12345")
+        cache.set("c", b"1")
+
+        assert cache.get("a") is None
+        assert cache.get("b") == b"12345"
+        assert cache.get("c") == b"1"
+        assert cache.memory.size == 6
+
+    def test_persists_to_disk(self, tmp_path: Path) -> None:
+        ResultCache(10, folder=tmp_path).set("abcdef", b"12345")
+        cache = ResultCache(10, folder=tmp_path)
+
+        assert (tmp_path / "ab" / "abcdef.json").read_bytes() == b"12345"
+        assert cache.get("abcdef") == b"12345"
+        assert cache.get("abcdef") == b"12345"
+        assert cache.disk_hits == 1
+
+    def test_key(self) -> None:
+        key = ResultCache.key(b"image", "buffalo_l", ModelType.FACIAL_RECOGNITION, {"minScore": 0.7, "a": 1})
+
+        assert key == ResultCache.key(b"image", "buffalo_l", ModelType.FACIAL_RECOGNITION, {"a": 1, "minScore": 0.7})
+        assert key != ResultCache.key(b"image", "buffalo_l", ModelType.FACIAL_RECOGNITION, {"minScore": 0.5})
+        assert key != ResultCache.key(b"image", "buffalo_s", ModelType.FACIAL_RECOGNITION, {"minScore": 0.7})
+        assert key != ResultCache.key(b"other", "buffalo_l", ModelType.FACIAL_RECOGNITION, {"minScore": 0.7})
+
+    def test_image_results_cached(
+        self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture
     ) -> None:
+        model = mock.MagicMock()
+        model.predict.return_value = ["tag"]
+        mocked_get = mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "result_cache", ResultCache(2**20))
         byte_image = BytesIO()
         pil_image.save(byte_image, format="jpeg")
+
+        for _ in range(2):
+            response = deployed_app.post(
+                "http://localhost:3003/predict",
+                data={"modelName": "microsoft/resnet-50", "modelType": "image-classification"},
+                files={"image": byte_image.getvalue()},
+            )
+            assert response.json() == ["tag"]
+
+        model.predict.assert_called_once()
+        mocked_get.assert_called_once()
+
+
+@pytest.mark.asyncio
+class TestMicroBatcher:
+    async def test_batches_concurrent_requests(self) -> None:
+        model = mock.MagicMock()
+        model.predict_batch.side_effect = lambda inputs: [f"output {i}" for i in inputs]
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=10)
+
+        outputs = await asyncio.gather(*[batcher.submit(model, i) for i in range(3)])
+
+        assert outputs == ["output 0", "output 1", "output 2"]
+        model.predict_batch.assert_called_once_with([0, 1, 2])
+
+    async def test_groups_by_options(self) -> None:
+        model = mock.MagicMock()
+        model.predict_batch.side_effect = lambda inputs, **options: [(i, options) for i in inputs]
+        batcher = MicroBatcher(max_batch_size=4, max_wait_ms=10)
+
+        outputs = await asyncio.gather(
+            batcher.submit(model, 0, {"minScore": 0.5}),
+            batcher.submit(model, 1, {"minScore": 0.7}),
+            batcher.submit(model, 2, {"minScore": 0.5}),
+        )
+
+        assert outputs == [(0, {"minScore": 0.5}), (1, {"minScore": 0.7}), (2, {"minScore": 0.5})]
+        assert model.predict_batch.call_count == 2
+
+    async def test_max_batch_size(self) -> None:
+        model = mock.MagicMock()
+        model.predict_batch.side_effect = lambda inputs: inputs
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=1000)
+
+        outputs = await asyncio.wait_for(asyncio.gather(*[batcher.submit(model, i) for i in range(4)]), 1)
+
+        assert outputs == [0, 1, 2, 3]
+        model.predict_batch.assert_has_calls([mock.call([0, 1]), mock.call([2, 3])])
+
+    async def test_batch_failure_isolated(self) -> None:
+        model = mock.MagicMock()
+        model.predict_batch.side_effect = ValueError("bad image")
+        model.predict.side_effect = lambda inputs: inputs if inputs != "bad" else model.predict_batch([inputs])
+        batcher = MicroBatcher(max_batch_size=2, max_wait_ms=10)
+
+        outputs = await asyncio.gather(
+            batcher.submit(model, "good"), batcher.submit(model, "bad"), return_exceptions=True
+        )
+
+        assert outputs[0] == "good"
+        assert isinstance(outputs[1], ValueError)
+
+
+@pytest.mark.asyncio
+class TestAdmissionController:
+    async def test_admits_by_priority(self) -> None:
+        admission = AdmissionController(concurrency=1, max_queue_size=10)
+        admitted = []
+
+        async def request(name: str, priority: Priority) -> None:
+            await admission.acquire(priority)
+            admitted.append(name)
+
+        await admission.acquire(Priority.NORMAL)
+        tasks = [
+            asyncio.create_task(request(name, priority))
+            for name, priority in [("low", Priority.LOW), ("normal", Priority.NORMAL), ("high", Priority.HIGH)]
+        ]
+        await asyncio.sleep(0)
+        assert admitted == []
+
+        for _ in tasks:
+            admission.release()
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+        assert admitted == ["high", "normal", "low"]
+        assert admission.active == 1
+
+    async def test_sheds_lower_priority(self) -> None:
+        admission = AdmissionController(concurrency=1, max_queue_size=1)
+        await admission.acquire(Priority.NORMAL)
+        low = asyncio.create_task(admission.acquire(Priority.LOW))
+        await asyncio.sleep(0)
+
+        with pytest.raises(Overloaded) as e:
+            await admission.acquire(Priority.LOW)
+        assert e.value.status_code == 429
+
+        high = asyncio.create_task(admission.acquire(Priority.HIGH))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded):
+            await low
+        admission.release()
+        await high
+        assert admission.rejected == {"queue_full": 2, "timeout": 0}
+
+    async def test_timeout(self) -> None:
+        admission = AdmissionController(concurrency=1, max_queue_size=1, timeout=0.01)
+        await admission.acquire(Priority.NORMAL)
+
+        with pytest.raises(Overloaded) as e:
+            await admission.acquire(Priority.HIGH)
+
+        assert e.value.status_code == 503
+        assert e.value.retry_after >= 1
+        assert admission.queue == []
+
+    async def test_cancelled_while_queued(self) -> None:
+        admission = AdmissionController(concurrency=1, max_queue_size=1)
+        await admission.acquire(Priority.NORMAL)
+        task = asyncio.create_task(admission.acquire(Priority.NORMAL))
+        await asyncio.sleep(0)
+
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        admission.release()
+
+        assert admission.queue == []
+        assert admission.active == 0
+
+
+class TestPriority:
+    def test_rejected_request(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", None)
+        mocker.patch.object(app.state, "admission", AdmissionController(concurrency=0, max_queue_size=0))
+
         response = deployed_app.post(
             "http://localhost:3003/predict",
-            data={"modelName": "ViT-B-32::openai", "modelType": "clip", "options": json.dumps({"mode": "vision"})},
-            files={"image": byte_image.getvalue()},
+            data={"modelName": "ViT-B-32::openai", "modelType": "clip", "text": "a dog"},
+            headers={"X-Priority": "low"},
         )
-        assert response.status_code == 200
-        assert response.json() == responses["clip"]["image"]
 
-    def test_clip_text_endpoint(self, responses: dict[str, Any], deployed_app: TestClient) -> None:
+        assert response.status_code == 429
+        assert response.headers["retry-after"] == "1"
+        model.predict.assert_not_called()
+
+    def test_invalid_priority(self, deployed_app: TestClient) -> None:
         response = deployed_app.post(
             "http://localhost:3003/predict",
-            data={
-                "modelName": "ViT-B-32::openai",
-                "modelType": "clip",
-                "text": "test search query",
+            data={"modelName": "ViT-B-32::openai", "modelType": "clip", "text": "a dog"},
+            headers={"X-Priority": "urgent"},
+        )
+
+        assert response.status_code == 400
+
+
+class TestProcessPool:
+    @pytest.mark.asyncio
+    async def test_shared_memory(self, mocker: MockerFixture) -> None:
+        from concurrent.futures import ThreadPoolExecutor
+
+        model = mock.Mock()
+        model.predict.side_effect = lambda data, **options: len(data)
+        mock_get_model = mocker.patch("app.process_pool._get_model", return_value=model)
+        pool = ProcessPool.__new__(ProcessPool)
+        # the worker side runs in a thread here, as mocks can't be shared with another process
+        pool.executor = ThreadPoolExecutor(1)  # type: ignore[assignment]
+
+        outputs = await pool.predict("buffalo_l", ModelType.FACIAL_RECOGNITION, b"0" * 1000, {"minScore": 0.5})
+
+        assert outputs == 1000
+        mock_get_model.assert_called_once_with("buffalo_l", ModelType.FACIAL_RECOGNITION, {"minScore": 0.5})
+        assert isinstance(model.predict.call_args.args[0], bytes)
+        assert model.predict.call_args.kwargs == {"minScore": 0.5}
+        pool.shutdown()
+
+    def test_load_options_in_key(self, mocker: MockerFixture) -> None:
+        mocker.patch.dict("app.process_pool._models", clear=True)
+        mock_create = mocker.patch.object(
+            InferenceModel, "from_model_type", side_effect=lambda *args, **kw: mock.Mock()
+        )
+
+        default = _get_model("ViT-B-32::openai", ModelType.CLIP, {"mode": "vision"})
+        quantized = _get_model("ViT-B-32::openai", ModelType.CLIP, {"mode": "vision", "quantize": True})
+
+        assert default is not quantized
+        assert _get_model("ViT-B-32::openai", ModelType.CLIP, {"mode": "vision", "quantize": True}) is quantized
+        assert mock_create.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_warmup_starts_every_worker(self) -> None:
+        pool = ProcessPool(2)
+
+        pids = await asyncio.wait_for(pool.warmup(), 60)
+
+        assert len(set(pids)) == 2
+        pool.shutdown()
+
+    def test_endpoint(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.model_name = "buffalo_l"
+        model.model_type = ModelType.FACIAL_RECOGNITION
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "result_cache", None)
+        process_pool = mock.Mock()
+        process_pool.predict = mocker.AsyncMock(return_value=[])
+        mocker.patch.object(app.state, "process_pool", process_pool)
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={"modelName": "buffalo_l", "modelType": "facial-recognition", "options": '{"minScore": 0.5}'},
+            files={"image": b"image"},
+        )
+
+        assert response.json() == []
+        process_pool.predict.assert_awaited_once_with(
+            "buffalo_l", ModelType.FACIAL_RECOGNITION, b"image", {"minScore": 0.5}
+        )
+        model.load.assert_not_called()
+
+
+class TestMetrics:
+    def test_metrics_endpoint(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.model_name = "metrics-test"
+        model.loaded = True
+        model.predict.side_effect = [[1.0], RuntimeError("failed")]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", None)
+        data = {"modelName": "metrics-test", "modelType": "clip", "text": "a dog"}
+
+        assert deployed_app.post("http://localhost:3003/predict", data=data).status_code == 200
+        with pytest.raises(RuntimeError):
+            deployed_app.post("http://localhost:3003/predict", data=data)
+        response = deployed_app.get("http://localhost:3003/metrics")
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == metrics.CONTENT_TYPE
+        lines = response.text.splitlines()
+        assert 'immich_ml_requests_total{model_name="metrics-test",model_type="clip"} 2.0' in lines
+        assert 'immich_ml_errors_total{model_name="metrics-test",model_type="clip"} 1.0' in lines
+        assert (
+            'immich_ml_stage_duration_seconds_count{model_name="metrics-test",model_type="clip",stage="serialize"} 1.0'
+            in lines
+        )
+        assert "immich_ml_thread_pool_queue_depth 0.0" in lines
+        assert any(line.startswith('immich_ml_cache_hits_total{cache="model"}') for line in lines)
+
+    def test_model_stages(self, pil_image: Image.Image, mocker: MockerFixture) -> None:
+        mocker.patch.object(CLIPEncoder, "download")
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        mocked.return_value.run.return_value = [[TestCLIP.embedding]]
+        mock_time_stage = mocker.patch("app.models.base.time_stage")
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache", mode="vision")
+        image = BytesIO()
+        pil_image.save(image, format="jpeg")
+
+        clip_encoder.predict(image.getvalue())
+
+        stages = [call.args[2] for call in mock_time_stage.call_args_list]
+        assert stages == ["decode", "preprocess", "run"]
+        assert mock_time_stage.call_args.args[:2] == ("ViT-B-32::openai", "clip")
+
+
+class TestPreload:
+    def test_ready_endpoint(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(app.state, "ready", False)
+        assert deployed_app.get("http://localhost:3003/ready").status_code == 503
+
+        app.state.ready = True
+        response = deployed_app.get("http://localhost:3003/ready")
+        assert response.status_code == 200
+        assert response.json() == "ready"
+
+    def test_preload_models(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        models = {"ViT-B-32::openai": mock.MagicMock(), "buffalo_l": mock.MagicMock()}
+        models["buffalo_l"].warmup.side_effect = RuntimeError("failed to warm up")
+        mocked_get = mocker.patch.object(
+            app.state.model_cache, "get", mocker.AsyncMock(side_effect=lambda name, *args, **kwargs: models[name])
+        )
+        mocker.patch.object(app.state, "ready", False)
+        preload = [
+            PreloadModel(model_name="ViT-B-32::openai", model_type=ModelType.CLIP, options={"mode": "text"}),
+            PreloadModel(model_name="buffalo_l", model_type=ModelType.FACIAL_RECOGNITION),
+        ]
+
+        asyncio.run(preload_models(preload))
+
+        mocked_get.assert_has_calls(
+            [
+                mock.call("ViT-B-32::openai", ModelType.CLIP, mode="text"),
+                mock.call("buffalo_l", ModelType.FACIAL_RECOGNITION),
+            ]
+        )
+        models["ViT-B-32::openai"].warmup.assert_called_once()
+        models["buffalo_l"].warmup.assert_called_once()
+        assert app.state.ready
+
+    def test_ready_after_workers_start(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(app.state, "ready", False)
+        process_pool = mock.Mock()
+
+        async def main() -> None:
+            workers_loaded = asyncio.Event()
+            process_pool.warmup = mocker.AsyncMock(side_effect=workers_loaded.wait)
+            task = asyncio.create_task(start_workers(process_pool))
+            await asyncio.sleep(0)
+            assert deployed_app.get("http://localhost:3003/ready").status_code == 503
+
+            workers_loaded.set()
+            await task
+            assert deployed_app.get("http://localhost:3003/ready").status_code == 200
+
+        asyncio.run(main())
+        process_pool.warmup.assert_awaited_once()
+
+    def test_clip_warmup(self, mocker: MockerFixture) -> None:
+        mocker.patch.object(CLIPEncoder, "download")
+        mocked = mocker.patch("app.models.base.ort.InferenceSession", autospec=True)
+        mocked.return_value.run.return_value = [[np.random.rand(512).astype(np.float32)]]
+        clip_encoder = CLIPEncoder("ViT-B-32::openai", cache_dir="test_cache")
+
+        clip_encoder.warmup()
+
+        assert clip_encoder.loaded
+        input_names = sorted(name for call in mocked.return_value.run.call_args_list for name in call.args[1])
+        assert input_names == ["attention_mask", "input_ids", "pixel_values"]
+
+
+class TestBatchEndpoint:
+    def test_streams_results(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.predict.side_effect = lambda text, **options: [float(len(text))] if text != "bad" else 1 / 0
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/batch",
+            data={
+                "modelName": "ViT-B-32::openai",
+                "modelType": "clip",
+                "text": ["a", "bad", "abc"],
+                "options": json.dumps({"mode": "text"}),
+            },
+        )
+
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = sorted((json.loads(line) for line in response.text.splitlines()), key=lambda line: line["index"])
+        assert lines == [
+            {"index": 0, "result": [1.0]},
+            {"index": 1, "error": "division by zero"},
+            {"index": 2, "result": [3.0]},
+        ]
+
+    def test_images(self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.predict.return_value = ["tag"]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/batch",
+            data={"modelName": "microsoft/resnet-50", "modelType": "image-classification"},
+            files=[("image", byte_image.getvalue()), ("image", byte_image.getvalue())],
+        )
+
+        assert response.status_code == 200
+        assert [json.loads(line)["result"] for line in response.text.splitlines()] == [["tag"], ["tag"]]
+        assert model.predict.call_count == 2
+
+    def test_model_in_use_until_streamed(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        mocker.patch.object(ImageClassifier, "_predict", return_value=["tag"])
+        model = ImageClassifier("test_model_name", cache_dir="test_cache")
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+
+        async def stream() -> list[Any]:
+            response = await predict_batch(
+                "test_model_name", ModelType.IMAGE_CLASSIFICATION, "{}", ["a", "b"], None, None
+            )
+            # the model can't be unloaded between the response being returned and the stream starting
+            assert model.active_requests == 1
+            lines = [line async for line in response.body_iterator]
+            assert model.active_requests == 0
+            return lines
+
+        assert len(asyncio.run(stream())) == 2
+
+    def test_no_inputs(self, deployed_app: TestClient) -> None:
+        response = deployed_app.post(
+            "http://localhost:3003/predict/batch",
+            data={"modelName": "ViT-B-32::openai", "modelType": "clip"},
+        )
+
+        assert response.status_code == 400
+
+
+class TestResponseFormats:
+    embedding = np.random.rand(512).astype(np.float32)
+    faces = [
+        {
+            "imageWidth": 600,
+            "imageHeight": 800,
+            "boundingBox": {"x1": 1.0, "y1": 2.0, "x2": 3.0, "y2": 4.0},
+            "score": 0.9,
+            "embedding": embedding,
+        }
+    ] * 2
+
+    def test_json_by_default(self) -> None:
+        for accept in [None, "", "*/*", "application/json, application/msgpack", "text/html"]:
+            response = negotiate(accept)(self.embedding)
+
+            assert response.media_type == "application/json"
+            # numbers are the same as before embeddings were returned as arrays
+            assert orjson.loads(response.body) == self.embedding.tolist()
+
+    def test_raw_float32(self) -> None:
+        response = negotiate("application/x-float32")(self.embedding)
+
+        assert response.media_type == "application/x-float32"
+        assert response.headers["x-embedding-shape"] == "512"
+        assert np.array_equal(np.frombuffer(response.body, dtype="<f4"), self.embedding)
+
+    def test_raw_float16_faces(self) -> None:
+        response = negotiate("application/json;q=0.5, application/x-float16")(self.faces)
+
+        assert response.headers["x-embedding-shape"] == "2,512"
+        embeddings = np.frombuffer(response.body, dtype="<f2").reshape(2, 512)
+        assert np.allclose(embeddings, self.embedding, atol=1e-3)
+
+    def test_raw_unsupported(self) -> None:
+        with pytest.raises(HTTPException) as e:
+            negotiate("application/x-float32")(["tag"])
+
+        assert e.value.status_code == 406
+
+    @pytest.mark.parametrize(
+        "accept,dtype", [("application/msgpack", "<f4"), ("application/msgpack; dtype=float16", "<f2")]
+    )
+    def test_msgpack(self, accept: str, dtype: str) -> None:
+        response = negotiate(accept)(self.faces)
+        faces = msgpack.unpackb(response.body)
+
+        assert response.media_type == "application/msgpack"
+        assert len(faces) == 2
+        for face in faces:
+            assert face["boundingBox"] == {"x1": 1.0, "y1": 2.0, "x2": 3.0, "y2": 4.0}
+            assert face["score"] == 0.9
+            assert np.array_equal(np.frombuffer(face["embedding"], dtype=dtype), self.embedding.astype(dtype))
+
+    def test_msgpack_numpy_scalars(self) -> None:
+        content = {"score": np.float32(0.5), "count": np.int64(3), "box": (np.float64(1.5), 2)}
+
+        response = negotiate("application/msgpack")(content)
+
+        assert msgpack.unpackb(response.body) == {"score": 0.5, "count": 3, "box": [1.5, 2]}
+
+    def test_endpoint(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.predict.return_value = self.embedding
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", None)
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={"modelName": "ViT-B-32::openai", "modelType": "clip", "text": "a dog"},
+            headers={"Accept": "application/x-float32"},
+        )
+
+        assert response.status_code == 200
+        assert np.array_equal(np.frombuffer(response.content, dtype="<f4"), self.embedding)
+
+
+class TestRawEndpoint:
+    def test_image_body(self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.predict.return_value = ["cat"]
+        mock_get = mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "result_cache", None)
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/raw",
+            params={"modelName": "microsoft/resnet-50", "modelType": "image-classification"},
+            headers={"Content-Type": "image/jpeg", "X-Options": json.dumps({"minScore": 0.5})},
+            content=byte_image.getvalue(),
+        )
+
+        assert response.status_code == 200
+        assert response.json() == ["cat"]
+        mock_get.assert_called_once_with("microsoft/resnet-50", ModelType.IMAGE_CLASSIFICATION, minScore=0.5)
+        model.predict.assert_called_once_with(byte_image.getvalue(), minScore=0.5)
+
+    def test_text_body(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        model = mock.MagicMock()
+        model.predict.return_value = [1.0, 2.0]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        mocker.patch.object(app.state, "text_cache", None)
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/raw",
+            headers={"Content-Type": "text/plain", "X-Model-Name": "ViT-B-32::openai", "X-Model-Type": "clip"},
+            content="a dog".encode(),
+        )
+
+        assert response.json() == [1.0, 2.0]
+        model.predict.assert_called_once_with("a dog")
+
+    @pytest.mark.parametrize(
+        "params",
+        [{"modelType": "clip"}, {"modelName": "ViT-B-32::openai"}, {"modelName": "ViT-B-32::openai", "modelType": "x"}],
+    )
+    def test_invalid_params(self, params: dict[str, str], deployed_app: TestClient) -> None:
+        response = deployed_app.post("http://localhost:3003/predict/raw", params=params, content=b"image")
+
+        assert response.status_code == 422
+
+    def test_empty_body(self, deployed_app: TestClient) -> None:
+        response = deployed_app.post(
+            "http://localhost:3003/predict/raw", params={"modelName": "ViT-B-32::openai", "modelType": "clip"}
+        )
+
+        assert response.status_code == 400
+
+
+class TestMultiEndpoint:
+    def test_decodes_once(self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        models = {model_type: mock.MagicMock() for model_type in ModelType}
+        models[ModelType.CLIP].decode_size.return_value = (224, 0)
+        models[ModelType.CLIP].predict.return_value = np.ones(2, dtype=np.float32)
+        models[ModelType.IMAGE_CLASSIFICATION].decode_size.return_value = (224, 0)
+        models[ModelType.IMAGE_CLASSIFICATION].predict.side_effect = RuntimeError("failed to classify")
+        models[ModelType.FACIAL_RECOGNITION].decode_size.return_value = (0, 640)
+        models[ModelType.FACIAL_RECOGNITION].predict.return_value = []
+        mock_get = mocker.patch.object(
+            app.state.model_cache,
+            "get",
+            mocker.AsyncMock(side_effect=lambda name, model_type, **kw: models[model_type]),
+        )
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+        tasks = [
+            {"modelName": "ViT-B-32::openai", "modelType": "clip", "options": {"mode": "vision"}},
+            {"modelName": "microsoft/resnet-50", "modelType": "image-classification"},
+            {"modelName": "buffalo_l", "modelType": "facial-recognition", "options": {"minScore": 0.5}},
+        ]
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/multi",
+            data={"tasks": json.dumps(tasks)},
+            files={"image": byte_image.getvalue()},
+        )
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {"modelName": "ViT-B-32::openai", "modelType": "clip", "result": [1.0, 1.0]},
+            {"modelName": "microsoft/resnet-50", "modelType": "image-classification", "error": "failed to classify"},
+            {"modelName": "buffalo_l", "modelType": "facial-recognition", "result": []},
+        ]
+        mock_get.assert_any_call("buffalo_l", ModelType.FACIAL_RECOGNITION, minScore=0.5)
+        assert models[ModelType.FACIAL_RECOGNITION].predict.call_args.kwargs == {"minScore": 0.5}
+        models[ModelType.FACIAL_RECOGNITION].decode_size.assert_called_once_with(minScore=0.5)
+        inputs = [model.predict.call_args.args[0] for model in models.values()]
+        assert isinstance(inputs[0], DecodedImage)
+        assert all(item is inputs[0] for item in inputs)
+
+    def test_failed_load_only_fails_task(
+        self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture
+    ) -> None:
+        clip = mock.MagicMock()
+        clip.decode_size.return_value = (224, 0)
+        clip.predict.return_value = np.ones(2, dtype=np.float32)
+        face = mock.MagicMock(model_type=ModelType.FACIAL_RECOGNITION, loaded=False)
+        face.load.side_effect = RuntimeError("failed to load")
+
+        def get(model_name: str, model_type: ModelType, **options: Any) -> mock.MagicMock:
+            if model_type == ModelType.IMAGE_CLASSIFICATION:
+                raise ValueError(f"Unknown model '{model_name}'")
+            return clip if model_type == ModelType.CLIP else face
+
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(side_effect=get))
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+        tasks = [
+            {"modelName": "ViT-B-32::openai", "modelType": "clip", "options": {"mode": "vision"}},
+            {"modelName": "ViT-L-14::openai", "modelType": "image-classification"},
+            {"modelName": "buffalo_l", "modelType": "facial-recognition"},
+        ]
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/multi",
+            data={"tasks": json.dumps(tasks)},
+            files={"image": byte_image.getvalue()},
+        )
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {"modelName": "ViT-B-32::openai", "modelType": "clip", "result": [1.0, 1.0]},
+            {
+                "modelName": "ViT-L-14::openai",
+                "modelType": "image-classification",
+                "error": "Unknown model 'ViT-L-14::openai'",
+            },
+            {"modelName": "buffalo_l", "modelType": "facial-recognition", "error": "failed to load"},
+        ]
+        face.decode_size.assert_not_called()
+
+    def test_exif_orientation_matches_predict(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(ImageClassifier, "download")
+        mocker.patch.object(ImageClassifier, "_load")
+        classifier = ImageClassifier("microsoft/resnet-50", cache_dir="test_cache")
+        classifier.image_size = 0
+        classifier.model = mock.Mock(return_value=[])  # type: ignore[attr-defined]
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=classifier))
+        mocker.patch.object(app.state, "result_cache", None)
+        # the left half is white, which is the top half once rotated by the EXIF orientation
+        pixels = np.zeros((32, 64, 3), dtype=np.uint8)
+        pixels[:, :32] = 255
+        image = Image.fromarray(pixels)
+        exif = image.getexif()
+        exif[ExifTags.Base.Orientation] = 6
+        byte_image = BytesIO()
+        image.save(byte_image, format="jpeg", exif=exif, quality=95)
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={"modelName": "microsoft/resnet-50", "modelType": "image-classification"},
+            files={"image": byte_image.getvalue()},
+        )
+        assert response.status_code == 200
+        tasks = [{"modelName": "microsoft/resnet-50", "modelType": "image-classification"}]
+        response = deployed_app.post(
+            "http://localhost:3003/predict/multi",
+            data={"tasks": json.dumps(tasks)},
+            files={"image": byte_image.getvalue()},
+        )
+        assert response.status_code == 200
+
+        single, multi = (np.asarray(call.args[0], dtype=np.float32) for call in classifier.model.call_args_list)
+        assert single.shape == multi.shape == (64, 32, 3)
+        assert single[:32].mean() > 200 and single[32:].mean() < 50
+        assert np.abs(single - multi).mean() < 2
+
+    @pytest.mark.parametrize("tasks", ["[]", "not json", '[{"modelName": "buffalo_l", "modelType": "x"}]'])
+    def test_invalid_tasks(self, tasks: str, pil_image: Image.Image, deployed_app: TestClient) -> None:
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+
+        response = deployed_app.post(
+            "http://localhost:3003/predict/multi", data={"tasks": tasks}, files={"image": byte_image.getvalue()}
+        )
+
+        assert response.status_code == 400
+
+
+class TestVectorIndex:
+    def random_vectors(self, count: int, dim: int = 16, seed: int = 0) -> ndarray:
+        return np.random.default_rng(seed).normal(size=(count, dim)).astype(np.float32)
+
+    def test_search(self, tmp_path: Path) -> None:
+        vectors = self.random_vectors(100)
+        index = VectorIndex(tmp_path / "index")
+        index.add([str(i) for i in range(100)], vectors)
+
+        results = index.search(vectors[42], 3)
+
+        assert len(index) == 100
+        assert len(results) == 3
+        assert results[0][0] == "42"
+        assert results[0][1] == pytest.approx(1.0, abs=1e-3)
+        assert results[0][1] >= results[1][1] >= results[2][1]
+
+    def test_replace_and_remove(self, tmp_path: Path) -> None:
+        vectors = self.random_vectors(10)
+        index = VectorIndex(tmp_path / "index")
+        index.add([str(i) for i in range(10)], vectors)
+
+        index.add(["0"], -vectors[0])
+        index.remove(["1", "missing"])
+
+        assert len(index) == 9
+        assert index.count == 10
+        assert "0" not in [id for id, _ in index.search(vectors[0], 3)]
+        assert "1" not in [id for id, _ in index.search(vectors[1], 10)]
+        assert index.search(-vectors[0], 1)[0][0] == "0"
+
+    def test_persists(self, tmp_path: Path) -> None:
+        vectors = self.random_vectors(10)
+        index = VectorIndex(tmp_path / "index", dtype="float32")
+        index.add([str(i) for i in range(10)], vectors)
+        index.remove(["3"])
+        index.flush()
+
+        reopened = VectorIndex(tmp_path / "index")
+
+        assert reopened.dtype == np.float32
+        assert len(reopened) == 9
+        assert reopened.search(vectors[5], 1)[0][0] == "5"
+        assert "3" not in [id for id, _ in reopened.search(vectors[3], 10)]
+
+    def test_wrong_dimensions(self, tmp_path: Path) -> None:
+        index = VectorIndex(tmp_path / "index")
+        index.add(["0"], self.random_vectors(1))
+
+        with pytest.raises(ValueError):
+            index.add(["1"], self.random_vectors(1, dim=8))
+        with pytest.raises(ValueError):
+            index.search(self.random_vectors(1, dim=8), 1)
+
+    def test_partitions(self, tmp_path: Path) -> None:
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(8, 16))
+        vectors = (centers[rng.integers(0, 8, 2000)] + 0.2 * rng.normal(size=(2000, 16))).astype(np.float32)
+        exact = VectorIndex(tmp_path / "exact")
+        exact.add([str(i) for i in range(2000)], vectors)
+        index = VectorIndex(tmp_path / "ivf", partitions=8, probes=2)
+        index.add([str(i) for i in range(2000)], vectors)
+        index.train()
+
+        recall = np.mean(
+            [
+                len({id for id, _ in index.search(v, 10)} & {id for id, _ in exact.search(v, 10)}) / 10
+                for v in vectors[:50]
+            ]
+        )
+        index.add(["new"], vectors[0] + 0.01)
+
+        assert (tmp_path / "ivf" / "partitions.npz").is_file()
+        assert recall >= 0.9
+        assert "new" in [id for id, _ in index.search(vectors[0], 2)]
+        assert "new" in [id for id, _ in VectorIndex(tmp_path / "ivf", partitions=8).search(vectors[0], 2)]
+
+    def test_trains_in_background(self, tmp_path: Path, mocker: MockerFixture) -> None:
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        vectors = np.random.default_rng(0).normal(size=(300, 16)).astype(np.float32)
+        index = VectorIndex(tmp_path, partitions=8)
+        index.add([str(i) for i in range(300)], vectors)
+        started, release = threading.Event(), threading.Event()
+        train = index._train
+
+        def blocking_train() -> None:
+            started.set()
+            release.wait(5)
+            train()
+
+        mock_train = mocker.patch.object(index, "_train", side_effect=blocking_train)
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(lambda vector: index.search(vector, 1), vectors[:8]))
+
+        # searches compare the query with every vector until training finishes, so they find the exact match
+        assert started.wait(5)
+        assert [result[0][0] for result in results] == [str(i) for i in range(8)]
+        assert index._centroids is None
+        release.set()
+        assert index._training is not None
+        index._training.join(5)
+        mock_train.assert_called_once()
+        assert index._centroids is not None
+        index.search(vectors[0], 1)
+        mock_train.assert_called_once()
+
+
+class TestIndexEndpoints:
+    @pytest.fixture
+    def index(self, tmp_path: Path, mocker: MockerFixture) -> VectorIndex:
+        index = VectorIndex(tmp_path / "index")
+        mocker.patch.object(app.state, "indexes", {"ViT-B-32::openai": index})
+        mocker.patch.object(app.state, "hash_indexes", {"ViT-B-32::openai": HashIndex(tmp_path / "index")})
+        mocker.patch.object(app.state, "result_cache", ResultCache(2**20))
+        return index
+
+    def test_index_and_search(
+        self, pil_image: Image.Image, index: VectorIndex, deployed_app: TestClient, mocker: MockerFixture
+    ) -> None:
+        model = mock.MagicMock()
+        model.predict.side_effect = lambda inputs: np.array([1, 0], dtype=np.float32)
+        model.decode_size.return_value = (224, 0)
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+
+        for _ in range(2):
+            response = deployed_app.post(
+                "http://localhost:3003/predict",
+                data={"modelName": "ViT-B-32::openai", "modelType": "clip", "options": '{"indexId": "asset"}'},
+                files={"image": byte_image.getvalue()},
+            )
+            assert response.status_code == 200
+        response = deployed_app.post(
+            "http://localhost:3003/index",
+            json={"modelName": "ViT-B-32::openai", "ids": ["other"], "embeddings": [[0.0, 1.0]]},
+        )
+        assert response.status_code == 200
+        response = deployed_app.post(
+            "http://localhost:3003/search", data={"modelName": "ViT-B-32::openai", "text": "a photo", "k": "1"}
+        )
+
+        assert response.status_code == 200
+        assert response.json() == [{"id": "asset", "score": pytest.approx(1.0, abs=1e-3)}]
+        # indexed predictions aren't served from the result cache
+        assert model.predict.call_count == 3
+
+    def test_remove(self, index: VectorIndex, deployed_app: TestClient) -> None:
+        index.add(["a", "b"], np.eye(2, dtype=np.float32))
+
+        response = deployed_app.post(
+            "http://localhost:3003/index/remove", json={"modelName": "ViT-B-32::openai", "ids": ["a"]}
+        )
+
+        assert response.status_code == 200
+        assert [id for id, _ in index.search(np.array([1, 0]), 2)] == ["b"]
+
+    def test_invalid(self, pil_image: Image.Image, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+        mocker.patch.object(app.state, "indexes", None)
+
+        disabled = deployed_app.post(
+            "http://localhost:3003/search", data={"modelName": "ViT-B-32::openai", "text": "a photo"}
+        )
+        mocker.patch.object(app.state, "indexes", {})
+        wrong_type = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={"modelName": "buffalo_l", "modelType": "facial-recognition", "options": '{"indexId": "asset"}'},
+            files={"image": byte_image.getvalue()},
+        )
+
+        assert disabled.status_code == 400
+        assert wrong_type.status_code == 400
+
+
+class TestDuplicates:
+    def image(self, seed: int) -> np.ndarray[int, np.dtype[np.uint8]]:
+        noise = np.random.default_rng(seed).random((480, 640, 3)) * 255
+        blurred = cv2.GaussianBlur(noise.astype(np.uint8), (51, 51), 0).astype(np.float32)
+        # stretches the contrast that blurring removed
+        return ((blurred - blurred.min()) * (255 / np.ptp(blurred))).astype(np.uint8)
+
+    def test_perceptual_hash(self) -> None:
+        image = self.image(0)
+        _, copy = cv2.imencode(".jpg", cv2.resize(image, (320, 240)), [cv2.IMWRITE_JPEG_QUALITY, 60])
+
+        image_hash = perceptual_hash(DecodedImage(image, (640, 480)))
+
+        assert bin(image_hash ^ perceptual_hash(copy.tobytes())).count("1") <= 4
+        assert bin(image_hash ^ perceptual_hash(DecodedImage(self.image(1), (640, 480)))).count("1") >= 16
+
+    def test_hamming_distance(self) -> None:
+        hashes = np.array([0, 1, 2**64 - 1], dtype=np.uint64)
+
+        assert hamming_distance(hashes, 0).tolist() == [0, 1, 64]
+        assert hamming_distance(hashes, hashes[::-1]).tolist() == [64, 0, 64]
+
+    @pytest.mark.parametrize("max_distance", [0, 3, 8])
+    def test_pairs(self, max_distance: int, tmp_path: Path) -> None:
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2**63, 500, dtype=np.uint64)
+        hashes[1::2] = hashes[::2] ^ rng.integers(0, 2**8, 250, dtype=np.uint64)
+        index = HashIndex(tmp_path)
+        index.add([str(i) for i in range(500)], hashes.tolist())
+
+        _, a, b = index.pairs(max_distance)
+
+        distances = hamming_distance(hashes[:, np.newaxis], hashes[np.newaxis])
+        expected = np.argwhere(np.triu(distances <= max_distance, k=1))
+        assert np.array_equal(np.stack([a, b], axis=1), expected)
+
+    @pytest.mark.parametrize("max_distance", [3, 8])
+    def test_pairs_comparisons(self, max_distance: int) -> None:
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2**64, 20000, dtype=np.uint64)
+        hashes[1::2] = hashes[::2] ^ rng.integers(0, 2**8, 10000, dtype=np.uint64)
+
+        comparisons = sum(len(a) for a, _ in _candidate_pairs(hashes, max_distance))
+
+        # comparing every pair would take about 200 million comparisons
+        assert comparisons < len(hashes) * (len(hashes) - 1) // 2 // 1000
+
+    def test_find_duplicates(self, tmp_path: Path) -> None:
+        hashes, index = HashIndex(tmp_path), VectorIndex(tmp_path)
+        embeddings = np.eye(4, dtype=np.float32)
+        embeddings[1] += embeddings[0]
+        index.add(["a", "b", "c", "d"], embeddings)
+        # "c" has the same hash as "a" but a different embedding, while "d" has a different hash
+        hashes.add(["a", "b", "c", "d"], [0b0, 0b1, 0b0, 0b1111])
+
+        assert find_duplicates(hashes, index, "a", 2, 0.5) == [
+            {"id": "b", "distance": 1, "similarity": pytest.approx(2**-0.5, abs=1e-3)}
+        ]
+        assert find_all_duplicates(hashes, index, 2, 0.5) == [["a", "b"]]
+        with pytest.raises(KeyError):
+            find_duplicates(hashes, index, "missing", 2, 0.5)
+
+    def test_persists(self, tmp_path: Path) -> None:
+        hashes = HashIndex(tmp_path)
+        hashes.add(["a", "b"], [2**64 - 1, 1])
+        hashes.remove(["b"])
+
+        reopened = HashIndex(tmp_path)
+
+        assert len(reopened) == 1
+        assert reopened.get("a") == 2**64 - 1
+        assert reopened.get("b") is None
+
+    def test_endpoints(self, tmp_path: Path, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(app.state, "indexes", {"ViT-B-32::openai": VectorIndex(tmp_path)})
+        mocker.patch.object(app.state, "hash_indexes", {"ViT-B-32::openai": HashIndex(tmp_path)})
+        mocker.patch.object(app.state, "result_cache", None)
+        model = mock.MagicMock()
+        model.predict.return_value = np.array([1, 0], dtype=np.float32)
+        model.decode_size.return_value = (224, 0)
+        mocker.patch.object(app.state.model_cache, "get", mocker.AsyncMock(return_value=model))
+        for id, image in (("original", self.image(0)), ("copy", self.image(0)), ("other", self.image(1))):
+            response = deployed_app.post(
+                "http://localhost:3003/predict",
+                data={"modelName": "ViT-B-32::openai", "modelType": "clip", "options": json.dumps({"indexId": id})},
+                files={"image": cv2.imencode(".png", image)[1].tobytes()},
+            )
+            assert response.status_code == 200
+
+        response = deployed_app.post(
+            "http://localhost:3003/duplicates", json={"modelName": "ViT-B-32::openai", "id": "original"}
+        )
+        assert response.status_code == 200
+        assert response.json() == [{"id": "copy", "distance": 0, "similarity": pytest.approx(1.0, abs=1e-3)}]
+        response = deployed_app.post("http://localhost:3003/duplicates/all", json={"modelName": "ViT-B-32::openai"})
+        assert response.status_code == 200
+        assert response.json() == [["original", "copy"]]
+        response = deployed_app.post(
+            "http://localhost:3003/duplicates", json={"modelName": "ViT-B-32::openai", "id": "missing"}
+        )
+        assert response.status_code == 404
+
+
+class TestFaceClusters:
+    def faces(self, people: int, faces_per_person: int, noise: float = 0.05) -> ndarray:
+        rng = np.random.default_rng(0)
+        people_embeddings = rng.normal(size=(people, 64))
+        return np.repeat(people_embeddings, faces_per_person, axis=0) + noise * rng.normal(
+            size=(people * faces_per_person, 64)
+        )
+
+    def test_dbscan(self) -> None:
+        embeddings = self.faces(3, 5)
+        embeddings = np.concatenate([embeddings, np.random.default_rng(1).normal(size=(2, 64))])
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        labels = dbscan(embeddings, max_distance=0.5, min_samples=3)
+
+        assert labels.tolist() == [0] * 5 + [1] * 5 + [2] * 5 + [-1, -1]
+
+    def test_dbscan_chunks(self, mocker: MockerFixture) -> None:
+        embeddings = self.faces(4, 10)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        expected = dbscan(embeddings, 0.5, 3)
+        mocker.patch("app.clustering._PAIRS_PER_CHUNK", 40)
+
+        assert dbscan(embeddings, 0.5, 3).tolist() == expected.tolist()
+
+    def test_assign(self, tmp_path: Path) -> None:
+        clusters = FaceClusters(tmp_path / "clusters")
+
+        cluster_ids = clusters.assign([str(i) for i in range(6)], self.faces(2, 3))
+
+        assert cluster_ids == [0, 0, 0, 1, 1, 1]
+        assert clusters.assign(["new"], self.faces(2, 3)[4]) == [1]
+
+    def test_recluster_merges(self, tmp_path: Path) -> None:
+        clusters = FaceClusters(tmp_path / "clusters")
+        angles = np.radians([0, 100, 45])
+        embeddings = np.zeros((3, 64))
+        embeddings[:, 0], embeddings[:, 1] = np.cos(angles), np.sin(angles)
+        # the first two faces are too far apart to be in the same cluster until the third face links them
+        assert clusters.assign(["a", "c", "b"], embeddings) == [0, 1, 0]
+
+        cluster_ids = clusters.recluster(max_distance=0.5, min_faces=2)
+
+        assert cluster_ids == {"a": 0, "c": 0, "b": 0}
+
+    def test_persists(self, tmp_path: Path) -> None:
+        clusters = FaceClusters(tmp_path / "clusters")
+        clusters.assign([str(i) for i in range(6)], self.faces(2, 3))
+        clusters.remove(["0"])
+        clusters.flush()
+
+        reopened = FaceClusters(tmp_path / "clusters")
+
+        assert reopened.clusters == {"1": 0, "2": 0, "3": 1, "4": 1, "5": 1}
+        assert reopened.assign(["6"], np.random.default_rng(2).normal(size=64)) == [2]
+
+
+class TestFaceClusterEndpoints:
+    def test_cluster_and_recluster(self, tmp_path: Path, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(app.state, "face_clusters", {"buffalo_l": FaceClusters(tmp_path / "clusters")})
+        embeddings = TestFaceClusters().faces(2, 3).tolist()
+        faces = [{"id": str(i), "embedding": embedding} for i, embedding in enumerate(embeddings)]
+
+        response = deployed_app.post(
+            "http://localhost:3003/faces/cluster", json={"modelName": "buffalo_l", "faces": faces}
+        )
+        assert response.status_code == 200
+        assert [face["clusterId"] for face in response.json()] == [0, 0, 0, 1, 1, 1]
+
+        response = deployed_app.post(
+            "http://localhost:3003/faces/remove", json={"modelName": "buffalo_l", "ids": ["5"]}
+        )
+        assert response.status_code == 200
+        response = deployed_app.post(
+            "http://localhost:3003/faces/recluster", json={"modelName": "buffalo_l", "minFaces": 3}
+        )
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {"id": "0", "clusterId": 0},
+            {"id": "1", "clusterId": 0},
+            {"id": "2", "clusterId": 0},
+            {"id": "3", "clusterId": None},
+            {"id": "4", "clusterId": None},
+        ]
+
+    def test_disabled(self, deployed_app: TestClient, mocker: MockerFixture) -> None:
+        mocker.patch.object(app.state, "face_clusters", None)
+
+        response = deployed_app.post("http://localhost:3003/faces/recluster", json={"modelName": "buffalo_l"})
+
+        assert response.status_code == 400
+
+
+@pytest.mark.skipif(
+    not settings.test_full,
+    reason="More time-consuming since it deploys the app and loads models.",
+)
+class TestEndpoints:
+    def test_tagging_endpoint(
+        self, pil_image: Image.Image, responses: dict[str, Any], deployed_app: TestClient
+    ) -> None:
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={
+                "modelName": "microsoft/resnet-50",
+                "modelType": "image-classification",
+                "options": json.dumps({"minScore": 0.0}),
+            },
+            files={"image": byte_image.getvalue()},
+        )
+        assert response.status_code == 200
+        assert response.json() == responses["image-classification"]
+
+    def test_clip_image_endpoint(
+        self, pil_image: Image.Image, responses: dict[str, Any], deployed_app: TestClient
+    ) -> None:
+        byte_image = BytesIO()
+        pil_image.save(byte_image, format="jpeg")
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={"modelName": "ViT-B-32::openai", "modelType": "clip", "options": json.dumps({"mode": "vision"})},
+            files={"image": byte_image.getvalue()},
+        )
+        assert response.status_code == 200
+        assert response.json() == responses["clip"]["image"]
+
+    def test_clip_text_endpoint(self, responses: dict[str, Any], deployed_app: TestClient) -> None:
+        response = deployed_app.post(
+            "http://localhost:3003/predict",
+            data={
+                "modelName": "ViT-B-32::openai",
+                "modelType": "clip",
+                "text": "test search query",
                 "options": json.dumps({"mode": "text"}),
             },
         )
@@ -229,6 +1987,21 @@ class TestEndpoints:
         assert response.json() == responses["facial-recognition"]
 
 
+def test_get_model_class() -> None:
+    assert get_model_class(ModelType.CLIP) is CLIPEncoder
+    assert get_model_class(ModelType.FACIAL_RECOGNITION) is FaceRecognizer
+    assert get_model_class(ModelType.IMAGE_CLASSIFICATION) is ImageClassifier
+    with pytest.raises(ValueError):
+        get_model_class("not-a-model-type")  # type: ignore
+
+
+def test_from_model_type() -> None:
+    model = InferenceModel.from_model_type(ModelType.FACIAL_RECOGNITION, "buffalo_l", cache_dir="test_cache")
+
+    assert isinstance(model, FaceRecognizer)
+    assert model.model_name == "buffalo_l"
+
+
 def test_sess_options() -> None:
     sess_options = PicklableSessionOptions()
     sess_options.intra_op_num_threads = 1
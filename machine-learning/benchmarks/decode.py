@@ -0,0 +1,119 @@
+"""
+Measures the speed and accuracy impact of downscaling JPEGs while decoding them.
+
+For each image, the full-size decode is compared with the reduced decode used by the models, both in time
+and in how much the resulting model inputs differ (CLIP pixel values and the face detector's input image).
+
+    python -m benchmarks.decode                       # synthetic 12, 24 and 48 MP photos
+    python -m benchmarks.decode photo1.jpg photo2.jpg # your own photos
+"""
+
+import argparse
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from app.models.clip import _transform_pil_images
+from app.models.decode import decode_cv2, decode_pil
+
+SYNTHETIC_SIZES = [(4000, 3000), (6000, 4000), (8000, 6000)]
+
+
+def synthetic_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    # upscaled noise has smooth gradients and edges, which compresses more like a photo than raw noise
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (height // 64, width // 64, 3), dtype=np.uint8)
+    image = cv2.resize(small, (width, height), interpolation=cv2.INTER_CUBIC)
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, format="jpeg", quality=90)
+    return buffer.getvalue()
+
+
+def timeit(func: Callable[[], Any], repeats: int) -> tuple[float, Any]:
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def letterbox(image: np.ndarray[int, np.dtype[Any]], size: int) -> np.ndarray[int, np.dtype[Any]]:
+    # same resize as insightface's RetinaFace.detect
+    scale = size / max(image.shape[:2])
+    resized: np.ndarray[int, np.dtype[Any]] = cv2.resize(
+        image, (int(image.shape[1] * scale), int(image.shape[0] * scale))
+    )
+    return resized
+
+
+def benchmark(name: str, data: bytes, safety_factor: float, repeats: int) -> dict[str, Any]:
+    def load_pil(factor: float) -> Image.Image:
+        image = decode_pil(data, 224, safety_factor=factor)
+        image.load()
+        return image
+
+    full_pil_time, full_pil = timeit(lambda: load_pil(0), repeats)
+    reduced_pil_time, reduced_pil = timeit(lambda: load_pil(safety_factor), repeats)
+    full_clip, reduced_clip = _transform_pil_images([full_pil, reduced_pil], 224)
+
+    full_cv2_time, (full_cv2, _) = timeit(lambda: decode_cv2(data, 640, safety_factor=0), repeats)
+    reduced_cv2_time, (reduced_cv2, _) = timeit(lambda: decode_cv2(data, 640, safety_factor=safety_factor), repeats)
+    full_det, reduced_det = letterbox(full_cv2, 640), letterbox(reduced_cv2, 640)
+    # dimensions can differ by a pixel due to rounding
+    height, width = min(full_det.shape[0], reduced_det.shape[0]), min(full_det.shape[1], reduced_det.shape[1])
+    det_error = np.abs(full_det[:height, :width].astype(np.float32) - reduced_det[:height, :width]).mean()
+
+    return {
+        "image": name,
+        "size": full_pil.size,
+        "pil_reduced_size": reduced_pil.size,
+        "pil_speedup": full_pil_time / reduced_pil_time,
+        "pil_full_ms": full_pil_time * 1000,
+        "pil_reduced_ms": reduced_pil_time * 1000,
+        "clip_max_abs_error": float(np.abs(full_clip - reduced_clip).max()),
+        "clip_cosine_similarity": float(
+            np.dot(full_clip.ravel(), reduced_clip.ravel()) / (np.linalg.norm(full_clip) * np.linalg.norm(reduced_clip))
+        ),
+        "cv2_reduced_size": reduced_cv2.shape[1::-1],
+        "cv2_speedup": full_cv2_time / reduced_cv2_time,
+        "cv2_full_ms": full_cv2_time * 1000,
+        "cv2_reduced_ms": reduced_cv2_time * 1000,
+        "detector_input_mean_abs_error": float(det_error),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", type=Path, help="JPEGs to benchmark. Uses synthetic images if omitted.")
+    parser.add_argument("--safety-factor", type=float, default=2.0)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.images:
+        inputs = [(path.name, path.read_bytes()) for path in args.images]
+    else:
+        inputs = [(f"synthetic {w}x{h}", synthetic_jpeg(w, h)) for w, h in SYNTHETIC_SIZES]
+
+    for name, data in inputs:
+        result = benchmark(name, data, args.safety_factor, args.repeats)
+        print(f"{result['image']} ({result['size'][0]}x{result['size'][1]})")
+        print(
+            f"  PIL:    {result['pil_full_ms']:.1f}ms -> {result['pil_reduced_ms']:.1f}ms "
+            f"({result['pil_speedup']:.1f}x) at {result['pil_reduced_size']}, CLIP input cosine similarity "
+            f"{result['clip_cosine_similarity']:.5f}, max abs error {result['clip_max_abs_error']:.3f}"
+        )
+        print(
+            f"  OpenCV: {result['cv2_full_ms']:.1f}ms -> {result['cv2_reduced_ms']:.1f}ms "
+            f"({result['cv2_speedup']:.1f}x) at {result['cv2_reduced_size']}, detector input mean abs error "
+            f"{result['detector_input_mean_abs_error']:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
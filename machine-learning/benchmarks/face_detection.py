@@ -0,0 +1,99 @@
+"""
+Measures the latency and recall of facial recognition at different detection sizes.
+
+There are no labels to compare against, so the faces found at the most thorough setting (the largest size with
+tiling) act as the ground truth. Recall is the fraction of those faces that are also found at each setting.
+Use photos with faces of different sizes, like group shots and portraits, to see the trade-off.
+
+    python -m benchmarks.face_detection photo1.jpg photo2.jpg
+    python -m benchmarks.face_detection photos/*.jpg --sizes 320 640 1024 auto --json
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any
+
+from app.models.facial_recognition import FaceRecognizer
+
+DEFAULT_SIZES = ["320", "480", "640", "800", "1024", "1280", "auto"]
+
+
+def parse_size(size: str) -> int | str:
+    return size if size == "auto" else int(size)
+
+
+def run(
+    model: FaceRecognizer, images: list[bytes], repeats: int, **options: Any
+) -> tuple[float, list[list[dict[str, Any]]]]:
+    model.predict(images[0], **options)  # excludes lazy initialization from the timings
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        outputs = [model.predict(image, **options) for image in images]
+        times.append((time.perf_counter() - start) / len(images))
+    return min(times), outputs
+
+
+def iou(a: dict[str, float], b: dict[str, float]) -> float:
+    width = min(a["x2"], b["x2"]) - max(a["x1"], b["x1"])
+    height = min(a["y2"], b["y2"]) - max(a["y1"], b["y1"])
+    intersection = max(width, 0) * max(height, 0)
+    union = (a["x2"] - a["x1"]) * (a["y2"] - a["y1"]) + (b["x2"] - b["x1"]) * (b["y2"] - b["y1"]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def recall(faces: list[list[dict[str, Any]]], reference: list[list[dict[str, Any]]]) -> float | None:
+    found = total = 0
+    for image_faces, reference_faces in zip(faces, reference):
+        total += len(reference_faces)
+        for face in reference_faces:
+            found += any(iou(face["boundingBox"], other["boundingBox"]) >= 0.5 for other in image_faces)
+    return found / total if total else None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="+", type=Path, help="Images with faces.")
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="Detection sizes to compare, or 'auto'.")
+    parser.add_argument("--model", default="buffalo_l")
+    parser.add_argument("--min-score", type=float, default=0.7)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Prints results as JSON lines.")
+    args = parser.parse_args()
+
+    images = [path.read_bytes() for path in args.images]
+    model = FaceRecognizer(args.model, min_score=args.min_score)
+    model.load()
+
+    configs = [(parse_size(size), False) for size in args.sizes]
+    numeric_sizes = [size for size, _ in configs if isinstance(size, int)]
+    reference_config = (max(numeric_sizes, default=1280), True)
+    configs.append(reference_config)
+
+    results: list[dict[str, Any]] = []
+    outputs: dict[tuple[int | str, bool], list[list[dict[str, Any]]]] = {}
+    for size, tiled in configs:
+        latency, outputs[(size, tiled)] = run(model, images, args.repeats, detectionSize=size, tiled=tiled)
+        results.append({"detection_size": size, "tiled": tiled, "latency_ms": latency * 1000})
+
+    reference = outputs[reference_config]
+    for result in results:
+        faces = outputs[(result["detection_size"], result["tiled"])]
+        result["faces"] = sum(len(image_faces) for image_faces in faces)
+        result["recall"] = recall(faces, reference)
+
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+            continue
+        name = f"{result['detection_size']}{' tiled' if result['tiled'] else ''}"
+        recall_str = f"{result['recall']:.3f}" if result["recall"] is not None else "n/a"
+        print(f"{name:>12}: {result['latency_ms']:8.1f}ms/image, {result['faces']:4d} faces, recall {recall_str}")
+    if not args.json:
+        print(f"Reference: {reference_config[0]} tiled, {sum(len(faces) for faces in reference)} faces")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measures the search latency and recall of the embedding index, comparing every vector with the query in float16 and
+float32 and searching a few partitions (IVF) at different numbers of probes.
+
+The vectors are synthetic: random clusters with noise, which is roughly how CLIP embeddings of a photo library are
+distributed. Recall is the fraction of the `k` most similar vectors found by a full float32 search that a setting
+also finds. Indexes are written to a temporary folder unless `--folder` is given, which needs about 1 GiB per million
+512-dimensional float16 vectors.
+
+    python -m benchmarks.index
+    python -m benchmarks.index --count 100000 --partitions 256 --probes 4 16 --json
+"""
+
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from app.index import NDArray, VectorIndex
+
+
+def make_vectors(count: int, dim: int, clusters: int, queries: int) -> tuple[NDArray, NDArray]:
+    """Returns vectors in random clusters, and queries near some of them."""
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)]
+    vectors += rng.normal(scale=0.5, size=vectors.shape).astype(np.float32)
+    query_vectors = vectors[rng.integers(0, count, queries)]
+    query_vectors += rng.normal(scale=0.5, size=query_vectors.shape).astype(np.float32)
+    return vectors, query_vectors
+
+
+def build(folder: Path, vectors: NDArray, dtype: str, chunk_size: int = 100_000) -> VectorIndex:
+    index = VectorIndex(folder, dtype=dtype)  # type: ignore[arg-type]
+    for i in range(0, len(vectors), chunk_size):
+        chunk = vectors[i : i + chunk_size]
+        index.add([str(id) for id in range(i, i + len(chunk))], chunk)
+    return index
+
+
+def run(index: VectorIndex, queries: NDArray, k: int) -> tuple[float, list[set[str]]]:
+    index.search(queries[0], k)  # excludes paging in the matrix from the timings
+    start = time.perf_counter()
+    results = [{id for id, _ in index.search(query, k)} for query in queries]
+    return (time.perf_counter() - start) / len(queries), results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1_000_000, help="Number of vectors to index.")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=100)
+    parser.add_argument("--partitions", type=int, default=1024)
+    parser.add_argument("--probes", nargs="+", type=int, default=[4, 8, 16, 32])
+    parser.add_argument("--folder", type=Path, help="Folder to write the indexes to.")
+    parser.add_argument("--json", action="store_true", help="Prints results as JSON lines.")
+    args = parser.parse_args()
+
+    vectors, queries = make_vectors(args.count, args.dim, args.clusters, args.queries)
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        results: list[dict[str, Any]] = []
+        reference: list[set[str]] = []
+        for dtype in ("float32", "float16"):
+            start = time.perf_counter()
+            index = build(Path(folder) / dtype, vectors, dtype)
+            build_time = time.perf_counter() - start
+            latency, found = run(index, queries, args.k)
+            reference = reference or found
+            mode = f"full {dtype}"
+            results.append({"mode": mode, "build_s": build_time, "latency_ms": latency * 1000, "found": found})
+
+        index = VectorIndex(Path(folder) / "float16", partitions=args.partitions)
+        start = time.perf_counter()
+        index.train()
+        train_time = time.perf_counter() - start
+        for probes in args.probes:
+            index.probes = probes
+            latency, found = run(index, queries, args.k)
+            mode = f"ivf {probes}/{args.partitions}"
+            results.append({"mode": mode, "build_s": train_time, "latency_ms": latency * 1000, "found": found})
+
+    for result in results:
+        found = result.pop("found")
+        result["recall"] = float(np.mean([len(a & b) / len(b) for a, b in zip(found, reference) if b]))
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(
+                f"{result['mode']:>16}: {result['latency_ms']:8.2f}ms/query, recall@{args.k} {result['recall']:.3f}, "
+                f"built in {result['build_s']:.1f}s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""
+Times each stage of the CLIP and facial recognition pipelines without a network connection or a running app.
+
+Models are replaced by tiny synthetic ONNX models with the same inputs and outputs as the real ones, so the timings
+of decoding, preprocessing, postprocessing and serialization are realistic while inference is much faster than with
+real models. The stages are timed by the same instrumentation as the app's metrics. Image classification isn't
+included, as its pipeline needs a downloaded Hugging Face model.
+
+Results can be written as JSON and compared with the results of another commit, e.g.:
+
+    git checkout main && python -m benchmarks.pipeline --output main.json
+    git checkout my-branch && python -m benchmarks.pipeline --compare main.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+import cv2
+import numpy as np
+import onnxruntime as ort
+from fastapi import HTTPException
+
+from app import metrics
+from app.models.base import InferenceModel
+from app.models.clip import CLIPEncoder
+from app.models.facial_recognition import FaceRecognizer
+from app.responses import negotiate
+
+from .decode import synthetic_jpeg
+
+DEFAULT_SIZES = ["640x480", "1920x1080", "4000x3000"]
+SAMPLE_TEXTS = {"short": "a dog", "long": "a group of friends having a picnic in a park on a sunny afternoon " * 4}
+SERIALIZE_FORMATS = {"json": "application/json", "msgpack": "application/msgpack", "float16": "application/x-float16"}
+EMBEDDING_SIZE = 512
+
+
+def save_model(path: Path, nodes: list[Any], inputs: list[Any], outputs: list[Any], weights: list[Any]) -> None:
+    from onnx import helper
+
+    graph = helper.make_graph(nodes, path.stem, inputs, outputs, weights)
+    # onnxruntime doesn't support the IR version of newer onnx releases
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 13)], ir_version=8)
+    path.write_bytes(model.SerializeToString())
+
+
+def save_image_encoder(path: Path, input_name: str, size: int, patch_size: int) -> None:
+    """Saves an encoder with a patch embedding, like a ViT's, followed by pooling and a projection."""
+    from onnx import TensorProto, helper, numpy_helper
+
+    rng = np.random.default_rng(0)
+    save_model(
+        path,
+        [
+            helper.make_node("Conv", [input_name, "patch"], ["patches"], strides=[patch_size] * 2),
+            helper.make_node("GlobalAveragePool", ["patches"], ["pooled"]),
+            helper.make_node("Flatten", ["pooled"], ["features"]),
+            helper.make_node("MatMul", ["features", "projection"], ["embedding"]),
+        ],
+        [helper.make_tensor_value_info(input_name, TensorProto.FLOAT, ["N", 3, size, size])],
+        [helper.make_tensor_value_info("embedding", TensorProto.FLOAT, ["N", EMBEDDING_SIZE])],
+        [
+            numpy_helper.from_array(
+                rng.normal(scale=0.01, size=(64, 3, patch_size, patch_size)).astype(np.float32), "patch"
+            ),
+            numpy_helper.from_array(rng.normal(scale=0.1, size=(64, EMBEDDING_SIZE)).astype(np.float32), "projection"),
+        ],
+    )
+
+
+def save_text_encoder(path: Path, context_length: int = 77) -> None:
+    from onnx import TensorProto, helper, numpy_helper
+
+    projection = np.random.default_rng(0).normal(scale=0.01, size=(context_length, EMBEDDING_SIZE)).astype(np.float32)
+    save_model(
+        path,
+        [
+            helper.make_node("Mul", ["input_ids", "attention_mask"], ["masked"]),
+            helper.make_node("Cast", ["masked"], ["tokens"], to=TensorProto.FLOAT),
+            helper.make_node("MatMul", ["tokens", "projection"], ["embedding"]),
+        ],
+        [
+            helper.make_tensor_value_info("input_ids", TensorProto.INT32, ["N", context_length]),
+            helper.make_tensor_value_info("attention_mask", TensorProto.INT32, ["N", context_length]),
+        ],
+        [helper.make_tensor_value_info("embedding", TensorProto.FLOAT, ["N", EMBEDDING_SIZE])],
+        [numpy_helper.from_array(projection, "projection")],
+    )
+
+
+def save_face_detector(path: Path) -> None:
+    """
+    Saves a detector with the same outputs as insightface's RetinaFace models: scores, box distances and keypoint
+    distances for 2 anchors at strides of 8, 16 and 32. Scores follow the brightness around each anchor, so
+    bright areas of an image are detected as faces. Distances are at least a few strides, so the boxes of nearby
+    anchors overlap and are merged by non-maximum suppression like a real detector's.
+    """
+    from onnx import TensorProto, helper
+
+    nodes: list[Any] = []
+    outputs: dict[str, list[Any]] = {"score": [], "bbox": [], "kps": []}
+    for stride in (8, 16, 32):
+        nodes += [
+            helper.make_node(
+                "AveragePool", ["input"], [f"pool{stride}"], kernel_shape=[stride] * 2, strides=[stride] * 2
+            ),
+            helper.make_node("ReduceMean", [f"pool{stride}"], [f"mean{stride}"], axes=[1]),
+            helper.make_node("Transpose", [f"mean{stride}"], [f"feat{stride}"], perm=[0, 2, 3, 1]),
+        ]
+        for name, channels, last_dim in (("score", 2, 1), ("bbox", 8, 4), ("kps", 20, 10)):
+            nodes.append(helper.make_node("Concat", [f"feat{stride}"] * channels, [f"{name}{stride}_nhwc"], axis=3))
+            if name == "score":
+                nodes.append(helper.make_node("Sigmoid", [f"{name}{stride}_nhwc"], [f"{name}{stride}_act"]))
+            else:
+                nodes.append(helper.make_node("Abs", [f"{name}{stride}_nhwc"], [f"{name}{stride}_abs"]))
+                nodes.append(helper.make_node("Add", [f"{name}{stride}_abs", "distance"], [f"{name}{stride}_act"]))
+            nodes.append(helper.make_node("Reshape", [f"{name}{stride}_act", f"shape{last_dim}"], [f"{name}{stride}"]))
+            outputs[name].append(helper.make_tensor_value_info(f"{name}{stride}", TensorProto.FLOAT, None))
+    save_model(
+        path,
+        nodes,
+        [helper.make_tensor_value_info("input", TensorProto.FLOAT, ["N", 3, "H", "W"])],
+        outputs["score"] + outputs["bbox"] + outputs["kps"],
+        [helper.make_tensor(f"shape{dim}", TensorProto.INT64, [2], [-1, dim]) for dim in (1, 4, 10)]
+        + [helper.make_tensor("distance", TensorProto.FLOAT, [], [4.0])],
+    )
+
+
+def create_models(folder: Path) -> dict[str, InferenceModel]:
+    clip_dir, face_dir = folder / "clip", folder / "facial-recognition"
+    clip_dir.mkdir()
+    face_dir.mkdir()
+    save_image_encoder(clip_dir / "visual.onnx", "pixel_values", 224, 32)
+    save_text_encoder(clip_dir / "textual.onnx")
+    save_face_detector(face_dir / "det_10g.onnx")
+    save_image_encoder(face_dir / "w600k_r50.onnx", "input.1", 112, 16)
+
+    models: dict[str, InferenceModel] = {
+        "clip-vision": CLIPEncoder("ViT-B-32::openai", cache_dir=clip_dir, mode="vision"),
+        "clip-text": CLIPEncoder("ViT-B-32::openai", cache_dir=clip_dir, mode="text"),
+        "facial-recognition": FaceRecognizer("buffalo_l", cache_dir=face_dir),
+    }
+    for model in models.values():
+        model.load()
+    return models
+
+
+def synthetic_photo(width: int, height: int, faces: int = 3) -> bytes:
+    """Returns a JPEG with bright spots that the synthetic face detector finds as faces, whatever the image size."""
+
+    image = cv2.imdecode(np.frombuffer(synthetic_jpeg(width, height), dtype=np.uint8), cv2.IMREAD_COLOR) // 2
+    radius = min(width, height) // 10
+    for face in range(faces):
+        center = (width * (2 * face + 1) // (2 * faces), height // 2)
+        cv2.circle(image, center, radius, (255, 255, 255), thickness=-1)
+    return cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+
+
+def stage_totals() -> dict[tuple[str, ...], tuple[float, int]]:
+    """Returns the total time and count of each stage per model from the app's metrics."""
+
+    totals: dict[tuple[str, ...], tuple[float, int]] = {}
+    for family in metrics.stage_duration_seconds.collect():
+        for sample in family.samples:
+            labels = (sample.labels["model_name"], sample.labels["model_type"], sample.labels["stage"])
+            total, count = totals.get(labels, (0.0, 0))
+            if sample.name.endswith("_sum"):
+                totals[labels] = (sample.value, count)
+            elif sample.name.endswith("_count"):
+                totals[labels] = (total, int(sample.value))
+    return totals
+
+
+def time_stages(model: InferenceModel, inputs: Any, repeats: int) -> tuple[dict[str, float], Any]:
+    """Returns the mean time in milliseconds of each stage of predicting the inputs, and the last output."""
+
+    output = model.predict(inputs)  # excludes lazy initialization from the timings
+    before = stage_totals()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        output = model.predict(inputs)
+    timings = {"total": (time.perf_counter() - start) / repeats * 1000}
+    for (_, model_type, stage), (total, count) in stage_totals().items():
+        previous_total, previous_count = before.get((model.model_name, model_type, stage), (0.0, 0))
+        if model_type == model.model_type.value and count > previous_count:
+            timings[stage] = (total - previous_total) / repeats * 1000
+    return timings, output
+
+
+def time_serialize(output: Any, repeats: int) -> dict[str, float]:
+    timings = {}
+    for name, media_type in SERIALIZE_FORMATS.items():
+        serialize = negotiate(media_type)
+        try:
+            serialize(output)
+        except HTTPException:
+            continue  # outputs without embeddings, e.g. images without faces, can't be serialized as raw arrays
+        timings[f"serialize-{name}"] = min(timeit(lambda: serialize(output), repeats)) * 1000
+    return timings
+
+
+def timeit(func: Callable[[], Any], repeats: int) -> list[float]:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def get_metadata() -> dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "onnxruntime": ort.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_results(results: list[dict[str, Any]], baseline: list[dict[str, Any]] | None = None) -> None:
+    previous = {(r["pipeline"], r["input"], r["stage"]): r["ms"] for r in baseline or []}
+    for result in results:
+        line = f"{result['pipeline']:>18} {result['input']:>10} {result['stage']:>18}: {result['ms']:9.3f}ms"
+        before = previous.get((result["pipeline"], result["input"], result["stage"]))
+        if before:
+            line += f" ({(result['ms'] - before) / before:+.1%} vs {before:.3f}ms)"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", default=DEFAULT_SIZES, help="Image sizes to time, e.g. 1920x1080.")
+    parser.add_argument("--repeats", type=int, default=10)
+    parser.add_argument("--output", type=Path, help="Writes the results to this JSON file.")
+    parser.add_argument("--compare", type=Path, help="JSON file of earlier results to compare with.")
+    parser.add_argument("--json", action="store_true", help="Prints results as JSON instead of a table.")
+    args = parser.parse_args()
+
+    results: list[dict[str, Any]] = []
+
+    def record(pipeline: str, input: str, timings: dict[str, float], **extra: Any) -> None:
+        results.extend(
+            {"pipeline": pipeline, "input": input, "stage": stage, "ms": ms, **extra} for stage, ms in timings.items()
+        )
+
+    with tempfile.TemporaryDirectory() as folder:
+        models = create_models(Path(folder))
+        for size in args.sizes:
+            width, height = (int(side) for side in size.split("x"))
+            image = synthetic_photo(width, height)
+            for pipeline in ("clip-vision", "facial-recognition"):
+                timings, output = time_stages(models[pipeline], image, args.repeats)
+                faces = {"faces": len(output)} if pipeline == "facial-recognition" else {}
+                record(pipeline, size, timings | time_serialize(output, args.repeats), **faces)
+        for name, text in SAMPLE_TEXTS.items():
+            timings, output = time_stages(models["clip-text"], text, args.repeats)
+            record("clip-text", name, timings | time_serialize(output, args.repeats))
+
+    report = {"metadata": get_metadata(), "results": results}
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        return
+    baseline = json.loads(args.compare.read_text())["results"] if args.compare is not None else None
+    print_results(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Checks the accuracy and speed of INT8 quantized CLIP models against their FP32 originals. Only CLIP models can be
+quantized, as the other models are mostly convolutions, which aren't quantized.
+
+For each input, the embeddings of both variants are compared by cosine similarity. Models are downloaded to and
+quantized in the cache folder (`MACHINE_LEARNING_CACHE_FOLDER`) as needed.
+
+    python -m benchmarks.quantization                                  # synthetic images and sample texts
+    python -m benchmarks.quantization photo1.jpg photo2.jpg --texts "a dog" "a beach at sunset"
+"""
+
+import argparse
+import json
+import time
+from pathlib import Path
+from typing import Any, Literal
+
+import numpy as np
+
+from app.models.clip import CLIPEncoder
+
+from .decode import synthetic_jpeg
+
+SAMPLE_TEXTS = ["a photo of a dog", "people at the beach", "a birthday cake with candles", "snowy mountains"]
+
+
+def cosine_similarity(a: np.ndarray[int, np.dtype[Any]], b: np.ndarray[int, np.dtype[Any]]) -> float:
+    return float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+
+
+def timed_predict(model: Any, inputs: list[Any]) -> tuple[float, list[Any]]:
+    model.predict(inputs[0])  # excludes lazy initialization from the timings
+    start = time.perf_counter()
+    outputs = [model.predict(item) for item in inputs]
+    return (time.perf_counter() - start) / len(inputs), outputs
+
+
+def summarize(name: str, similarities: list[float], fp32_time: float, int8_time: float) -> dict[str, Any]:
+    return {
+        "model": name,
+        "samples": len(similarities),
+        "mean_cosine_similarity": float(np.mean(similarities)) if similarities else None,
+        "min_cosine_similarity": float(np.min(similarities)) if similarities else None,
+        "fp32_ms": fp32_time * 1000,
+        "int8_ms": int8_time * 1000,
+        "speedup": fp32_time / int8_time,
+    }
+
+
+def compare_clip(model_name: str, mode: Literal["text", "vision"], inputs: list[Any]) -> dict[str, Any]:
+    fp32_time, fp32 = timed_predict(CLIPEncoder(model_name, mode=mode, quantize=False), inputs)
+    int8_time, int8 = timed_predict(CLIPEncoder(model_name, mode=mode, quantize=True), inputs)
+    similarities = [cosine_similarity(a, b) for a, b in zip(fp32, int8)]
+    return summarize(f"{model_name} ({mode})", similarities, fp32_time, int8_time)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", type=Path, help="Images to compare. Uses synthetic images if omitted.")
+    parser.add_argument("--texts", nargs="*", default=SAMPLE_TEXTS, help="Texts to compare.")
+    parser.add_argument("--clip-model", default="ViT-B-32::openai")
+    parser.add_argument("--json", action="store_true", help="Prints results as JSON lines.")
+    args = parser.parse_args()
+
+    if args.images:
+        images = [path.read_bytes() for path in args.images]
+    else:
+        images = [synthetic_jpeg(1920, 1080, seed) for seed in range(8)]
+
+    results = [
+        compare_clip(args.clip_model, "vision", images),
+        compare_clip(args.clip_model, "text", args.texts),
+    ]
+    for result in results:
+        if args.json:
+            print(json.dumps(result))
+            continue
+        similarity = (
+            f"cosine similarity mean {result['mean_cosine_similarity']:.4f}, min {result['min_cosine_similarity']:.4f}"
+            if result["samples"]
+            else "no samples to compare"
+        )
+        print(
+            f"{result['model']}: {result['samples']} samples, {similarity}, "
+            f"{result['fp32_ms']:.1f}ms -> {result['int8_ms']:.1f}ms ({result['speedup']:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,17 @@ class CLIPVisionFormDataLoadTest(InferenceLoadTest):
         self.client.post("/predict", data=data, files=files)
 
 
+class CLIPVisionRawLoadTest(InferenceLoadTest):
+    @task
+    def encode_image(self) -> None:
+        params = {
+            "modelName": self.environment.parsed_options.clip_model,
+            "modelType": "clip",
+            "options": json.dumps({"mode": "vision"}),
+        }
+        self.client.post("/predict/raw", params=params, data=self.data, headers=self.headers)
+
+
 class RecognitionFormDataLoadTest(InferenceLoadTest):
     @task
     def recognize(self) -> None:
@@ -90,3 +101,27 @@ class RecognitionFormDataLoadTest(InferenceLoadTest):
         files = {"image": self.data}
             
         self.client.post("/predict", data=data, files=files)
+
+
+class MultiFormDataLoadTest(InferenceLoadTest):
+    @task
+    def predict_all(self) -> None:
+        tasks = [
+            {
+                "modelName": self.environment.parsed_options.tag_model,
+                "modelType": "image-classification",
+                "options": {"minScore": self.environment.parsed_options.tag_min_score},
+            },
+            {
+                "modelName": self.environment.parsed_options.clip_model,
+                "modelType": "clip",
+                "options": {"mode": "vision"},
+            },
+            {
+                "modelName": self.environment.parsed_options.face_model,
+                "modelType": "facial-recognition",
+                "options": {"minScore": self.environment.parsed_options.face_min_score},
+            },
+        ]
+        files = {"image": self.data}
+        self.client.post("/predict/multi", data={"tasks": json.dumps(tasks)}, files=files)